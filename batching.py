@@ -0,0 +1,201 @@
+import itertools
+
+import numpy as np
+
+import torch
+from torch.utils.data import Sampler, Dataset, IterableDataset, get_worker_info
+
+
+# split indices which are sorted by length (ascending) into batches of at most batchSize texts, if maxTokens is given a batch is filled
+# until its padded size (number of texts * longest text) would exceed maxTokens. A text longer than maxTokens gets its own batch.
+def split_sorted(indices, lengths, batchSize: int, maxTokens: int = None):
+    if not maxTokens:
+        return [indices[i:i + batchSize] for i in range(0, len(indices), batchSize)]
+
+    # the indices are sorted, therefore the padded size of a batch is its number of texts times the length of its last text
+    batches = list()
+    lengths = lengths[indices]
+    start = 0
+    while start < len(indices):
+        costs = np.arange(1, min(batchSize, len(indices) - start) + 1) * lengths[start:start + batchSize]
+        to_take = max(int(np.searchsorted(costs, maxTokens, side="right")), 1)
+        batches.append(indices[start:start + to_take])
+        start += to_take
+    return batches
+
+# inverse of the batching, the outputs of the batches are put back to the original position of their texts
+def restore_order(outputs, indices):
+    indices = np.asarray(indices).reshape(-1)
+    restored = np.empty_like(outputs)
+    restored[indices] = outputs
+    return restored
+
+
+# sampler which yields batches of indices of texts with similar length, the texts are shuffled and split into buckets
+# of bucketFactor * batchSize texts which are sorted by length, the order of the batches is shuffled every epoch.
+# If maxTokens is given a batch is filled until its padded size (number of texts * longest text) would exceed maxTokens.
+class LengthBucketSampler(Sampler):
+    def __init__(self, lengths, batchSize: int, maxTokens: int = None, shuffle: bool = True, bucketFactor: int = 50, seed: int = 42):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batchSize = batchSize
+        self.maxTokens = maxTokens
+        self.shuffle = shuffle
+        self.bucketFactor = bucketFactor
+        self.seed = seed
+        self.epoch = 0
+        self.batches = None
+
+    # the batches depend only on seed and epoch, so an epoch can be recreated (e.g. to resume training)
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+        self.batches = None
+
+    def create_batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        if self.shuffle:
+            order = rng.permutation(len(self.lengths))
+            bucket_size = self.bucketFactor * self.batchSize
+        else:
+            order = np.arange(len(self.lengths))
+            bucket_size = len(self.lengths)
+
+        batches = list()
+        for start in range(0, len(order), max(bucket_size, 1)):
+            bucket = order[start:start + bucket_size]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind="stable")]
+            batches += self.split_bucket(bucket)
+
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def split_bucket(self, bucket):
+        return split_sorted(bucket, self.lengths, self.batchSize, self.maxTokens)
+
+    def __iter__(self):
+        if self.batches is None:
+            self.batches = self.create_batches()
+        return iter(self.batches)
+
+    def __len__(self):
+        if self.batches is None:
+            self.batches = self.create_batches()
+        return len(self.batches)
+
+
+# sampler which yields the texts in their original order in batches of batchSize
+class SequentialBatchSampler(Sampler):
+    def __init__(self, size: int, batchSize: int):
+        self.size = size
+        self.batchSize = batchSize
+
+    def set_epoch(self, epoch: int):
+        pass
+
+    def __iter__(self):
+        return (np.arange(i, min(i + self.batchSize, self.size)) for i in range(0, self.size, self.batchSize))
+
+    def __len__(self):
+        return (self.size + self.batchSize - 1) // self.batchSize
+
+
+# yields the batches of a batch sampler after the first skip batches, so an epoch can be resumed at a batch
+# (the batches of the samplers depend only on their seed and epoch)
+class SkipBatchSampler(Sampler):
+    def __init__(self, batchSampler, skip: int):
+        self.batchSampler = batchSampler
+        self.skip = skip
+
+    def set_epoch(self, epoch: int):
+        self.batchSampler.set_epoch(epoch)
+
+    def __iter__(self):
+        return itertools.islice(iter(self.batchSampler), self.skip, None)
+
+    def __len__(self):
+        return max(len(self.batchSampler) - self.skip, 0)
+
+
+# sampler for the inference, all texts are sorted by length so a batch holds texts of nearly the same length and is hardly padded.
+# The longest texts come first, so a too large token budget fails at the start. Use restore_order to get the original order back.
+class InferenceBatchSampler(Sampler):
+    def __init__(self, lengths, batchSize: int, maxTokens: int = None):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batches = split_sorted(np.argsort(self.lengths, kind="stable"), self.lengths, batchSize, maxTokens)[::-1]
+
+    def set_epoch(self, epoch: int):
+        pass
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
+# slices and pads a batch out of the token store, it adds either the target or the index of the texts.
+# For the binary classification (labelTokens given) every text is paired with all label sentences.
+# If bucketBoundaries are given the batch is padded to the next boundary, so only a few different shapes are created.
+class StoreCollator():
+    def __init__(self, store, pad_id: int, padding_side: str = "right", labelTokens= None, max_length: int = 512, target= None, index= None, bucketBoundaries: list = None):
+        self.store = store
+        self.pad_id = pad_id
+        self.padding_side = padding_side
+        self.labelTokens = labelTokens
+        self.max_length = max_length
+        self.target = target
+        self.index = np.asarray(index) if index is not None else None
+        self.bucketBoundaries = sorted(bucketBoundaries) if bucketBoundaries else None
+
+    def padded_length(self, length):
+        if self.bucketBoundaries:
+            for boundary in self.bucketBoundaries:
+                if boundary >= length:
+                    return min(boundary, self.max_length)
+        return min(length, self.max_length)
+
+    def __call__(self, indices):
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.store.offsets[indices + 1] - self.store.offsets[indices]
+        if self.labelTokens is not None:
+            label_ids, label_lengths = self.labelTokens
+            length = self.padded_length(int(lengths.max()) + int(label_lengths.max()))
+            data, mask = self.store.pad_label_pairs(indices, label_ids, label_lengths, self.pad_id, self.padding_side, self.max_length, length= length)
+        else:
+            data, mask = self.store.pad_batch(indices, self.pad_id, self.padding_side, length= self.padded_length(int(lengths.max())))
+        batch = (torch.from_numpy(data).long(), torch.from_numpy(mask).long())
+        if self.target is not None:
+            batch += (torch.tensor(self.target[indices], dtype=torch.int32),)
+        elif self.index is not None:
+            batch += (torch.tensor(self.index[indices], dtype=torch.long),)
+        return batch
+
+
+# map style dataset over the token store, it is indexed with the whole batch of indices coming from a batch sampler
+# (DataLoader with sampler= batch sampler and batch_size= None), so every worker creates complete padded batches
+class TokenStoreDataset(Dataset):
+    def __init__(self, collator: StoreCollator):
+        self.collator = collator
+
+    def __getitem__(self, indices):
+        return self.collator(indices)
+
+    def __len__(self):
+        return len(self.collator.store)
+
+
+# iterable dataset which streams the batches of a batch sampler, the batches are split between the dataloader workers.
+# Only the batch which is currently created is held in memory, the texts are read from the (memory mapped) store.
+class TokenStoreIterableDataset(IterableDataset):
+    def __init__(self, collator: StoreCollator, batchSampler):
+        self.collator = collator
+        self.batchSampler = batchSampler
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        for i, indices in enumerate(self.batchSampler):
+            if worker_info is None or i % worker_info.num_workers == worker_info.id:
+                yield self.collator(indices)
+
+    def __len__(self):
+        return len(self.batchSampler)
@@ -0,0 +1,299 @@
+from startup import ensure_nltk_data
+
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import subprocess
+
+import pandas as pd
+import numpy as np
+
+import torch
+
+# benchmark of the stages of the pipeline (Preprocessor.transform, Tokenizer.transform, Model.preprocess, applySmartBatching and
+# Model.predict) on synthetic AG News like data, so no download is needed. The transformer is a small randomly initialized
+# distilbert with a word piece vocabulary of the synthetic words, only its speed is measured. Every stage and size is run in its
+# own process, so the peak memory of a stage is not hidden by an earlier one. The results are written as json and can be compared
+# with the results of an earlier run (--baseline).
+#
+#   python benchmark.py --sizes 1000 10000 --output benchmark_results.json
+#   python benchmark.py --baseline benchmark_results.json --failOnRegression
+
+stages = ["preprocess", "tokenize", "tokenize_hash", "model_preprocess", "smart_batching", "predict"]
+
+# words of the synthetic news, every class has its own topic words, the common words and the names are shared
+topic_words = {
+    "world": "government president minister election war troops peace talks country capital border refugees embassy united nations parliament protest military attack ceasefire vote leader official crisis treaty".split(),
+    "sports": "team game season coach player match win victory championship league score goal cup final title injury quarterback tournament olympic race record fans stadium points".split(),
+    "business": "company shares stock market profit quarter sales prices oil investors billion million deal bank economy growth earnings percent rates merger revenue firm trade chief".split(),
+    "science": "software internet computer technology space research scientists users microsoft google network data online phone wireless system study nasa launch security web version digital".split(),
+}
+common_words = "the a of to and in on for with that is was it as at by from has have be will are after new its said says over more than first two year week monday tuesday wednesday thursday friday reuters ap".split()
+name_syllables = ["ka", "lo", "mi", "ra", "to", "ne", "sa", "vi", "de", "mo", "ri", "ta", "be", "no", "la", "zu"]
+names = [(a + b + c).capitalize() for a in name_syllables for b in name_syllables for c in name_syllables[:4]]
+
+
+# dataframe with a text column and one hot target columns like the AG News files, the texts have a title, a source and a
+# description (with a few html entities) and a length similar to the AG News texts
+def synthetic_agnews(size: int, targets: list, seed: int = 42):
+    rng = np.random.default_rng(seed)
+    classes = rng.integers(len(targets), size= size)
+    topics = list(topic_words.keys())
+    texts = list()
+    for label in classes:
+        # the topic of a target column is found by its name (e.g. science_int), other targets get the topics in order
+        topic = next((x for x in topics if x in targets[label]), topics[label % len(topics)])
+        words = list()
+        for length in [int(rng.integers(4, 12)), int(rng.lognormal(3.3, 0.35))]:
+            choice = rng.random(length)
+            part = np.where(choice < 0.35, rng.choice(topic_words[topic], length), np.where(choice < 0.9, rng.choice(common_words, length), rng.choice(names, length)))
+            words.append(" ".join(part))
+        source = "&lt;b&gt;" + rng.choice(names) + "&lt;/b&gt;" if rng.random() < 0.1 else rng.choice(["Reuters", "AP", "AFP"])
+        texts.append("{} ({}) - {}.".format(words[0].capitalize(), source, words[1].capitalize()))
+    target = np.eye(len(targets), dtype= int)[classes]
+    return pd.concat([pd.DataFrame({"text": texts}), pd.DataFrame(target, columns= targets)], axis= 1)
+
+# word piece vocabulary of all synthetic words, it is saved like a pretrained tokenizer so Tokenizer and Model can load it
+def save_vocabulary(path: str):
+    from transformers import DistilBertTokenizer
+    if os.path.exists(os.path.join(path, "vocab.txt")):
+        return path
+    os.makedirs(path, exist_ok= True)
+    words = sorted(set(w.lower() for w in common_words + names + [w for x in topic_words.values() for w in x] + ["article", "about"]))
+    with open(os.path.join(path, "vocab.txt"), "w") as f:
+        f.write("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"] + list(".,-()&;/<>") + words))
+    DistilBertTokenizer(os.path.join(path, "vocab.txt")).save_pretrained(path)
+    return path
+
+
+# current and peak resident memory of this process in MB. On linux the peak is reset before a stage (clear_refs),
+# elsewhere the peak of the whole process is reported. The memory of dataloader workers is not included
+def reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def memory_mb():
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(status["VmRSS"].split()[0]) / 1024, int(status["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB on linux
+        peak = peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+        return None, peak
+
+
+# preprocessor, tokenizers and model of the benchmark, created with the settings of the config
+class BenchmarkPipeline():
+    def __init__(self, args: dict, vocabulary: str, binary: bool, modelDim: int, modelLayers: int, device):
+        import main
+        from modeling import Model
+        from transformers import DistilBertConfig, DistilBertForSequenceClassification
+
+        self.args = args
+        self.targets = args["targets"]
+        self.device = device
+        self.preprocessor = main.create_preprocessor(args)
+        self.preprocessor.fit(None)
+
+        tokenizer_model = {"tokenizer": "distilbert", "model": "distilbert", "binaryClassification": binary, "optimizer": "adam"}
+        self.tokenizer = main.create_tokenizer(args, tokenizer_model)
+        self.tokenizer.pretrainedPath = vocabulary
+        self.tokenizer.fit(None)
+        self.hash_tokenizer = main.create_tokenizer(args, {"tokenizer": "bow_hash", "ngram": 2, "model": "naivebayes"})
+
+        labelSentences = {x: "The article is about {}.".format(x.split("_")[0]) for x in self.targets}
+        config = DistilBertConfig(vocab_size= self.tokenizer.pretrained.vocab_size, dim= modelDim, n_layers= modelLayers, n_heads= 2, hidden_dim= 4 * modelDim,
+                                  num_labels= 1 if binary else len(self.targets), torchscript= True)
+        self.model = Model(args= tokenizer_model, doLower= args["doLower"], train_batchSize= args["train_batchSize"], testval_batchSize= args["testval_batchSize"], learningRate= args["learningRate"], doLearningRateScheduler= False,
+                           labelSentences= labelSentences, smartBatching= True, max_label_len= max(len(x.split()) for x in labelSentences.values()), device= device, target_columns= self.targets, max_length= args["max_length"],
+                           maxTokens= args["smartBatching_maxTokens"], numWorkers= args["dataloader_numWorkers"], prefetchFactor= args["dataloader_prefetchFactor"], bucketBoundaries= args["dataloader_bucketBoundaries"],
+                           streamingDataLoader= args["dataloader_streaming"], foldLabelSentences= args["binary_foldLabelSentences"], maxForwardBatch= args["binary_maxForwardBatch"], inferenceMaxTokens= args["inference_maxTokens"],
+                           mixedPrecision= args["mixedPrecision"], model= DistilBertForSequenceClassification(config).to(device), tokenizer= self.tokenizer.pretrained, loadPretrained= False)
+
+    # share of the tokens of the batches which are not padding
+    @staticmethod
+    def padding_efficiency(dataloader):
+        tokens, padded = 0, 0
+        for batch in dataloader:
+            tokens += int(batch[1].sum())
+            padded += batch[1].numel()
+        return tokens / padded if padded else None
+
+
+# run one stage on size synthetic texts repeats times, the inputs of the stage are created before (not timed)
+def run_stage(stage: str, size: int, args: dict, vocabulary: str, repeats: int = 1, binary: bool = False, modelDim: int = 64, modelLayers: int = 2, seed: int = 42):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    torch.manual_seed(seed)
+    pipeline = BenchmarkPipeline(args, vocabulary, binary, modelDim, modelLayers, device)
+    df = synthetic_agnews(size, pipeline.targets, seed)
+    result = {"stage": stage, "size": size}
+
+    texts = df["text"]
+    if stage != "preprocess":
+        processed = pipeline.preprocessor.transform(texts)
+        valid = ~pd.isnull(processed)
+        texts, target = pd.Series(processed[valid]), df[pipeline.targets].values[valid]
+        result["num_texts"] = len(texts)
+    if stage == "tokenize_hash":
+        pipeline.hash_tokenizer.fit(texts)
+    if stage in ["model_preprocess", "smart_batching", "predict"]:
+        store = pipeline.tokenizer.transform(texts)
+        store.labels = target
+        result["mean_tokens"] = float(np.mean(store.lengths))
+    if stage in ["smart_batching", "predict"]:
+        store, _, target = pipeline.model.preprocess(store, target, pipeline.model.max_label_len, pipeline.targets)
+
+    def run():
+        if stage == "preprocess":
+            return pipeline.preprocessor.transform(texts)
+        elif stage == "tokenize":
+            return pipeline.tokenizer.transform(texts)
+        elif stage == "tokenize_hash":
+            return pipeline.hash_tokenizer.transform(texts)
+        elif stage == "model_preprocess":
+            # the label sentences are encoded again in every run
+            pipeline.model.labelTokens = None
+            return pipeline.model.preprocess(store, target, pipeline.model.max_label_len, pipeline.targets)
+        elif stage == "smart_batching":
+            return pipeline.padding_efficiency(pipeline.model.applySmartBatching(store, None, target, text= "Smart batching:", shuffle= True))
+        elif stage == "predict":
+            return pipeline.model.predict(store, device= device)
+        raise ValueError("unknown stage {}".format(stage))
+
+    rss_before, _ = memory_mb()
+    result["peak_rss_reset"] = reset_peak_rss()
+    times = list()
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        output = run()
+        times.append(time.perf_counter() - start_time)
+    rss_after, peak_rss = memory_mb()
+
+    # the fastest run is reported, the others are slowed down by the rest of the system
+    result["seconds"] = min(times)
+    result["rows_per_sec"] = len(texts) / result["seconds"]
+    result["rss_before_mb"], result["rss_after_mb"], result["peak_rss_mb"] = rss_before, rss_after, peak_rss
+    # memory used by the stage itself (the imports and the inputs are part of rss_before)
+    result["peak_rss_increase_mb"] = peak_rss - rss_before if rss_before is not None and result["peak_rss_reset"] else None
+    if stage == "smart_batching":
+        result["padding_efficiency"] = output
+        result["normal_padding_efficiency"] = pipeline.padding_efficiency(pipeline.model.applyNormalBatching(store, None, target, text= "Normal batching:"))
+    elif stage == "predict":
+        result["padding_efficiency"] = pipeline.padding_efficiency(pipeline.model.applyInferenceBatching(store, None, index= np.arange(len(store)), text= "Inference batching:"))
+    return result
+
+# run a stage in a new python process and return its result
+def run_worker(stage: str, size: int, cli_args):
+    command = [sys.executable, os.path.abspath(__file__), "--worker", stage, "--sizes", str(size), "--config", cli_args.config, "--workDir", cli_args.workDir,
+               "--repeats", str(cli_args.repeats), "--modelDim", str(cli_args.modelDim), "--modelLayers", str(cli_args.modelLayers), "--seed", str(cli_args.seed)]
+    if cli_args.binary:
+        command.append("--binary")
+    process = subprocess.run(command, stdout= subprocess.PIPE, stderr= subprocess.PIPE, universal_newlines= True)
+    if process.returncode != 0:
+        logging.error("stage {} with {} texts failed:\n{}".format(stage, size, process.stderr[-5000:]))
+        return {"stage": stage, "size": size, "error": process.stderr.strip().split("\n")[-1]}
+    # the result is the last line of the output, the lines before come from the stage itself
+    return json.loads(process.stdout.strip().split("\n")[-1])
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], stdout= subprocess.PIPE, stderr= subprocess.DEVNULL, universal_newlines= True, cwd= os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit or None, "python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "torch": torch.__version__, "numpy": np.__version__, "pandas": pd.__version__, "cuda": torch.cuda.is_available()}
+
+# compare the rows per second and the peak memory with the baseline, a stage is a regression if it is more than tolerance slower
+def compare(results: list, baseline: dict, tolerance: float = 0.1):
+    baseline_results = {(x["stage"], x["size"]): x for x in baseline["results"] if "error" not in x}
+    comparison = list()
+    for result in results:
+        base = baseline_results.get((result["stage"], result["size"]))
+        if base is None or "error" in result:
+            continue
+        speedup = result["rows_per_sec"] / base["rows_per_sec"]
+        comparison.append({"stage": result["stage"], "size": result["size"], "speedup": speedup, "peak_rss_ratio": result["peak_rss_mb"] / base["peak_rss_mb"] if base["peak_rss_mb"] else None,
+                           "regression": speedup < 1 - tolerance})
+    return comparison
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description= "Benchmark the stages of the pipeline on synthetic AG News data at different sizes.")
+    parser.add_argument("--stages", nargs= "+", default= stages, choices= stages)
+    parser.add_argument("--sizes", nargs= "+", type= int, default= [1000, 10000], help= "number of synthetic texts")
+    parser.add_argument("--config", default= "config.json", help= "config with the settings of the preprocessing, tokenization and batching")
+    parser.add_argument("--repeats", type= int, default= 3, help= "every stage is run repeats times, the fastest run is reported")
+    parser.add_argument("--binary", action= "store_true", help= "benchmark the binary classification (every text is paired with the label sentences)")
+    parser.add_argument("--modelDim", type= int, default= 64, help= "hidden size of the benchmark transformer")
+    parser.add_argument("--modelLayers", type= int, default= 2, help= "number of layers of the benchmark transformer")
+    parser.add_argument("--workDir", default= os.path.join("model", "benchmark"), help= "directory of the vocabulary of the benchmark transformer")
+    parser.add_argument("--output", default= "benchmark_results.json")
+    parser.add_argument("--baseline", default= None, help= "results of an earlier run which are compared with this run")
+    parser.add_argument("--tolerance", type= float, default= 0.1, help= "a stage which is more than tolerance slower than the baseline is a regression")
+    parser.add_argument("--failOnRegression", action= "store_true", help= "exit with an error if a stage is a regression")
+    parser.add_argument("--seed", type= int, default= 42)
+    parser.add_argument("--worker", default= None, help= argparse.SUPPRESS)
+    cli_args = parser.parse_args()
+
+    with open(cli_args.config) as f:
+        args = json.load(f)
+    vocabulary = os.path.join(cli_args.workDir, "vocabulary")
+
+    if cli_args.worker:
+        result = run_stage(cli_args.worker, cli_args.sizes[0], args, vocabulary, repeats= cli_args.repeats, binary= cli_args.binary,
+                           modelDim= cli_args.modelDim, modelLayers= cli_args.modelLayers, seed= cli_args.seed)
+        print(json.dumps(result))
+        sys.exit(0)
+
+    logging.basicConfig(level= logging.INFO)
+    ensure_nltk_data("punkt", "tokenizers/punkt")
+    save_vocabulary(vocabulary)
+
+    results = list()
+    for size in cli_args.sizes:
+        for stage in cli_args.stages:
+            result = run_worker(stage, size, cli_args)
+            results.append(result)
+            if "error" in result:
+                print("{:<18} {:>8} failed: {}".format(stage, size, result["error"]))
+            else:
+                padding = " padding {:.3f}".format(result["padding_efficiency"]) if result.get("padding_efficiency") else ""
+                increase = " (+{:.1f} MB)".format(result["peak_rss_increase_mb"]) if result["peak_rss_increase_mb"] is not None else ""
+                print("{:<18} {:>8} {:>12.1f} rows/s {:>9.1f} MB peak{}{}".format(stage, size, result["rows_per_sec"], result["peak_rss_mb"], increase, padding))
+
+    report = {"environment": environment(), "settings": {x: getattr(cli_args, x) for x in ["repeats", "binary", "modelDim", "modelLayers", "seed"]},
+              "config": {x: args[x] for x in ["doLower", "doLemmatization", "removeStopWords", "doBatchPreprocessing", "preprocessing_batchSize", "preprocessing_numWorkers", "fastTokenizer",
+                                              "tokenizer_batchSize", "tokenizer_numWorkers", "max_length", "train_batchSize", "testval_batchSize", "smartBatching_maxTokens", "inference_maxTokens",
+                                              "dataloader_numWorkers", "dataloader_bucketBoundaries", "dataloader_streaming", "mixedPrecision"]},
+              "results": results}
+
+    regressions = list()
+    if cli_args.baseline:
+        with open(cli_args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("settings") != report["settings"] or baseline.get("config") != report["config"]:
+            logging.warning("The baseline was run with other settings, the results are not comparable.")
+        report["baseline"] = {"file": cli_args.baseline, "environment": baseline.get("environment"), "comparison": compare(results, baseline, cli_args.tolerance)}
+        print("Compared with {} (commit {}):".format(cli_args.baseline, baseline.get("environment", {}).get("commit")))
+        for x in report["baseline"]["comparison"]:
+            print("{:<18} {:>8} {:>7.2f}x speed {:>7}x memory{}".format(x["stage"], x["size"], x["speedup"], "{:.2f}".format(x["peak_rss_ratio"]) if x["peak_rss_ratio"] else "-",
+                                                                        "  REGRESSION" if x["regression"] else ""))
+        regressions = [x for x in report["baseline"]["comparison"] if x["regression"]]
+
+    with open(cli_args.output, "w") as f:
+        json.dump(report, f, indent= 2)
+    print("Results are in {}".format(cli_args.output))
+    if regressions and cli_args.failOnRegression:
+        sys.exit("{} stages are slower than the baseline.".format(len(regressions)))
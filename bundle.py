@@ -0,0 +1,100 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+
+import pandas as pd
+import numpy as np
+
+from startup import get_device
+from preprocessing import Preprocessor
+from tokenization import Tokenizer
+from modeling import Model
+
+# inference bundle: a directory with everything which is needed to predict raw texts with a trained model. It holds the config of
+# the preprocessor, the fitted tokenizer (vectorizer, hashing state or the pretrained tokenizer with its vocabulary), the encoded
+# label sentences, the target columns with their decision thresholds and the model file. Loading a bundle does not fit anything.
+#
+#   <bundle>/bundle.json          version, configs, targets and thresholds
+#   <bundle>/tokenizer/           see Tokenizer.save
+#   <bundle>/label_tokens.npz     encoded label sentences of the binary classification
+#   <bundle>/model.pt (.onnx, .pkl)
+BUNDLE_VERSION = 1
+
+transformer_models = ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]
+
+
+class InferenceBundle():
+    def __init__(self, preprocessor: Preprocessor, tokenizer: Tokenizer, model: Model, thresholds: dict, meta: dict):
+        self.preprocessor = preprocessor
+        self.tokenizer = tokenizer
+        self.model = model
+        self.thresholds = thresholds
+        self.meta = meta
+        self.target_columns = model.target_columns
+
+    # probabilities of the targets for a list of texts, texts which are too short after the preprocessing get None
+    def predict(self, texts: list, device= "cpu"):
+        processed = self.preprocessor.transform(pd.Series(texts, dtype= object))
+        valid = np.flatnonzero(~pd.isnull(processed))
+        predictions = [None] * len(texts)
+        if len(valid) > 0:
+            output = self.model.predict(self.tokenizer.transform(pd.Series(processed[valid])), device= device)
+            for i, row in zip(valid, output.to_dict(orient= "records")):
+                predictions[i] = row
+        return predictions
+
+
+# save a trained model with its preprocessing and tokenization, thresholds defaults to 0.5 for every target.
+# With quantize or onnx the int8 or the onnx version of a transformer model is saved. Returns the path of the bundle
+def save_bundle(path: str, tokenizer_model: dict, preprocessor_config: dict, tokenizer: Tokenizer, model: Model, thresholds: dict = None, quantize: bool = False, onnx: bool = False):
+    thresholds = thresholds if thresholds else dict(zip(model.target_columns, [0.5] * len(model.target_columns)))
+    if not set(model.target_columns).issubset(set(thresholds.keys())):
+        logging.error("The thresholds need a value for every target column.")
+        sys.exit("The thresholds need a value for every target column.")
+    # files of an older bundle would be mixed with the new ones
+    if os.path.exists(os.path.join(path, "bundle.json")):
+        logging.warning("The bundle {} is replaced.".format(path))
+        shutil.rmtree(path)
+    os.makedirs(path, exist_ok= True)
+
+    tokenizer.save(os.path.join(path, "tokenizer"))
+    model_file = model.save(os.path.join(path, "model"), quantize= quantize, onnx= onnx)
+    if tokenizer_model["model"] in transformer_models and tokenizer_model["binaryClassification"]:
+        label_ids, label_lengths = model.encodeLabelSentences(model.target_columns)
+        np.savez(os.path.join(path, "label_tokens.npz"), label_ids= label_ids, label_lengths= label_lengths)
+
+    meta = {"version": BUNDLE_VERSION, "created": time.strftime("%Y-%m-%dT%H:%M:%S"), "tokenizer_model": tokenizer_model, "preprocessor": preprocessor_config,
+            "model": {"file": os.path.basename(model_file), "doLower": model.doLower, "max_length": model.max_length, "max_label_len": model.max_label_len,
+                      "labelSentences": model.labelSentences, "target_columns": list(model.target_columns)},
+            "thresholds": {x: thresholds[x] for x in model.target_columns}}
+    with open(os.path.join(path, "bundle.json"), "w") as f:
+        json.dump(meta, f, indent= 2)
+    return path
+
+# load a bundle of save_bundle, the other arguments of Model (e.g. inferenceMaxTokens) are given with modelArgs. Without device
+# the model of the bundle decides it, see get_device
+def load_bundle(path: str, device= None, batchSize: int = 64, **modelArgs):
+    with open(os.path.join(path, "bundle.json")) as f:
+        meta = json.load(f)
+    if meta["version"] > BUNDLE_VERSION:
+        logging.error("The bundle {} has version {}, only versions up to {} can be loaded.".format(path, meta["version"], BUNDLE_VERSION))
+        sys.exit("The bundle {} has version {}, only versions up to {} can be loaded.".format(path, meta["version"], BUNDLE_VERSION))
+
+    # the texts of a prediction are preprocessed in the process, a worker pool per request costs more than it saves
+    device = device if device else get_device(meta["tokenizer_model"]["model"])
+    preprocessor = Preprocessor(**dict(meta["preprocessor"], numWorkers= 1))
+    preprocessor.fit(None)
+    tokenizer = Tokenizer.load(os.path.join(path, "tokenizer"))
+
+    config = meta["model"]
+    model = Model(args= meta["tokenizer_model"], doLower= config["doLower"], train_batchSize= batchSize, testval_batchSize= batchSize, learningRate= 0, doLearningRateScheduler= False,
+                  target_columns= config["target_columns"], smartBatching= False, mixedPrecision= False, labelSentences= config["labelSentences"], max_label_len= config["max_label_len"],
+                  tokenizer= tokenizer.pretrained, device= device, max_length= config["max_length"], loadPretrained= False, **modelArgs)
+    model.load(os.path.join(path, config["file"]))
+    if os.path.exists(os.path.join(path, "label_tokens.npz")):
+        label_tokens = np.load(os.path.join(path, "label_tokens.npz"))
+        model.labelTokens, model.labelTokenColumns = (label_tokens["label_ids"], label_tokens["label_lengths"]), list(config["target_columns"])
+    return InferenceBundle(preprocessor, tokenizer, model, meta["thresholds"], meta)
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import shutil
+import pickle
+import hashlib
+import logging
+
+import numpy as np
+from scipy import sparse
+
+from tokenstore import TokenStore
+
+
+# hash the content of a file, the result is memorized as long as size and modification time do not change
+file_hashes = dict()
+def hash_file(path, block_size= 1 << 20):
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if memo_key not in file_hashes:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(block_size), b""):
+                sha.update(block)
+        file_hashes[memo_key] = sha.hexdigest()
+    return file_hashes[memo_key]
+
+# the code version of a stage is the hash of the source files which create its artifacts
+def hash_source(*file_names):
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    return hashlib.sha256("".join(hash_file(os.path.join(code_dir, x)) for x in file_names).encode()).hexdigest()
+
+
+# content addressed cache for the artifacts (preprocessed and tokenized data) of the different stages
+# every entry is a directory named by the key which holds the arrays and a manifest.json
+class ArtifactCache():
+    def __init__(self, cache_dir: str, maxSizeGB: float = None):
+        self.cache_dir = cache_dir
+        self.maxSize = maxSizeGB * 1024 ** 3 if maxSizeGB else None
+        os.makedirs(self.cache_dir, exist_ok= True)
+
+    # build the key out of everything the artifacts of a stage depend on
+    def key(self, stage: str, **parts):
+        description = json.dumps({"stage": stage, **parts}, sort_keys= True, default= str)
+        return "{}_{}".format(stage, hashlib.sha256(description.encode()).hexdigest()[:32])
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def exists(self, key):
+        return os.path.exists(os.path.join(self.entry_path(key), "manifest.json"))
+
+    def load(self, key):
+        entry = self.entry_path(key)
+        with open(os.path.join(entry, "manifest.json")) as f:
+            manifest = json.load(f)
+        artifacts = dict()
+        for name, info in manifest["artifacts"].items():
+            file_path = os.path.join(entry, info["file"])
+            if info["type"] == "sparse":
+                artifacts[name] = sparse.load_npz(file_path)
+            elif info["type"] == "csr":
+                # the arrays are memory mapped, slicing rows only reads the rows which are needed
+                parts = [np.load(os.path.join(file_path, x + ".npy"), mmap_mode= "r") for x in ["data", "indices", "indptr"]]
+                artifacts[name] = sparse.csr_matrix(tuple(parts), shape= tuple(info["shape"]), copy= False)
+            elif info["type"] == "tokenstore":
+                artifacts[name] = TokenStore.load(file_path)
+            elif info["type"] == "pickle":
+                with open(file_path, "rb") as f:
+                    artifacts[name] = pickle.load(f)
+            else:
+                artifacts[name] = np.load(file_path, allow_pickle= True)
+        # the modification time of the manifest is used as last access time for the lru eviction
+        os.utime(os.path.join(entry, "manifest.json"))
+        return artifacts
+
+    def save(self, key, artifacts: dict, description: dict = None):
+        entry = self.entry_path(key)
+        # write into a temporary directory first, so other processes never see a half written entry
+        temp_entry = "{}.tmp-{}".format(entry, os.getpid())
+        os.makedirs(temp_entry, exist_ok= True)
+        manifest = {"key": key, "created": time.time(), "description": description, "artifacts": dict()}
+        for name, value in artifacts.items():
+            if sparse.issparse(value):
+                # sparse matrices are stored as uncompressed csr arrays, so they can be memory mapped
+                value = value.tocsr()
+                os.makedirs(os.path.join(temp_entry, name))
+                for part in ["data", "indices", "indptr"]:
+                    np.save(os.path.join(temp_entry, name, part + ".npy"), getattr(value, part))
+                manifest["artifacts"][name] = {"file": name, "type": "csr", "shape": list(value.shape), "dtype": str(value.dtype)}
+            elif isinstance(value, TokenStore):
+                value.save(os.path.join(temp_entry, name))
+                manifest["artifacts"][name] = {"file": name, "type": "tokenstore", "num_texts": len(value)}
+            elif isinstance(value, dict):
+                # fitted state (e.g. of the tokenizer) which is not an array
+                file_name = name + ".pkl"
+                with open(os.path.join(temp_entry, file_name), "wb") as f:
+                    pickle.dump(value, f)
+                manifest["artifacts"][name] = {"file": file_name, "type": "pickle"}
+            else:
+                value = np.asarray(value)
+                file_name = name + ".npy"
+                np.save(os.path.join(temp_entry, file_name), value, allow_pickle= True)
+                manifest["artifacts"][name] = {"file": file_name, "type": "array", "shape": list(value.shape), "dtype": str(value.dtype)}
+        manifest["size"] = self.get_size(temp_entry)
+        with open(os.path.join(temp_entry, "manifest.json"), "w") as f:
+            json.dump(manifest, f, indent= 2, default= str)
+
+        if os.path.exists(entry):
+            # another process created the same entry in the meantime, its content is identical
+            shutil.rmtree(temp_entry, ignore_errors= True)
+        else:
+            try:
+                os.rename(temp_entry, entry)
+            except OSError:
+                shutil.rmtree(temp_entry, ignore_errors= True)
+        self.evict(keep= key)
+
+    @staticmethod
+    def get_size(path):
+        size = 0
+        for root, _, files in os.walk(path):
+            for file in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, file))
+                except OSError:
+                    pass
+        return size
+
+    # remove the least recently used entries until the cache is smaller than maxSize
+    def evict(self, keep= None):
+        if not self.maxSize:
+            return
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            manifest_path = os.path.join(self.cache_dir, name, "manifest.json")
+            try:
+                with open(manifest_path) as f:
+                    size = json.load(f)["size"]
+                entries.append((os.path.getmtime(manifest_path), size, name))
+            except (OSError, ValueError, KeyError):
+                continue
+        total_size = sum(x[1] for x in entries)
+        for _, size, name in sorted(entries):
+            if total_size <= self.maxSize:
+                break
+            if name == keep:
+                continue
+            logging.info("evict {} from the artifact cache".format(name))
+            shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors= True)
+            total_size -= size
@@ -0,0 +1,125 @@
+import os
+import sys
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+
+# hash of the fasttext dictionary (32 bit FNV-1a over the signed bytes of the utf-8 encoded string)
+def fnv1a(data: bytes):
+    h = 2166136261
+    for byte in data:
+        h = (h ^ ((byte - 256 if byte > 127 else byte) & 0xffffffff)) & 0xffffffff
+        h = (h * 16777619) & 0xffffffff
+    return h
+
+# character n-grams of "<word>" with minn to maxn characters as fasttext creates them, the single "<" and ">" are no n-grams
+def char_ngrams(word: str, minn: int, maxn: int):
+    chars = list("<" + word + ">")
+    ngrams = list()
+    for i in range(len(chars)):
+        for n in range(1, maxn + 1):
+            if i + n > len(chars):
+                break
+            if n >= minn and not (n == 1 and (i == 0 or i + n == len(chars))):
+                ngrams.append("".join(chars[i:i + n]))
+    return ngrams
+
+
+# fasttext word vectors which are read from a converted directory with np.load(mmap_mode="r"), so the vectors are shared between
+# all processes on a host via the page cache. The vectors of the converted vocabulary are stored as they are, the vectors of
+# other words are created out of the subword n-gram table (as fasttext does for out of vocabulary words).
+class MmapFastText():
+    version = 1
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != self.version:
+            raise ValueError("Converted fasttext version {} can not be read, expected version {}.".format(self.meta["version"], self.version))
+        with open(os.path.join(path, "words.json"), encoding= "utf-8") as f:
+            self.word_index = {w: i for i, w in enumerate(json.load(f))}
+        self.word_vectors = np.load(os.path.join(path, "word_vectors.npy"), mmap_mode= "r")
+        self.buckets = np.load(os.path.join(path, "buckets.npy"), mmap_mode= "r") if self.meta["maxn"] > 0 else None
+        self.path = path
+
+    @classmethod
+    def load(cls, path: str):
+        return cls(path)
+
+    def get_dimension(self):
+        return self.meta["dim"]
+
+    def get_word_vector(self, word: str):
+        if word in self.word_index:
+            return np.asarray(self.word_vectors[self.word_index[word]], dtype= np.float32)
+        if self.buckets is None:
+            return np.zeros(self.meta["dim"], dtype= np.float32)
+        rows = [fnv1a(x.encode("utf-8")) % self.meta["bucket"] for x in char_ngrams(word, self.meta["minn"], self.meta["maxn"])]
+        if not rows:
+            return np.zeros(self.meta["dim"], dtype= np.float32)
+        # the rows are sorted so the memory mapped table is read in order
+        return np.asarray(self.buckets[np.sort(rows)], dtype= np.float32).mean(axis= 0)
+
+
+# words of the texts as they are split by the fasttext featurizer, in their original and lower case
+def corpus_words(texts, batchSize: int = 10000):
+    from tokenization import tokenize_words
+    texts = list(texts)
+    words = set()
+    for start in tqdm(range(0, len(texts), batchSize), desc= "Collect words"):
+        for document in tokenize_words(texts[start:start + batchSize]):
+            words.update(document)
+    return words | {w.lower() for w in words}
+
+# convert a fasttext .bin model into a directory with the vectors of the given words and the subword n-gram table
+def convert(model_file: str, output_path: str, words: set, dtype: str = "float16", topWords: int = 0, chunkSize: int = 100000):
+    import fasttext
+    model = fasttext.load_model(model_file)
+    model_args = model.f.getArgs()
+    model_words = model.get_words()
+    # the most frequent words of the model are added, so texts which were not part of the conversion are covered as well
+    words = sorted(set(words) | set(model_words[:topWords]))
+
+    os.makedirs(output_path, exist_ok= True)
+    word_vectors = np.lib.format.open_memmap(os.path.join(output_path, "word_vectors.npy"), mode= "w+", dtype= dtype, shape= (len(words), model.get_dimension()))
+    for i, word in enumerate(tqdm(words, desc= "Convert word vectors")):
+        word_vectors[i] = model.get_word_vector(word)
+    word_vectors.flush()
+
+    if model_args.maxn > 0:
+        # the rows after the words of the input matrix are the hashed n-gram buckets
+        input_matrix = model.get_input_matrix()
+        buckets = np.lib.format.open_memmap(os.path.join(output_path, "buckets.npy"), mode= "w+", dtype= dtype, shape= (model_args.bucket, model.get_dimension()))
+        for start in tqdm(range(0, model_args.bucket, chunkSize), desc= "Convert n-gram buckets"):
+            end = min(start + chunkSize, model_args.bucket)
+            buckets[start:end] = input_matrix[len(model_words) + start:len(model_words) + end]
+        buckets.flush()
+
+    with open(os.path.join(output_path, "words.json"), "w", encoding= "utf-8") as f:
+        json.dump(words, f, ensure_ascii= False)
+    with open(os.path.join(output_path, "meta.json"), "w") as f:
+        json.dump({"format": "fasttext_mmap", "version": MmapFastText.version, "source": os.path.abspath(model_file), "dim": model.get_dimension(), "dtype": dtype,
+                   "num_words": len(words), "minn": model_args.minn, "maxn": model_args.maxn, "bucket": model_args.bucket}, f, indent= 2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description= "Convert a fasttext .bin model into memory mappable vectors for the fasttext tokenizers.")
+    parser.add_argument("--model", required= True, help= "fasttext .bin model, e.g. ./support/cc.en.300.bin")
+    parser.add_argument("--output", required= True, help= "output directory, use it as fasttext_file in the config.json")
+    parser.add_argument("--texts", nargs= "*", default= [], help= "csv files with the texts whose words are converted")
+    parser.add_argument("--column", default= "text", help= "column of the texts in the csv files")
+    parser.add_argument("--topWords", type= int, default= 100000, help= "number of the most frequent words of the model which are converted as well")
+    parser.add_argument("--dtype", default= "float16", choices= ["float16", "float32"])
+    args = parser.parse_args()
+
+    words = set()
+    for file in args.texts:
+        texts = pd.read_csv(file, usecols= [args.column])[args.column].dropna()
+        words |= corpus_words(texts)
+    if not words and not args.topWords:
+        sys.exit("Give the texts or a number of topWords to convert.")
+    convert(args.model, args.output, words, dtype= args.dtype, topWords= args.topWords)
@@ -1,5 +1,6 @@
+from startup import import_timer, ensure_nltk_data, startup_report, get_device
+
 import json
-import wandb
 import logging
 import os
 import sys
@@ -7,24 +8,24 @@ import random
 
 import pandas as pd
 import numpy as np
-from scipy import sparse
 
 from sklearn.model_selection import train_test_split
 
-import torch
-from torch import optim
+import tracking
 
-from preprocessing import Preprocessor
-from tokenization import Tokenizer
+# the heavy dependencies of the configured tokenizer and model are imported when they are created
+with import_timer("preprocessing"):
+    from preprocessing import Preprocessor
+with import_timer("tokenization"):
+    from tokenization import Tokenizer
 
-from modeling import Model
+with import_timer("modeling"):
+    from modeling import Model
+from caching import ArtifactCache, hash_file, hash_source
+from bundle import save_bundle
+from tokenstore import TokenStore
 
 from nltk import word_tokenize
-import nltk
-nltk.download('punkt')
-
-import subprocess
-subprocess.check_call([sys.executable, "-m", "pip", "install", "SentencePiece"])
 
 # implementation of a dataloader which can handle multiple file types
 def pd_load_multiple_files(path):
@@ -39,24 +40,9 @@ def pd_load_multiple_files(path):
         sys.exit("{} datatype not supported.".format(path))
 
 
-if __name__ == "__main__":
-    # get all the configuration details from the config.json file
-    with open(r"config.json") as f:
-        args = json.load(f)
-
-    # initalize wandb to have online login and be able to run sweeps
-    wandb.init(project= "NewsClassification", entity='faruman', config=args)
-    args = wandb.config
-    wandb.log({'finished': False})
-
-    random.seed(42)
-    np.random.seed(42)
-    torch.manual_seed(42)
-
-    # define on which device to run
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-    tokenizer_model = json.loads(args["tokenizer_model"].replace("'", '"'))
+# the tokenizer_model of the config is a string of a dict (as the sweeps need it), "True" and "False" are converted to booleans
+def parse_tokenizer_model(tokenizer_model: str):
+    tokenizer_model = json.loads(tokenizer_model.replace("'", '"'))
     for dict_elements in tokenizer_model.keys():
         if tokenizer_model[dict_elements] == "True":
             tokenizer_model[dict_elements] = True
@@ -64,181 +50,221 @@ if __name__ == "__main__":
             tokenizer_model[dict_elements] = False
         else:
             pass
-
-    logging.info("training will be done on {}", device)
-
-    # do the data loading
-    ## check for already preprocessed files
-    train_pre_path = os.path.join(args["data_path"], "temp", "{}_prep_train_{}-{}-{}-{}-{}-{}".format(args["train_data_file"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
-    val_pre_path = os.path.join(args["data_path"], "temp", "{}_prep_val_{}-{}-{}-{}-{}-{}".format(args["train_data_file"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
+    return tokenizer_model
+
+# the artifacts of every stage are cached under a key which hashes the input files, the config of the stage and the code version.
+# Returns the keys and descriptions of the preprocessing and the tokenization stage
+def artifact_keys(args, tokenizer_model: dict, cache: ArtifactCache):
+    input_files = [os.path.join(args["data_path"], args[x]) for x in ["train_data_file", "train_target_file", "test_data_file", "test_target_file"] if args[x]]
+    preprocessing_config = {x: args[x] for x in ["train_data_drop", "train_merge_on", "test_data_drop", "test_merge_on", "targets", "validation_split", "test_split", "data_used",
+                                                 "doLower", "doLemmatization", "removeStopWords", "removeNewLine", "removePunctuation", "minTextLength"]}
+    pre_key = cache.key("preprocessing", files= {os.path.basename(x): hash_file(x) for x in input_files}, config= preprocessing_config, code= hash_source("main.py", "preprocessing.py"))
+    ## the fasttext model is too large to be hashed, its size and modification time are used instead
+    ## for converted vectors (a directory) the meta.json is used
+    fasttext_meta = os.path.join(args["fasttext_file"], "meta.json") if os.path.isdir(args["fasttext_file"]) else args["fasttext_file"]
+    fasttext_stat = os.stat(fasttext_meta) if "fasttext" in tokenizer_model["tokenizer"] else None
+    tokenization_config = {"tokenizer": {x: tokenizer_model[x] for x in ["tokenizer", "ngram", "n_features"] if x in tokenizer_model.keys()}, "doLower": args["doLower"], "fastTokenizer": args["fastTokenizer"],
+                           "max_length": args["max_length"], "fasttext_file": (args["fasttext_file"], fasttext_stat.st_size, fasttext_stat.st_mtime) if fasttext_stat else None}
+    tok_key = cache.key("tokenization", preprocessing= pre_key, config= tokenization_config, code= hash_source("tokenization.py"))
+    return {"preprocessing": pre_key, "tokenization": tok_key, "input_files": input_files, "preprocessing_config": preprocessing_config, "tokenization_config": tokenization_config}
+
+# the html entities are never removed (removeHtmlTags of the config is not used), so removeHtmlTags is not part of the preprocessing key
+def create_preprocessor(args):
+    return Preprocessor(doLower= args["doLower"], doLemmatization= args["doLemmatization"], removeStopWords= args["removeStopWords"], doSpellingCorrection= False, removeNewLine= args["removeNewLine"], removePunctuation=args["removePunctuation"], removeHtmlTags= False, minTextLength = args["minTextLength"], doBatchProcessing= args["doBatchPreprocessing"], batchSize= args["preprocessing_batchSize"], numWorkers= args["preprocessing_numWorkers"])
+
+def create_tokenizer(args, tokenizer_model: dict):
+    return Tokenizer(args= tokenizer_model, fasttextFile= args["fasttext_file"], doLower= args["doLower"], max_length= args["max_length"], useFastTokenizer= args["fastTokenizer"], batchSize= args["tokenizer_batchSize"], numWorkers= args["tokenizer_numWorkers"])
+
+# load the data files, split them into train, validation and test data and preprocess the texts
+def preprocess_data(args):
+    ## create the train data
+    train_df = pd_load_multiple_files(os.path.join(args["data_path"], args["train_data_file"]))
+    train_df = train_df.drop(args["train_data_drop"], axis= 1)
+    train_df = train_df.sample(int(train_df.shape[0] * args["data_used"]))
+    if args["train_target_file"] and args["train_merge_on"]:
+        train_target = pd_load_multiple_files(os.path.join(args["data_path"], args["train_target_file"]))
+        train_target = train_target.loc[:, args["targets"] + [args["train_merge_on"][1]]]
+        train_df = pd.merge(train_df, train_target, how="left", left_on=args["train_merge_on"][0], right_on=args["train_merge_on"][1])
+        train_df = train_df.drop([args["train_merge_on"][0]], axis= 1)
+    if not train_df.shape[1] == len(args["targets"]) +1:
+        logging.error("train_df has too many columns, check your files.")
+        sys.exit("train_df has too many columns, check your files.")
+
+    ## create the test data
     if args["test_data_file"]:
-        test_pre_path = os.path.join(args["data_path"], "temp", "{}_prep_test_{}-{}-{}-{}-{}-{}".format(args["test_data_file"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
+        test_df = pd_load_multiple_files(os.path.join(args["data_path"], args["test_data_file"]))
+        test_df = test_df.drop(args["test_data_drop"], axis=1)
+        if args["test_target_file"] and args["test_merge_on"]:
+            test_target = pd_load_multiple_files(os.path.join(args["data_path"], args["test_target_file"]))
+            test_target = test_target.loc[:, args["targets"] + [args["test_merge_on"][1]]]
+            test_df = pd.merge(test_df,  test_target, how="left", left_on=args["test_merge_on"][0], right_on=args["test_merge_on"][1])
+            test_df =  test_df.drop([args["test_merge_on"][0]], axis=1)
+        if not train_df.shape[1] == len(args["targets"]) + 1:
+            logging.error("test_df has too many columns, check your files.")
+            sys.exit("test_df has too many columns, check your files.")
     else:
-        test_pre_path = os.path.join(args["data_path"], "temp", "{}_prep_test_{}-{}-{}-{}-{}-{}".format(args["train_data_file"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
-    ## check for already tokenized files
-    if "ngram" in tokenizer_model.keys():
-        train_tok_path = os.path.join(args["data_path"], "temp", "{}_tok_train_{}-{}-{}-{}-{}-{}-{}-{}".format(args["train_data_file"], tokenizer_model["tokenizer"], tokenizer_model["ngram"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
-        val_tok_path = os.path.join(args["data_path"], "temp", "{}_tok_val_{}-{}-{}-{}-{}-{}-{}_{}".format(args["train_data_file"], tokenizer_model["tokenizer"], tokenizer_model["ngram"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
-        if args["test_data_file"]:
-            test_tok_path = os.path.join(args["data_path"], "temp", "{}_tok_test_{}-{}-{}-{}-{}-{}-{}-{}".format(args["test_data_file"], tokenizer_model["tokenizer"], tokenizer_model["ngram"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
-        else:
-            test_tok_path = os.path.join(args["data_path"], "temp", "{}_tok_test_{}-{}-{}-{}-{}-{}-{}-{}".format(args["train_data_file"], tokenizer_model["tokenizer"], tokenizer_model["ngram"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
-    else:
-        train_tok_path = os.path.join(args["data_path"], "temp", "{}_tok_train_{}-{}-{}-{}-{}-{}-{}".format(args["train_data_file"], tokenizer_model["tokenizer"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
-        val_tok_path = os.path.join(args["data_path"], "temp", "{}_tok_val_{}-{}-{}-{}-{}-{}-{}".format(args["train_data_file"], tokenizer_model["tokenizer"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
-        if args["test_data_file"]:
-            test_tok_path = os.path.join(args["data_path"], "temp", "{}_tok_test_{}-{}-{}-{}-{}-{}-{}".format(args["test_data_file"], tokenizer_model["tokenizer"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
-        else:
-            test_tok_path = os.path.join(args["data_path"], "temp", "{}_tok_test_{}-{}-{}-{}-{}-{}-{}".format(args["train_data_file"], tokenizer_model["tokenizer"], args["doLower"], args["doLemmatization"], args["removeStopWords"], args["removeNewLine"], args["removePunctuation"], args["data_used"]) + "_{}")
-
-    # TODO: Implement Whoosh Index for file storage store metadata with idx
-    # TODO: Implement paraallel processing with pandarallel or dask
+        train_df, test_df = train_test_split(train_df, test_size= args["test_split"], random_state= 42)
 
-    ## reload data if existent
-    run_preprocessing = False
-    run_tokenization = False
-
-    if (os.path.exists(train_tok_path.format("data") + ".npy") and os.path.exists(train_tok_path.format("target") + ".npy") and os.path.exists(val_tok_path.format("data") + ".npy") and os.path.exists(val_tok_path.format("target") + ".npy") and os.path.exists(test_tok_path.format("data") + ".npy") and os.path.exists(test_tok_path.format("target") + ".npy")) or (os.path.exists(train_tok_path.format("data") + ".npz") and os.path.exists(train_tok_path.format("target") + ".npy") and os.path.exists(val_tok_path.format("data") + ".npz") and os.path.exists(val_tok_path.format("target") + ".npy") and os.path.exists(test_tok_path.format("data") + ".npz") and os.path.exists(test_tok_path.format("target") + ".npy")):
-        if "bow-" in train_tok_path or "tfidf-" in train_tok_path:
-            train_data = sparse.load_npz(train_tok_path.format("data") + ".npz")
-        else:
-            train_data = np.load(train_tok_path.format("data") + ".npy", allow_pickle=True)
-        train_target = np.load(train_tok_path.format("target") + ".npy", allow_pickle=True)
-        if "bow-" in val_tok_path or "tfidf-" in val_tok_path:
-            val_data = sparse.load_npz(val_tok_path.format("data") + ".npz")
-        else:
-            val_data = np.load(val_tok_path.format("data") + ".npy", allow_pickle=True)
-        val_target = np.load(val_tok_path.format("target") + ".npy", allow_pickle=True)
-        if "bow-" in test_tok_path or "tfidf-" in test_tok_path:
-            test_data = sparse.load_npz(test_tok_path.format("data") + ".npz")
-        else:
-            test_data = np.load(test_tok_path.format("data") + ".npy", allow_pickle=True)
-        test_target = np.load(test_tok_path.format("target") + ".npy", allow_pickle=True)
-    elif os.path.exists(train_pre_path.format("data") + ".npy") and os.path.exists(train_pre_path.format("target") + ".npy") and os.path.exists(val_pre_path.format("data") + ".npy") and os.path.exists(val_pre_path.format("target") + ".npy") and os.path.exists(test_pre_path.format("data") + ".npy") and os.path.exists(test_pre_path.format("target") + ".npy"):
-        train_data = np.load(train_pre_path.format("data") + ".npy", allow_pickle=True)
-        val_data = np.load(val_pre_path.format("data") + ".npy", allow_pickle=True)
-        test_data = np.load(test_pre_path.format("data") + ".npy", allow_pickle=True)
-        train_target = np.load(train_pre_path.format("target") + ".npy", allow_pickle=True)
-        val_target = np.load(val_pre_path.format("target") + ".npy", allow_pickle=True)
-        test_target = np.load(test_pre_path.format("target") + ".npy", allow_pickle=True)
-        run_tokenization = True
+    ## create the validation data
+    if args["validation_split"]:
+        train_df, val_df = train_test_split(train_df, test_size=args["validation_split"], random_state=42)
     else:
-        run_preprocessing = True
-        run_tokenization = True
-
-    if run_preprocessing:
-        ## create the train data
-        train_df = pd_load_multiple_files(os.path.join(args["data_path"], args["train_data_file"]))
-        train_df = train_df.drop(args["train_data_drop"], axis= 1)
-        train_df = train_df.sample(int(train_df.shape[0] * args["data_used"]))
-        if args["train_target_file"] and args["train_merge_on"]:
-            train_target = pd_load_multiple_files(os.path.join(args["data_path"], args["train_target_file"]))
-            train_target = train_target.loc[:, args["targets"] + [args["train_merge_on"][1]]]
-            train_df = pd.merge(train_df, train_target, how="left", left_on=args["train_merge_on"][0], right_on=args["train_merge_on"][1])
-            train_df = train_df.drop([args["train_merge_on"][0]], axis= 1)
-        if not train_df.shape[1] == len(args["targets"]) +1:
-            logging.error("train_df has too many columns, check your files.")
-            sys.exit("train_df has too many columns, check your files.")
-
-        ## create the test data
-        if args["test_data_file"]:
-            test_df = pd_load_multiple_files(os.path.join(args["data_path"], args["test_data_file"]))
-            test_df = test_df.drop(args["test_data_drop"], axis=1)
-            if args["test_target_file"] and args["test_merge_on"]:
-                test_target = pd_load_multiple_files(os.path.join(args["data_path"], args["test_target_file"]))
-                test_target = test_target.loc[:, args["targets"] + [args["test_merge_on"][1]]]
-                test_df = pd.merge(test_df,  test_target, how="left", left_on=args["test_merge_on"][0], right_on=args["test_merge_on"][1])
-                test_df =  test_df.drop([args["test_merge_on"][0]], axis=1)
-            if not train_df.shape[1] == len(args["targets"]) + 1:
-                logging.error("test_df has too many columns, check your files.")
-                sys.exit("test_df has too many columns, check your files.")
+        logging.error("vaidation_split needs to be given.")
+        sys.exit("vaidation_split needs to be given.")
+
+    ## get data columns
+    data_column = list(set(train_df.columns) - set(args["targets"]))[0]
+    train_target = train_df[args["targets"]].values
+    val_target = val_df[args["targets"]].values
+    test_target = test_df[args["targets"]].values
+
+    ## do the preprocessing
+    print("Preprocess")
+    preprocessor = create_preprocessor(args)
+    train_data = preprocessor.fit_transform(train_df[data_column])
+    train_target = train_target[~pd.isnull(train_data)]
+    train_data = train_data[~pd.isnull(train_data)]
+    val_data = preprocessor.transform(val_df[data_column])
+    val_target = val_target[~pd.isnull(val_data)]
+    val_data = val_data[~pd.isnull(val_data)]
+    test_data = preprocessor.transform(test_df[data_column])
+    test_target = test_target[~pd.isnull(test_data)]
+    test_data = test_data[~pd.isnull(test_data)]
+    return {"train_data": train_data, "val_data": val_data, "test_data": test_data, "train_target": train_target, "val_target": val_target, "test_target": test_target}
+
+# fit the tokenizer on the preprocessed train data and transform all data
+def tokenize_data(args, tokenizer_model: dict, preprocessed: dict):
+    print("Tokenize")
+    tokenizer = create_tokenizer(args, tokenizer_model)
+    train_data = tokenizer.fit_transform(preprocessed["train_data"])
+    val_data = tokenizer.transform(preprocessed["val_data"])
+    test_data = tokenizer.transform(preprocessed["test_data"])
+    if isinstance(train_data, TokenStore):
+        # keep the label matrix next to the token ids
+        train_data.labels, val_data.labels, test_data.labels = preprocessed["train_target"], preprocessed["val_target"], preprocessed["test_target"]
+    # the fitted state of the tokenizer is kept with the data, so the inference bundle can be saved without fitting again
+    return {"train_data": train_data, "val_data": val_data, "test_data": test_data,
+            "train_target": preprocessed["train_target"], "val_target": preprocessed["val_target"], "test_target": preprocessed["test_target"], "tokenizer_state": tokenizer.get_state()}
+
+# get the tokenized train, validation and test data. Every stage is taken from memory (a dict which is shared between the runs
+# of one process, e.g. by sweep.py), from the cache on disk or is computed and saved.
+def load_artifacts(args, tokenizer_model: dict, cache: ArtifactCache, memory: dict = None):
+    keys = artifact_keys(args, tokenizer_model, cache)
+    pre_key, tok_key = keys["preprocessing"], keys["tokenization"]
+    memory = memory if memory is not None else dict()
+    if tok_key in memory:
+        return memory[tok_key]
+
+    if cache.exists(tok_key):
+        memory[tok_key] = cache.load(tok_key)
+        return memory[tok_key]
+
+    if pre_key not in memory:
+        if cache.exists(pre_key):
+            memory[pre_key] = cache.load(pre_key)
         else:
-            train_df, test_df = train_test_split(train_df, test_size= args["test_split"], random_state= 42)
+            memory[pre_key] = preprocess_data(args)
+            ## save the preprocessed data
+            cache.save(pre_key, memory[pre_key], description= {"files": keys["input_files"], "config": keys["preprocessing_config"]})
 
-        ## create the validation data
-        if args["validation_split"]:
-            train_df, val_df = train_test_split(train_df, test_size=args["validation_split"], random_state=42)
-        else:
-            logging.error("vaidation_split needs to be given.")
-            sys.exit("vaidation_split needs to be given.")
-
-        ## get data columns
-        data_column = list(set(train_df.columns) - set(args["targets"]))[0]
-        train_target = train_df[args["targets"]].values
-        val_target = val_df[args["targets"]].values
-        test_target = test_df[args["targets"]].values
-
-        ## do the preprocessing
-        print("Preprocess")
-        preprocessor = Preprocessor(doLower= args["doLower"], doLemmatization= args["doLemmatization"], removeStopWords= args["removeStopWords"], doSpellingCorrection= False, removeNewLine= args["removeNewLine"], removePunctuation=args["removePunctuation"], removeHtmlTags= False, minTextLength = args["minTextLength"])
-        train_data = preprocessor.fit_transform(train_df[data_column])
-        train_target = train_target[~pd.isnull(train_data)]
-        train_data = train_data[~pd.isnull(train_data)]
-        val_data = preprocessor.transform(val_df[data_column])
-        val_target = val_target[~pd.isnull(val_data)]
-        val_data = val_data[~pd.isnull(val_data)]
-        test_data = preprocessor.transform(test_df[data_column])
-        test_target = test_target[~pd.isnull(test_data)]
-        test_data = test_data[~pd.isnull(test_data)]
-
-        ## save the preprocessed data
-        if not os.path.exists(os.path.join(args["data_path"], "temp")):
-            os.makedirs(os.path.join(args["data_path"], "temp"))
-        np.save(train_pre_path.format("data"), train_data, allow_pickle=True)
-        np.save(val_pre_path.format("data"), val_data, allow_pickle=True)
-        np.save(test_pre_path.format("data"), test_data, allow_pickle=True)
-        np.save(train_pre_path.format("target"), train_target, allow_pickle=True)
-        np.save(val_pre_path.format("target"), val_target, allow_pickle=True)
-        np.save(test_pre_path.format("target"), test_target, allow_pickle=True)
-
-
-    if run_tokenization:
-        ## do tokenization
-        print("Tokenize")
-        tokenizer = Tokenizer(args= tokenizer_model, fasttextFile= args["fasttext_file"], doLower= args["doLower"])
-        train_data = tokenizer.fit_transform(train_data)
-        val_data = tokenizer.transform(val_data)
-        test_data = tokenizer.transform(test_data)
-
-        ## save the preprocessed data
-        if not os.path.exists(os.path.join(args["data_path"], "temp")):
-            os.makedirs(os.path.join(args["data_path"], "temp"))
-        if sparse.issparse(train_data):
-            sparse.save_npz(train_tok_path.format("data"), train_data)
-        else:
-            np.save(train_tok_path.format("data"), train_data)
-        np.save(train_tok_path.format("target"), train_target)
-        if sparse.issparse(val_data):
-            sparse.save_npz(val_tok_path.format("data"), val_data)
-        else:
-            np.save(val_tok_path.format("data"), val_data)
-        np.save(val_tok_path.format("target"), val_target)
-        if sparse.issparse(val_data):
-            sparse.save_npz(test_tok_path.format("data"), test_data)
-        else:
-            np.save(test_tok_path.format("data"), test_data)
-        np.save(test_tok_path.format("target"), test_target)
+    memory[tok_key] = tokenize_data(args, tokenizer_model, memory[pre_key])
+    ## save the tokenized data
+    cache.save(tok_key, memory[tok_key], description= {"preprocessing": pre_key, "config": keys["tokenization_config"]})
+    return memory[tok_key]
 
-    ## for testing purposes
-    #train_df = train_df.sample(100)
-    #val_df = val_df.sample(20)
-    #test_df = test_df.sample(20)
-
-    # train the model
+def create_model(args, tokenizer_model: dict, device):
     cathegoryDict = {"science_int": "science", "sports_int": "sports", "world_int": "the world", "business_int": "business"}
     ## create the auxiliary sentences which are needed if binary classification is done.
     texts = ["The article is about {}.".format(cathegoryDict[x]) for x in args["targets"]]
     labelSentencesDict = dict(zip(args["targets"], texts))
     max_label_len = max([len(word_tokenize(x)) for x in labelSentencesDict.values()])
 
+    return Model(args= tokenizer_model, doLower= args["doLower"], train_batchSize= args["train_batchSize"], testval_batchSize= args["testval_batchSize"], learningRate= args["learningRate"], doLearningRateScheduler= args["doLearningRateScheduler"], labelSentences= labelSentencesDict, smartBatching=args["smartBatching"], max_label_len= max_label_len, device= device, target_columns= args["targets"], max_length= args["max_length"], maxTokens= args["smartBatching_maxTokens"],
+                 numWorkers= args["dataloader_numWorkers"], prefetchFactor= args["dataloader_prefetchFactor"], pinMemory= str(device).startswith("cuda"), bucketBoundaries= args["dataloader_bucketBoundaries"], streamingDataLoader= args["dataloader_streaming"],
+                 foldLabelSentences= args["binary_foldLabelSentences"], maxForwardBatch= args["binary_maxForwardBatch"], inferenceMaxTokens= args["inference_maxTokens"], incrementalTraining= args["incrementalTraining"], incrementalBatchSize= args["incremental_batchSize"], earlyStoppingRounds= args["boosting_earlyStoppingRounds"], maxDenseElements= args["boosting_maxDenseElements"],
+                 mixedPrecision= args["mixedPrecision"], gradientAccumulationSteps= args["gradientAccumulationSteps"],
+                 onnxIntraOpThreads= args["onnx_intraOpThreads"], onnxInterOpThreads= args["onnx_interOpThreads"], prefixCaching= args["binary_prefixCaching"])
+
+# train and test the model and do the configured exports, the exported files are named after the run
+def train_model(args, tokenizer_model: dict, model, artifacts: dict, device, run_name: str):
+    model.run(train_data= artifacts["train_data"], train_target= artifacts["train_target"], val_data= artifacts["val_data"], val_target= artifacts["val_target"],
+              test_data= artifacts["test_data"], test_target= artifacts["test_target"], epochs= args["numEpochs"])
+    test_data, test_target = artifacts["test_data"], artifacts["test_target"]
+    is_transformer = tokenizer_model["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]
+
+    # the float32 torchscript model is saved once, the int8 and the onnx version are compared with it
+    fp32_file = None
+    if is_transformer and (args["export_quantized"] or args["export_onnx"]):
+        fp32_file = model.save(os.path.join(args["model_path"], "{}".format(run_name)))
+
+    # export the float32 and the int8 quantized model for the inference on the cpu and compare both on the test data
+    if args["export_quantized"] and is_transformer:
+        report = model.exportQuantized(os.path.join(args["model_path"], "{}".format(run_name)), test_data, test_target, fp32File= fp32_file)
+        tracking.log({"quantization_{}_{}".format(version, key): value for version in ["fp32", "int8"] for key, value in report[version].items()})
+    # export the model to onnx and compare the onnx runtime with the torchscript inference on the test data
+    if args["export_onnx"] and is_transformer:
+        report = model.exportOnnxRuntime(os.path.join(args["model_path"], "{}".format(run_name)), test_data, test_target, fp32File= fp32_file)
+        tracking.log({"onnx_{}_{}".format(version, key): value for version in ["torchscript", "onnx"] for key, value in report[version].items()})
+
+    # compare the prefix cached binary classification with the full encoding of the (text, label sentence) pairs on the test data
+    if args["binary_prefixCaching"] and tokenizer_model["model"] == "xlnet" and tokenizer_model["binaryClassification"]:
+        if not os.path.exists(args["model_path"]):
+            os.makedirs(args["model_path"])
+        report = model.benchmarkPrefixCaching(os.path.join(args["model_path"], "{}".format(run_name)), test_data, test_target, device= device)
+        tracking.log({"prefix_caching_{}_{}".format(version, key): value for version in ["full", "prefix_cached"] for key, value in report[version].items()})
+        tracking.log({"prefix_caching_{}".format(key): report[key] for key in ["speedup", "macroF1_difference", "max_abs_probability_difference", "prediction_agreement"]})
+
+    # save the model with its preprocessing and tokenization as inference bundle (used by predict.py and serve.py)
+    if args["export_bundle"]:
+        tokenizer = create_tokenizer(args, tokenizer_model).set_state(artifacts["tokenizer_state"])
+        path = save_bundle(os.path.join(args["model_path"], "{}_bundle".format(run_name)), tokenizer_model, create_preprocessor(args).get_config(), tokenizer, model, thresholds= args["bundle_thresholds"])
+        print("Saved the inference bundle to {}".format(path))
+
+# torch is only seeded if it is imported, get_device imports it for the torch models
+def set_seeds(seed: int = 42):
+    random.seed(seed)
+    np.random.seed(seed)
+    if "torch" in sys.modules:
+        sys.modules["torch"].manual_seed(seed)
+
+
+if __name__ == "__main__":
+    # get all the configuration details from the config.json file
+    with open(r"config.json") as f:
+        args = json.load(f)
+
+    # initalize wandb to have online login and be able to run sweeps
+    with import_timer("wandb"):
+        import wandb
+    wandb.init(project= "NewsClassification", entity='faruman', config=args)
+    args = wandb.config
+    tracking.log({'finished': False})
+
+    # the sentence tokenizer data of nltk is only downloaded if it is missing
+    ensure_nltk_data("punkt", "tokenizers/punkt")
+
+    tokenizer_model = parse_tokenizer_model(args["tokenizer_model"])
+
+    # define on which device to run
+    device = get_device(tokenizer_model["model"])
+
+    set_seeds(42)
+
+    logging.info("training will be done on {}".format(device))
+
+    # do the data loading and tokenization, or reload them from the cache
+    cache = ArtifactCache(os.path.join(args["data_path"], "temp"), maxSizeGB= args["cache_maxSizeGB"])
+    artifacts = load_artifacts(args, tokenizer_model, cache)
+
+    # train the model
     print("Train Model")
-    model = Model(args= tokenizer_model, doLower= args["doLower"], train_batchSize= args["train_batchSize"], testval_batchSize= args["testval_batchSize"], learningRate= args["learningRate"], doLearningRateScheduler= args["doLearningRateScheduler"], labelSentences= labelSentencesDict, smartBatching=args["smartBatching"], max_label_len= max_label_len, device= device, target_columns= args["targets"])
+    model = create_model(args, tokenizer_model, device)
+
+    # log the time until the training starts and the time of every (lazy) import
+    tracking.log(startup_report())
 
     # train and test the model
-    model.run(train_data= train_data, train_target= train_target, val_data= val_data, val_target= val_target, test_data= test_data, test_target= test_target, epochs= args["numEpochs"])
+    train_model(args, tokenizer_model, model, artifacts, device, run_name= wandb.run.name)
 
     # close the logging
-    wandb.log({'finished': True})
-
-    # save the model
-    #model.save(os.path.join(args["model_path"], "{}".format(wandb.run.name)))
+    tracking.log({'finished': True})
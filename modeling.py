@@ -1,29 +1,20 @@
-import wandb
 import math
 import random
 import time
 import csv
+import os
+import copy
+import json
+import contextlib
 
 import logging
 import sys
 import statistics
 from tqdm import tqdm
-from tqdm.contrib import tzip
 
 import pandas as pd
 import numpy as np
 
-import torch
-from torch.utils.data import DataLoader, TensorDataset
-from torch.nn import BCELoss, CrossEntropyLoss
-from torch.nn import BCEWithLogitsLoss
-from torch import optim
-
-from transformers import DistilBertForSequenceClassification, BertForSequenceClassification, XLNetForSequenceClassification, RobertaForSequenceClassification
-from transformers import DistilBertTokenizer, BertTokenizer, XLNetTokenizer, RobertaTokenizer
-from transformers import get_cosine_schedule_with_warmup
-
-from xgboost import XGBClassifier
 from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
 from sklearn.multiclass import OneVsRestClassifier
 from sklearn.pipeline import Pipeline
@@ -33,13 +24,19 @@ from sklearn.linear_model import SGDClassifier
 
 from sklearn.metrics import accuracy_score, f1_score, precision_score, recall_score, roc_auc_score
 
-import matplotlib.pyplot as plt
 from sklearn.metrics import precision_recall_curve
 
 import pickle
+import inspect
+
+from tokenstore import TokenStore
+from startup import import_timer
+import tracking
 
 # function to plot precision/recall to Threshold graph
 def plot_auc(label, score, title):
+    with import_timer("matplotlib"):
+        import matplotlib.pyplot as plt
     precision, recall, thresholds = precision_recall_curve(label, score)
     plt.figure(figsize=(15, 5))
     plt.grid()
@@ -54,11 +51,38 @@ def plot_auc(label, score, title):
     return plt
 
 
+# wrapper around an onnx runtime session which is called like the traced transformer models: model(input_ids, attention_mask)[0] are the logits
+class OnnxModel():
+    def __init__(self, file_path: str, intraOpThreads: int = 0, interOpThreads: int = 0):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        # 0 lets onnx runtime choose the number of threads
+        options.intra_op_num_threads = intraOpThreads
+        options.inter_op_num_threads = interOpThreads
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(file_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [x.name for x in self.session.get_inputs()]
+
+    def __call__(self, input_ids, attention_mask):
+        import torch
+        inputs = {"input_ids": input_ids.cpu().numpy().astype(np.int64), "attention_mask": attention_mask.cpu().numpy().astype(np.int64)}
+        outputs = self.session.run(None, {x: inputs[x] for x in self.input_names})
+        return tuple(torch.from_numpy(x) for x in outputs)
+
+    # the session always runs in inference mode on the cpu
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+
 class Model():
-    def __init__(self, args: dict, doLower: bool, train_batchSize: int, testval_batchSize:int, learningRate: float, doLearningRateScheduler: bool, target_columns: list, smartBatching: bool = True, mixedPrecision: bool = True, labelSentences: dict = None, max_label_len= None, model= None, optimizer= None, loss_fct= None, device= "cpu"):
+    def __init__(self, args: dict, doLower: bool, train_batchSize: int, testval_batchSize:int, learningRate: float, doLearningRateScheduler: bool, target_columns: list, smartBatching: bool = True, mixedPrecision: bool = False, labelSentences: dict = None, max_label_len= None, model= None, tokenizer= None, optimizer= None, loss_fct= None, device= "cpu", max_length= 512, maxTokens: int = None, numWorkers: int = 0, prefetchFactor: int = 2, pinMemory: bool = False, bucketBoundaries: list = None, streamingDataLoader: bool = False, foldLabelSentences: bool = True, maxForwardBatch: int = None, gradientAccumulationSteps: int = 1, inferenceMaxTokens: int = None, incrementalTraining: bool = False, incrementalBatchSize: int = 10000, earlyStoppingRounds: int = 10, maxDenseElements: int = 200000000, onnxIntraOpThreads: int = 0, onnxInterOpThreads: int = 0, prefixCaching: bool = False, loadPretrained: bool = True):
         self.args = args
+        self.doLower = doLower
         self.labelSentences = labelSentences
-        self.tokenizer = None
+        self.tokenizer = tokenizer
         self.device = device
         self.train_batchSize = train_batchSize
         self.testval_batchSize = testval_batchSize
@@ -67,18 +91,54 @@ class Model():
         self.doLearningRateScheduler = doLearningRateScheduler
         self.learningRateScheduler = None
         self.smartBatching = smartBatching
+        self.maxTokens = maxTokens
+        self.inferenceMaxTokens = inferenceMaxTokens
+        self.incrementalTraining = incrementalTraining
+        self.incrementalBatchSize = incrementalBatchSize
+        self.earlyStoppingRounds = earlyStoppingRounds
+        self.maxDenseElements = maxDenseElements
+        self.numWorkers = numWorkers
+        self.prefetchFactor = prefetchFactor
+        self.pinMemory = pinMemory
+        self.bucketBoundaries = bucketBoundaries
+        self.streamingDataLoader = streamingDataLoader
+        self.foldLabelSentences = foldLabelSentences
+        self.maxForwardBatch = maxForwardBatch
+        self.prefixCaching = prefixCaching
+        # position of the training, the epoch and the batch inside the epoch
+        self.epoch = 0
+        self.step = 0
         self.mixedPrecision = mixedPrecision
+        self.gradientAccumulationSteps = gradientAccumulationSteps
+        # batches of the current accumulation window, the last window of an epoch can be shorter
+        self.accumulationBatches = gradientAccumulationSteps
+        self.onnxIntraOpThreads = onnxIntraOpThreads
+        self.onnxInterOpThreads = onnxInterOpThreads
+        self.gradScaler = None
         self.max_label_len = max_label_len
         self.target_columns = target_columns
+        self.max_length = max_length
+        # encoded label sentences of the target columns, see encodeLabelSentences
+        self.labelTokens = None
+        self.labelTokenColumns = None
         self.input_multiclass_as_one = False
 
 
+        # torch is only imported for the torch models, the sklearn models (and their inference) run without it
         if self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]:
+            with import_timer("torch"):
+                import torch
+
+            # loss scaling is only needed for float16 training on cuda, bfloat16 on the cpu has the range of float32
+            self.gradScaler = torch.cuda.amp.GradScaler(enabled= mixedPrecision and torch.device(device).type == "cuda")
+            if mixedPrecision and torch.device(device).type == "cpu" and not hasattr(torch, "autocast"):
+                logging.warning("bfloat16 autocast on the cpu needs torch >= 1.10, training is done in float32.")
+
             # define loss function
             if loss_fct:
                 self.loss_fct = loss_fct
             else:
-                self.loss_fct = BCEWithLogitsLoss()
+                self.loss_fct = torch.nn.BCEWithLogitsLoss()
 
             # define how many labels need to be classified
             if self.args["binaryClassification"]:
@@ -86,8 +146,18 @@ class Model():
             else:
                 self.num_labels = len(self.labelSentences.keys())
 
-        # build model from the model_str
-        if self.args["model"] == "distilbert":
+        # transformers, xgboost and the experimental sklearn models are only imported for the configured model
+        if loadPretrained and self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
+            with import_timer("transformers"):
+                from transformers import DistilBertForSequenceClassification, BertForSequenceClassification, XLNetForSequenceClassification, RobertaForSequenceClassification
+                from transformers import DistilBertTokenizer, BertTokenizer, XLNetTokenizer, RobertaTokenizer
+
+        # build model from the model_str. Without loadPretrained the pretrained transformer is not loaded, a saved model is loaded
+        # afterwards with load and the tokenizer of the saved model is given (e.g. by an inference bundle)
+        if not loadPretrained and self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
+            self.model = model
+
+        elif self.args["model"] == "distilbert":
             if doLower:
                 self.model = DistilBertForSequenceClassification.from_pretrained('distilbert-base-uncased', num_labels=self.num_labels, output_attentions=False, output_hidden_states=False, torchscript=True)
                 self.tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
@@ -135,6 +205,22 @@ class Model():
             self.model = GradientBoostingClassifier(learning_rate= self.learningRate, n_estimators= self.args["n_estimators"], max_depth= self.args["max_depth"], verbose=1)
             self.input_multiclass_as_one = True
 
+        elif self.args["model"] == "histgradboost":
+            # histogram based boosting, the trees are added in steps with warm_start to do early stopping on the validation data
+            # (the experimental import is needed for sklearn < 1.0)
+            from sklearn.experimental import enable_hist_gradient_boosting
+            from sklearn.ensemble import HistGradientBoostingClassifier
+            self.model = HistGradientBoostingClassifier(learning_rate= self.args.get("learning_rate", self.learningRate), max_iter= self.args["n_estimators"], max_depth= self.args["max_depth"],
+                                                        early_stopping= False, warm_start= True, verbose= 0)
+            self.input_multiclass_as_one = True
+
+        elif self.args["model"] == "xgboost":
+            with import_timer("xgboost"):
+                from xgboost import XGBClassifier
+            self.model = XGBClassifier(learning_rate= self.args.get("learning_rate", self.learningRate), n_estimators= self.args["n_estimators"], max_depth= self.args["max_depth"],
+                                       tree_method= "hist", n_jobs= -1, objective= "multi:softprob", eval_metric= "mlogloss")
+            self.input_multiclass_as_one = True
+
         elif self.args["model"] == "randomforest":
             self.model = RandomForestClassifier(n_estimators= self.args["n_estimators"], max_depth= self.args["max_depth"], verbose=1, n_jobs= -1)
             self.input_multiclass_as_one = True
@@ -158,167 +244,229 @@ class Model():
     def preprocess(self, data, target, max_label_len, target_columns):
         # do preprocessing for transformer models
         if self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
-            df = pd.DataFrame([[a, b] for a, b in data], columns=["data", "mask"])
-            df = pd.concat([df, pd.DataFrame(target, columns=target_columns)], axis=1)
+            if not isinstance(data, TokenStore):
+                data = TokenStore.from_pairs(data)
             if self.args["binaryClassification"]:
-                # add auxiliary sentences for the binary classification
-                max_label_len += 2
-                if type(self.labelSentences[list(self.labelSentences.keys())[0]]) == str:
-                    for key in self.labelSentences.keys():
-                        text = self.labelSentences[key]
-                        temp = self.tokenizer(text, return_attention_mask=True, padding="max_length", truncation=True, max_length= max_label_len)
-                        encoded_text = temp["input_ids"][1:]
-                        mask = temp["attention_mask"][1:]
-                        self.labelSentences[key] = (encoded_text, mask)
-                max_label_len -= 1
-                if set(target_columns).issubset(set(self.labelSentences.keys())):
-                    def create_samples(df_row, target_columns):
-                        output_base = list()
-                        output_mask = list()
-                        for i, key in enumerate(target_columns):
-                            input_base = df_row["data"].copy()
-                            input_mask = df_row["mask"].copy()
-                            extend_text, extend_mask = self.labelSentences[key]
-                            last_data = np.max(np.nonzero(input_mask)) +1
-                            if last_data < (len(input_mask)- len(extend_mask)):
-                                input_base[last_data: (last_data+ len(extend_mask))] = extend_text
-                                input_mask[last_data: (last_data+ len(extend_mask))] = extend_mask
-                                output_base.append(input_base)
-                                output_mask.append(input_mask)
-                            else:
-                                input_base[-(len(extend_text)+1):] = [input_base[last_data -1]] + extend_text
-                                input_mask[-(len(extend_mask)+1):] = [input_base[last_data -1]] + extend_mask
-                                output_base.append(input_base)
-                                output_mask.append(input_mask)
-                        df_row["data"] = np.array(output_base)
-                        df_row["mask"] = np.array(output_mask)
-                        return df_row
-                    df = df.apply(create_samples, args= (target_columns,), axis=1)
-                else:
-                    logging.error("Target columns need to be subset of labelSentences.keys.")
-                    sys.exit("Target columns need to be subset of labelSentences.keys.")
-                return df["data"].values, df["mask"].values, target
-            else:
-                return df["data"].values, df["mask"].values, target
+                self.encodeLabelSentences(target_columns)
+            # the store is padded per batch while batching
+            return data, None, target
         else:
             mask = None
             return data, mask, target
 
-    # implementation of smart batching, create different sample batches with different length to speed up the training process
-    def applySmartBatching(self, data, mask, target= None, index= None, text= "Iteration:"):
-        data = np.stack(data)
-        mask = np.stack(mask)
-        if target is not None and index is None:
-            target = target
-        elif index is not None and target is None:
-            index = index
+    # tokenize the auxiliary sentences for the binary classification, they are appended to the texts per batch. The token ids are
+    # kept as padded matrix (target columns x longest label sentence) and lengths, they are only encoded again for other target columns
+    def encodeLabelSentences(self, target_columns):
+        if self.labelTokens is not None and self.labelTokenColumns == list(target_columns):
+            return self.labelTokens
+        if not set(target_columns).issubset(set(self.labelSentences.keys())):
+            logging.error("Target columns need to be subset of labelSentences.keys.")
+            sys.exit("Target columns need to be subset of labelSentences.keys.")
+        encoded_texts = list()
+        for key in target_columns:
+            encoded_text = self.tokenizer(self.labelSentences[key])["input_ids"]
+            # the label sentence follows the text, therefore a leading classification token is removed
+            if encoded_text[0] in [self.tokenizer.cls_token_id, self.tokenizer.bos_token_id]:
+                encoded_text = encoded_text[1:]
+            encoded_texts.append(encoded_text)
+        label_lengths = np.array([len(x) for x in encoded_texts])
+        label_ids = np.full((len(target_columns), label_lengths.max()), self.tokenizer.pad_token_id, dtype=np.int32)
+        for i, encoded_text in enumerate(encoded_texts):
+            label_ids[i, :label_lengths[i]] = encoded_text
+        self.labelTokens, self.labelTokenColumns = (label_ids, label_lengths), list(target_columns)
+        return self.labelTokens
+
+    # number of tokens of every text after padding, for the binary classification the text is paired with all label sentences
+    def storeLengths(self, store):
+        if self.args["binaryClassification"]:
+            label_ids, label_lengths = self.labelTokens
+            return np.minimum(store.lengths + label_lengths.max(), self.max_length) * len(label_lengths)
+        return store.lengths
+
+    # batch sampler of the current epoch
+    def createSampler(self, data, smartBatching= False, shuffle= False):
+        from batching import LengthBucketSampler, SequentialBatchSampler
+        if smartBatching:
+            sampler = LengthBucketSampler(self.storeLengths(data), self.train_batchSize, maxTokens= self.maxTokens, shuffle= shuffle)
         else:
+            sampler = SequentialBatchSampler(len(data), self.train_batchSize)
+        sampler.set_epoch(self.epoch)
+        return sampler
+
+    # create the dataloader over the token store, the batches are padded in the (worker) processes of the dataloader.
+    # The first skipBatches batches of the epoch are left out (to resume an epoch)
+    def createDataLoader(self, data, target= None, index= None, text= "Iteration:", smartBatching= False, shuffle= False, sampler= None, skipBatches: int = 0):
+        import torch
+        from torch.utils.data import DataLoader
+        from batching import SkipBatchSampler, StoreCollator, TokenStoreDataset, TokenStoreIterableDataset
+        if target is not None and index is not None:
             logging.warning("Provide exactly one of target or index.")
-
-        def getArrayLength(x):
-            return sum(x != 0)
-
-        length_array = np.apply_along_axis(getArrayLength, np.stack(data).ndim - 1, np.stack(data))
-        while length_array.ndim > 1:
-            length_array = np.max(length_array, axis=1)
-        sort_idx = length_array.argsort()
-        length_array = length_array[sort_idx]
-        data = data[sort_idx]
-        mask = mask[sort_idx]
-        if target is not None and index is None:
-            target = target[sort_idx]
-        elif index is not None and target is None:
-            index = index[sort_idx]
+        collator = StoreCollator(data, self.tokenizer.pad_token_id, self.tokenizer.padding_side, labelTokens= self.labelTokens if self.args["binaryClassification"] else None,
+                                 max_length= self.max_length, target= target, index= index, bucketBoundaries= self.bucketBoundaries)
+        if sampler is None:
+            sampler = self.createSampler(data, smartBatching, shuffle)
+        if skipBatches:
+            sampler = SkipBatchSampler(sampler, skipBatches)
+        sampler.set_epoch(self.epoch)
+
+        # the dataloader draws the seed of its workers from its own generator, so the global random state (dropout) does not depend
+        # on the number of dataloaders and a resumed epoch continues with the same random numbers
+        generator = torch.Generator()
+        generator.manual_seed(self.epoch)
+        loader_args = {"batch_size": None, "num_workers": self.numWorkers, "pin_memory": self.pinMemory, "generator": generator}
+        if self.numWorkers > 0:
+            loader_args["prefetch_factor"] = self.prefetchFactor
+        if self.streamingDataLoader:
+            dataloader = DataLoader(TokenStoreIterableDataset(collator, sampler), **loader_args)
         else:
-            logging.warning("Provide exactly one of target or index.")
+            dataloader = DataLoader(TokenStoreDataset(collator), sampler= sampler, **loader_args)
+        return tqdm(dataloader, text)
 
-        data_batch = list()
-        mask_batch = list()
-        if target is not None and index is None:
-            target_batch = list()
-        elif index is not None and target is None:
-            index_batch = list()
+    # implementation of smart batching, create different sample batches with different length to speed up the training process
+    def applySmartBatching(self, data, mask, target= None, index= None, text= "Iteration:", shuffle= True, skipBatches: int = 0):
+        return self.createDataLoader(data, target, index, text, smartBatching= True, shuffle= shuffle, skipBatches= skipBatches)
+
+    # implementation of normal batching, the batches keep the order of the data and are padded to their longest text
+    def applyNormalBatching(self, data, mask, target = None, index= None, text= "Iteration:", skipBatches: int = 0):
+        return self.createDataLoader(data, target, index, text, skipBatches= skipBatches)
+
+    # batching for the inference, the texts are sorted by length and the batches are filled up to inferenceMaxTokens padded tokens.
+    # The index is added to the batches to restore the original order
+    def applyInferenceBatching(self, data, mask, index, text= "Iteration:"):
+        from batching import InferenceBatchSampler
+        sampler = InferenceBatchSampler(self.storeLengths(data), self.testval_batchSize, maxTokens= self.inferenceMaxTokens)
+        return self.createDataLoader(data, index= index, text= text, sampler= sampler)
+
+    # forward pass over all (text, label sentence) pairs of a batch at once, returns the logits with the shape (batch, num_labels)
+    def forwardLabelPairs(self, data, mask):
+        import torch
+        batch_size, num_labels, length = data.shape
+        data = data.reshape(batch_size * num_labels, length)
+        mask = mask.reshape(batch_size * num_labels, length)
+        chunk_size = self.maxForwardBatch if self.maxForwardBatch else data.shape[0]
+        logits = [self.model(data_batch, mask_batch)[0] for data_batch, mask_batch in zip(torch.split(data, chunk_size), torch.split(mask, chunk_size))]
+        return torch.cat(logits, 0).reshape(batch_size, num_labels)
+
+    # the shared prefix caching needs the mems of xlnet and the eager model (a traced or onnx model only takes input_ids and attention_mask)
+    def usePrefixCaching(self):
+        import torch
+        if not (self.prefixCaching and self.args["binaryClassification"]):
+            return False
+        if self.args["model"] != "xlnet" or not isinstance(self.model, torch.nn.Module) or isinstance(self.model, torch.jit.ScriptModule):
+            logging.warning("Prefix caching needs the untraced xlnet model, the (text, label sentence) pairs are encoded completely.")
+            return False
+        return True
+
+    # cut a text to limit tokens, the last token (<sep> <cls> of xlnet) is kept as done by pad_label_pairs
+    @staticmethod
+    def truncatePrefix(tokens, limit: int):
+        tokens = np.asarray(tokens)
+        if len(tokens) <= limit:
+            return tokens
+        return np.concatenate([tokens[:limit - 1], tokens[-1:]])
+
+    # binary classification where every text is encoded once and its hidden states (the mems of xlnet) are reused for all label sentences,
+    # so only the few tokens of the label sentences are run per label. The text does not attend to the label sentence (it does in the full
+    # pass), therefore the probabilities are an approximation of the full pass, check them with benchmarkPrefixCaching.
+    # Texts of the same length are batched, so neither the cached text nor the label sentences are padded. Returns the probabilities in the order of the store.
+    def prefixCachedInference(self, store, device= "cpu", text= "Iteration:"):
+        import torch
+        label_ids, label_lengths = self.labelTokens
+        limit = self.max_length - int(label_lengths.max())
+        lengths = np.minimum(store.lengths, limit)
+        order = np.argsort(lengths, kind="stable")
+        groups = np.split(order, np.flatnonzero(np.diff(lengths[order])) + 1)
+        batches = [group[i:i + self.testval_batchSize] for group in groups if len(group) > 0 for i in range(0, len(group), self.testval_batchSize)]
+
+        outputs = np.zeros((len(store), len(label_lengths)), dtype=np.float32)
+        self.model.eval()
+        with torch.no_grad(), self.autocast():
+            for indices in tqdm(batches, text):
+                prefix = torch.from_numpy(np.stack([self.truncatePrefix(store[i], limit) for i in indices])).long().to(device)
+                mems = self.model.transformer(input_ids= prefix, use_mems= True, return_dict= False)[1]
+                for k in range(len(label_lengths)):
+                    suffix = torch.from_numpy(np.repeat(label_ids[k:k + 1, :label_lengths[k]], len(indices), axis=0)).long().to(device)
+                    hidden = self.model.transformer(input_ids= suffix, mems= mems, use_mems= False, return_dict= False)[0]
+                    logits = self.model.logits_proj(self.model.sequence_summary(hidden))
+                    outputs[indices, k] = torch.sigmoid(logits[:, 0]).float().cpu().numpy()
+        return outputs
+
+    # mixed precision context for the forward pass, float16 on cuda and bfloat16 on the cpu
+    def autocast(self):
+        import torch
+        if self.mixedPrecision and torch.device(self.device).type == "cuda":
+            return torch.cuda.amp.autocast()
+        elif self.mixedPrecision and hasattr(torch, "autocast"):
+            return torch.autocast("cpu", dtype=torch.bfloat16)
         else:
-            logging.warning("Provide exactly one of target or index.")
+            return contextlib.nullcontext()
 
-        pbar = tqdm(total=len(data), desc="Apply dynamic batching")
-        while len(data) > 0:
-            to_take = min(self.train_batchSize, len(data))
-            select = random.randint(0, len(data) - to_take)
-            max_batch_len = max(length_array[select:select + to_take])
-            data_batch += [torch.tensor(data[select:select + to_take][..., :max_batch_len], dtype=torch.long)]
-            mask_batch += [torch.tensor(mask[select:select + to_take][..., :max_batch_len], dtype=torch.long)]
-            if target is not None and index is None:
-                target_batch += [torch.tensor(target[select:select + to_take], dtype=torch.long)]
-            elif index is not None and target is None:
-                index_batch += [torch.tensor(index[select:select + to_take], dtype=torch.long)]
-            else:
-                logging.error("Provide exactly one of target or index.")
-            length_array = np.delete(length_array, np.s_[select:select + to_take], 0)
-            data = np.delete(data, np.s_[select:select + to_take], 0)
-            mask = np.delete(mask, np.s_[select:select + to_take], 0)
-            if target is not None and index is None:
-                target = np.delete(target, np.s_[select:select + to_take], 0)
-            elif index is not None and target is None:
-                index = np.delete(index, np.s_[select:select + to_take], 0)
-            else:
-                logging.warning("Provide exactly one of target or index.")
-            pbar.update(to_take)
-        pbar.close()
-        if target is not None and index is None:
-            return tzip(data_batch, mask_batch, target_batch, desc=text)
-        elif index is not None and target is None:
-            return tzip(data_batch, mask_batch, index_batch, desc=text)
-        else:
-            return tzip(data_batch, mask_batch, desc=text)
-
-    # implementation of normal batching
-    def applyNormalBatching(self, data, mask, target = None, text= "Iteration:"):
-        data = torch.tensor(np.stack(data), dtype=torch.long)
-        mask = torch.tensor(np.stack(mask), dtype=torch.long)
-        if target is not None:
-            target = torch.tensor(target, dtype=torch.int32)
-            data = TensorDataset(data, mask, target)
-        else:
-            data = TensorDataset(data, mask)
-        return tqdm(DataLoader(data, batch_size=self.train_batchSize), text)
+    # backward pass of one batch, the loss is averaged over the batches of the accumulation window and scaled for float16 training
+    def backward(self, loss):
+        self.gradScaler.scale(loss / self.accumulationBatches).backward()
 
     # training function (for one epoch)
-    def train(self, data, mask, target, device= "cpu"):
+    # with startStep and stopStep only the batches startStep to stopStep of the epoch are trained (to stop and resume an epoch),
+    # both have to be multiples of gradientAccumulationSteps as the optimizer only steps at the end of an accumulation window
+    def train(self, data, mask, target, device= "cpu", val_data= None, val_target= None, startStep: int = 0, stopStep: int = None):
         # TODO: recreate batches each epoch? => no, create extra argument
         if self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]:
+            import torch
             if self.smartBatching:
-                dataloader = self.applySmartBatching(data, mask, target, text= "Do training:")
+                dataloader = self.applySmartBatching(data, mask, target, text= "Do training:", skipBatches= startStep)
             else:
-                dataloader = self.applyNormalBatching(data, mask, target, text= "Do Training:")
+                dataloader = self.applyNormalBatching(data, mask, target, text= "Do Training:", skipBatches= startStep)
 
             self.model.train()
 
-            for step, batch in enumerate(dataloader):
+            num_steps = startStep + len(dataloader)
+            step_start = time.perf_counter()
+            for step, batch in enumerate(dataloader, start= startStep):
+                if stopStep is not None and step >= stopStep:
+                    break
                 # TODO: Make loss function variable
                 batch = tuple(t.to(device) for t in batch)
                 data, mask, target = batch
+                num_samples, num_tokens = data.shape[0], mask.sum().item()
 
-                self.optimizer.zero_grad()
+                # the gradients of gradientAccumulationSteps batches are summed up before the optimizer step
+                if step % self.gradientAccumulationSteps == 0:
+                    self.optimizer.zero_grad()
+                    self.accumulationBatches = min(self.gradientAccumulationSteps, num_steps - step)
 
                 if self.args["binaryClassification"]:
                     data = data.reshape(data.shape[0]*data.shape[1], data.shape[2])
                     mask = mask.reshape(mask.shape[0]*mask.shape[1], mask.shape[2])
                     target = target.reshape(target.shape[0]*target.shape[1])
 
-                    if self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
+                    if self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"] and self.foldLabelSentences:
+                        # all label pairs of the batch in one forward pass (or in chunks of maxForwardBatch pairs with accumulated gradients)
+                        chunk_size = self.maxForwardBatch if self.maxForwardBatch else data.shape[0]
+                        sum_loss = 0
+                        for data_batch, mask_batch, target_batch in zip(torch.split(data, chunk_size), torch.split(mask, chunk_size), torch.split(target, chunk_size)):
+                            with self.autocast():
+                                logits = self.model(input_ids= data_batch, attention_mask= mask_batch)[0].float()
+                            # scaled to the sum of the per label losses which are used in the unfolded mode
+                            loss = self.loss_fct(logits.flatten(), target_batch.type_as(logits)) * len(self.target_columns) * data_batch.shape[0] / data.shape[0]
+                            sum_loss += loss.item()
+                            self.backward(loss)
+
+                        tracking.log({'train_batch_loss': sum_loss})
+
+                    elif self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
                         data = torch.split(data, int(data.shape[0] / len(self.labelSentences.keys())))
                         mask = torch.split(mask, int(mask.shape[0] / len(self.labelSentences.keys())))
                         target = torch.split(target, int(target.shape[0] / len(self.labelSentences.keys())))
 
                         sum_loss = 0
                         for data_batch, mask_batch, target_batch in zip(data, mask, target):
-                            logits = self.model(input_ids= data_batch, attention_mask= mask_batch)[0]
+                            with self.autocast():
+                                logits = self.model(input_ids= data_batch, attention_mask= mask_batch)[0].float()
                             loss = self.loss_fct(logits.flatten(), target_batch.type_as(logits))
                             sum_loss += loss.item()
-                            loss.backward()
+                            self.backward(loss)
 
-                        wandb.log({'train_batch_loss': sum_loss})
+                        tracking.log({'train_batch_loss': sum_loss})
 
                     else:
                         sum_loss = 0
@@ -327,44 +475,223 @@ class Model():
                             subtarget = target[:, i]
                             loss = self.loss_fct(model_output, subtarget)
                             sum_loss += loss.item()
-                            loss.backward()
+                            self.backward(loss)
 
-                        wandb.log({'train_batch_loss': sum_loss})
+                        tracking.log({'train_batch_loss': sum_loss})
 
                 else:
                     if self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
-                        logits = self.model(input_ids= data, attention_mask= mask)[0]
+                        with self.autocast():
+                            logits = self.model(input_ids= data, attention_mask= mask)[0].float()
 
                         loss = self.loss_fct(logits, target.type_as(logits))
 
-                        loss.backward()
-                        wandb.log({'train_batch_loss': loss.item()})
+                        self.backward(loss)
+                        tracking.log({'train_batch_loss': loss.item()})
 
                     else:
                         model_output = self.model(input_ids=data, attention_mask=mask)
                         loss = self.loss_fct(model_output, target)
 
-                        loss.backward()
-                        wandb.log({'train_batch_loss': loss.item()})
+                        self.backward(loss)
+                        tracking.log({'train_batch_loss': loss.item()})
 
-                self.optimizer.step()
+                if (step + 1) % self.gradientAccumulationSteps == 0 or step + 1 == num_steps:
+                    self.gradScaler.step(self.optimizer)
+                    self.gradScaler.update()
 
-                if self.learningRateScheduler:
-                    self.learningRateScheduler.step()
+                    if self.learningRateScheduler:
+                        self.learningRateScheduler.step()
+
+                step_time = time.perf_counter() - step_start
+                step_start = time.perf_counter()
+                tracking.log({'train_samples_per_sec': num_samples / step_time, 'train_tokens_per_sec': num_tokens / step_time})
+        elif self.args["model"] == "xgboost" and val_data is not None:
+            self.fitXGBoost(data, target, val_data, val_target)
+        elif self.args["model"] == "histgradboost":
+            self.fitHistGradientBoosting(data, target, val_data, val_target)
         else:
             if self.input_multiclass_as_one:
                 self.model.fit(data, np.argmax(target, axis=1))
             else:
                 self.model.fit(data, target)
 
+    # number of training batches of the current epoch
+    def epochSteps(self, data):
+        return len(self.createSampler(data, self.smartBatching, shuffle= True))
+
+    # train until the given (fractional) epoch, e.g. 1.5 stops in the middle of the second epoch. The position (epoch and batch) is kept,
+    # so the training can be continued later with a higher untilEpoch (also after saveCheckpoint and loadCheckpoint)
+    def trainUntil(self, data, mask, target, untilEpoch: float, device= "cpu"):
+        while True:
+            epoch_steps = self.epochSteps(data)
+            stop_step = math.ceil(round((untilEpoch - self.epoch) * epoch_steps, 6))
+            # stop at the end of an accumulation window, otherwise the gradients of the started window are lost
+            stop_step = min(math.ceil(stop_step / self.gradientAccumulationSteps) * self.gradientAccumulationSteps, epoch_steps)
+            if stop_step <= self.step:
+                break
+            self.train(data, mask, target, device= device, startStep= self.step, stopStep= stop_step)
+            self.step = stop_step
+            if self.step >= epoch_steps:
+                self.epoch += 1
+                self.step = 0
+
+    # training state of the transformer models (weights, optimizer, learning rate scheduler and position), the training is resumed with loadCheckpoint
+    def saveCheckpoint(self, file_path: str):
+        import torch
+        torch.save({"model": self.model.state_dict(), "optimizer": self.optimizer.state_dict(), "gradScaler": self.gradScaler.state_dict(),
+                    "learningRateScheduler": self.learningRateScheduler.state_dict() if self.learningRateScheduler else None,
+                    "epoch": self.epoch, "step": self.step, "torch_rng_state": torch.get_rng_state(),
+                    # dropout on the gpu draws from the cuda generators
+                    "cuda_rng_state": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None}, file_path)
+
+    # load a checkpoint of saveCheckpoint, the optimizer (and scheduler) need to be created before with prepareTraining
+    def loadCheckpoint(self, file_path: str):
+        import torch
+        checkpoint = torch.load(file_path, map_location= self.device)
+        self.model.load_state_dict(checkpoint["model"])
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        self.gradScaler.load_state_dict(checkpoint["gradScaler"])
+        if self.learningRateScheduler and checkpoint["learningRateScheduler"]:
+            self.learningRateScheduler.load_state_dict(checkpoint["learningRateScheduler"])
+        self.epoch, self.step = checkpoint["epoch"], checkpoint["step"]
+        torch.set_rng_state(checkpoint["torch_rng_state"].cpu())
+        if torch.cuda.is_available() and checkpoint.get("cuda_rng_state"):
+            torch.cuda.set_rng_state_all([x.cpu() for x in checkpoint["cuda_rng_state"]])
+
+    # xgboost takes the sparse data directly and stops when the loss on the validation data did not improve for earlyStoppingRounds trees
+    def fitXGBoost(self, data, target, val_data, val_target):
+        fit_args = {"eval_set": [(val_data, np.argmax(val_target, axis=1))], "verbose": False}
+        # early_stopping_rounds moved from fit to the constructor in newer xgboost versions
+        if "early_stopping_rounds" in inspect.signature(self.model.fit).parameters:
+            fit_args["early_stopping_rounds"] = self.earlyStoppingRounds
+        else:
+            self.model.set_params(early_stopping_rounds= self.earlyStoppingRounds)
+        self.model.fit(data, np.argmax(target, axis=1), **fit_args)
+        tracking.log({'train_best_iteration': self.model.best_iteration})
+
+    # the histogram boosting of sklearn does not accept sparse input, a sparse matrix is only densified up to maxDenseElements values
+    # (e.g. a bow matrix of a large corpus would need hundreds of GB as dense matrix)
+    def toDense(self, data):
+        if not hasattr(data, "toarray"):
+            return data
+        if data.shape[0] * data.shape[1] > self.maxDenseElements:
+            logging.error("The sparse data with shape {} has more than {} values as dense matrix, use histgradboost with dense features (e.g. fasttext_mean) or xgboost.".format(data.shape, self.maxDenseElements))
+            sys.exit("The sparse data with shape {} has more than {} values as dense matrix, use histgradboost with dense features (e.g. fasttext_mean) or xgboost.".format(data.shape, self.maxDenseElements))
+        return data.toarray()
+
+    # the histogram boosting is trained in steps of earlyStoppingRounds trees, after every step it is scored on the validation data.
+    # The training stops if the score did not improve in the last step, the trees of this step are removed again
+    def fitHistGradientBoosting(self, data, target, val_data= None, val_target= None):
+        data, val_data = self.toDense(data), self.toDense(val_data)
+        target = np.argmax(target, axis=1)
+        if val_data is None:
+            self.model.fit(data, target)
+            return
+
+        val_target = np.argmax(val_target, axis=1)
+        max_iter = self.model.max_iter
+        best_score, best_iter = -np.inf, 0
+        for num_iter in range(self.earlyStoppingRounds, max_iter + self.earlyStoppingRounds, self.earlyStoppingRounds):
+            self.model.set_params(max_iter= min(num_iter, max_iter))
+            self.model.fit(data, target)
+            score = self.model.score(val_data, val_target)
+            if score > best_score:
+                best_score, best_iter = score, self.model.n_iter_
+            else:
+                break
+        if self.model.n_iter_ != best_iter:
+            self.model.set_params(max_iter= best_iter, warm_start= False)
+            self.model.fit(data, target)
+        tracking.log({'train_best_iteration': best_iter})
+
+    # run the model over all batches of a dataloader, returns the predicted probabilities, the target (or index) of the batches
+    # and the time every batch took
+    def inference(self, dataloader, device= "cpu"):
+        import torch
+        all_model_outputs = []
+        all_targets = []
+        batch_times = []
+
+        with torch.no_grad(), self.autocast():
+            for step, batch in enumerate(dataloader):
+                data, mask, target = batch
+                start_time = time.perf_counter()
+                data = data.to(device)
+                mask = mask.to(device)
+
+                if self.args["binaryClassification"]:
+                    if self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"] and self.foldLabelSentences:
+                        model_output = torch.sigmoid(self.forwardLabelPairs(data, mask))
+
+                    elif self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
+                        model_output = []
+                        for i, label in enumerate(self.target_columns):
+                            ind_model_output = self.model(data[:, i, :], mask[:, i, :])[0]
+                            model_output.append(ind_model_output)
+                        model_output = torch.sigmoid(torch.cat(model_output, 1))
+
+                    else:
+                        model_output = []
+                        for i, label in enumerate(self.target_columns):
+                            ind_model_output = self.model[label](data, mask)
+                            model_output.append(ind_model_output)
+                        model_output = torch.sigmoid(torch.cat(model_output, 0))
+                else:
+                    if self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
+                        model_output = self.model(data, mask)[0]
+                        model_output = torch.sigmoid(model_output)
+
+                    else:
+                        model_output = self.model(data, mask)
+                        model_output = torch.sigmoid(model_output)
+
+                all_model_outputs.append(model_output.detach().float().cpu().numpy())
+                batch_times.append(time.perf_counter() - start_time)
+                all_targets.append(target)
+
+        return np.concatenate(all_model_outputs), np.concatenate(all_targets), batch_times
+
+    # minibatches of rows for the incremental training, the order of the blocks of incrementalBatchSize rows and the rows inside a block
+    # are shuffled every epoch. A block is read at once, so a memory mapped matrix is read block by block and never loaded completely.
+    def incrementalBatches(self, data, target):
+        rng = np.random.default_rng(42 + self.epoch)
+        starts = np.arange(0, data.shape[0], self.incrementalBatchSize)
+        for start in starts[rng.permutation(len(starts))]:
+            end = min(start + self.incrementalBatchSize, data.shape[0])
+            order = rng.permutation(end - start)
+            yield data[start:end][order], np.asarray(target[start:end])[order]
+
+    # one epoch of the incremental training, the one hot targets are passed as class index (the targets are exclusive)
+    def trainIncremental(self, data, target):
+        classes = np.arange(target.shape[1])
+        num_samples = 0
+        start_time = time.perf_counter()
+        num_batches = math.ceil(data.shape[0] / self.incrementalBatchSize)
+        for data_batch, target_batch in tqdm(self.incrementalBatches(data, target), total= num_batches, desc= "Epoch {}".format(self.epoch)):
+            self.model.partial_fit(data_batch, np.argmax(target_batch, axis=1), classes= classes)
+            num_samples += data_batch.shape[0]
+        tracking.log({'train_epoch': self.epoch, 'train_samples_per_sec': num_samples / (time.perf_counter() - start_time)})
+
+    # class scores of the sklearn models, models without probabilities (e.g. sgd with hinge loss) return their decision function
+    def predictScores(self, data):
+        if self.args["model"] == "histgradboost":
+            data = self.toDense(data)
+        if hasattr(self.model, "predict_proba"):
+            return self.model.predict_proba(data)
+        return self.model.decision_function(data)
+
     # test a model and calculate different scores such as F1, Recall, Precision and Accuracy
     def test_validate(self, data, mask, target, type: str, device= "cpu", use_wandb= True, decision_dict= None):
         if not decision_dict:
             decision_dict = dict(zip(self.target_columns, [0.5]*len(self.target_columns)))
 
-        if self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]:
+        if self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"] and self.usePrefixCaching():
+            all_model_outputs, all_targets = self.prefixCachedInference(data, device, text= "Do {}:".format(type)), np.asarray(target)
+
+        elif self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]:
             if self.smartBatching:
-                dataloader = self.applySmartBatching(data, mask, target, text= "Do {}:".format(type))
+                dataloader = self.applySmartBatching(data, mask, target, text= "Do {}:".format(type), shuffle= False)
             else:
                 dataloader = self.applyNormalBatching(data, mask, target, text= "Do {}:".format(type))
 
@@ -377,47 +704,10 @@ class Model():
                     else:
                         self.model = self.model.eval()
 
-            all_model_outputs= []
-            all_targets = []
-
-            with torch.no_grad():
-                for step, batch in enumerate(dataloader):
-                    data, mask, target = batch
-                    data = data.to(device)
-                    mask = mask.to(device)
-
-                    if self.args["binaryClassification"]:
-                        if self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
-                            model_output = []
-                            for i, label in enumerate(self.target_columns):
-                                ind_model_output = self.model(data[:, i, :], mask[:, i, :])[0]
-                                model_output.append(ind_model_output)
-                            model_output = torch.sigmoid(torch.cat(model_output, 1))
-
-                        else:
-                            model_output = []
-                            for i, label in enumerate(self.target_columns):
-                                ind_model_output = self.model[label](data, mask)
-                                model_output.append(ind_model_output)
-                            model_output = torch.sigmoid(torch.cat(model_output, 0))
-                    else:
-                        if self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
-                            model_output = self.model(data, mask)[0]
-                            model_output = torch.sigmoid(model_output)
-
-                        else:
-                            model_output = self.model(data, mask)
-                            model_output = torch.sigmoid(model_output)
-
-                    all_model_outputs.append(model_output.detach().cpu().numpy())
-                    all_targets.append(target)
-
-            all_targets = np.concatenate(all_targets)
-            all_model_outputs = np.concatenate(all_model_outputs)
-            all_model_outputs.transpose()
+            all_model_outputs, all_targets, _ = self.inference(dataloader, device)
         else:
             all_targets = target
-            all_model_outputs = self.model.predict_proba(data)
+            all_model_outputs = self.predictScores(data)
 
         all_model_outputs = np.argmax(all_model_outputs, axis=1)
         all_targets = np.argmax(all_targets, axis=1)
@@ -428,10 +718,29 @@ class Model():
         Acc = accuracy_score(all_targets, all_model_outputs)
 
         if use_wandb:
-            wandb.log({'{}_macroF1'.format(type): macroF1, '{}_macroPrec'.format(type): macroPrec, '{}_macroRec'.format(type): macroRec, '{}_Acc'.format(type): Acc})
+            tracking.log({'{}_macroF1'.format(type): macroF1, '{}_macroPrec'.format(type): macroPrec, '{}_macroRec'.format(type): macroRec, '{}_Acc'.format(type): Acc})
         else:
             return {'{}_macroF1'.format(type): macroF1, '{}_macroPrec'.format(type): macroPrec, '{}_macroRec'.format(type): macroRec, '{}_Acc'.format(type): Acc}
 
+    # create the optimizer and the learning rate scheduler for the training of epochs epochs and move the model to the device
+    def prepareTraining(self, train_data, epochs: int):
+        import torch
+        if self.args["optimizer"] == "adam":
+            self.optimizer = torch.optim.Adam(self.model.parameters(), self.learningRate)
+        elif self.args["optimizer"] == "sgd":
+            self.optimizer = torch.optim.SGD(self.model.parameters(), self.learningRate)
+        else:
+            # use adam as default optimizer
+            self.optimizer = torch.optim.Adam(self.model.parameters(), self.learningRate)
+
+        # implement learning rate scheduler to reduce learning rate after a defined time of steps
+        if ~bool(self.learningRateScheduler) and self.doLearningRateScheduler:
+            from transformers import get_cosine_schedule_with_warmup
+            num_train_steps = epochs * math.ceil(len(train_data) / (self.train_batchSize * self.gradientAccumulationSteps))
+            self.learningRateScheduler = get_cosine_schedule_with_warmup(self.optimizer, num_warmup_steps=int(0.1*num_train_steps), num_training_steps=num_train_steps)
+
+        self.model.to(self.device)
+
     # function to do the training process
     def run(self, train_data, train_target, val_data, val_target, test_data, test_target, epochs: int):
         # prepare the data for binary classification
@@ -441,73 +750,209 @@ class Model():
 
 
         if self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]:
-            if self.args["optimizer"] == "adam":
-                self.optimizer = optim.Adam(self.model.parameters(), self.learningRate)
-            elif self.args["optimizer"] == "sgd":
-                self.optimizer = torch.optim.SGD(self.model.parameters(), self.learningRate)
-            else:
-                # use adam as default optimizer
-                self.optimizer = optim.Adam(self.model.parameters(), self.learningRate)
-
-            # implement learning rate scheduler to reduce learning rate after a defined time of steps
-            if ~bool(self.learningRateScheduler) and self.doLearningRateScheduler:
-                num_train_steps = epochs * math.ceil(train_data.shape[0] / self.train_batchSize)
-                self.learningRateScheduler = get_cosine_schedule_with_warmup(self.optimizer, num_warmup_steps=int(0.1*num_train_steps), num_training_steps=num_train_steps)
-
-            self.model.to(self.device)
+            self.prepareTraining(train_data, epochs)
 
             # train the model for the defined number of epochs after each epoch do validation
             for i in range(epochs):
                 print("epoch {}".format(i))
+                self.epoch = i
                 self.train(train_data, train_mask, train_target, device= self.device)
                 self.test_validate(val_data, val_mask, val_target, type= "validate", device= self.device)
             self.test_validate(test_data, test_mask, test_target, type= "test", device= self.device)
 
+        elif self.incrementalTraining and self.args["model"] in ["naivebayes", "sgd"]:
+            # train sklearn based model with partial_fit over minibatches for the defined number of epochs, naive bayes only sums up
+            # the feature counts per class, so every further pass would count the documents again and is skipped
+            num_epochs = epochs if self.args["model"] == "sgd" else 1
+            for i in range(num_epochs):
+                self.epoch = i
+                self.trainIncremental(train_data, train_target)
+                self.test_validate(val_data, val_mask, val_target, type= "validate", device= self.device)
+            self.test_validate(test_data, test_mask, test_target, type= "test", device= self.device)
+
         else:
+            if self.incrementalTraining:
+                logging.warning("{} does not support partial_fit, the model is trained with fit.".format(self.args["model"]))
             # train sklearn based model without epochs
-            self.train(train_data, train_mask, train_target, device=self.device)
+            self.train(train_data, train_mask, train_target, device=self.device, val_data= val_data, val_target= val_target)
             self.test_validate(val_data, val_mask, val_target, type="validate", device=self.device)
             self.test_validate(test_data, test_mask, test_target, type="test", device=self.device)
 
-    # function to save the model
-    def save(self, file_path: str):
+    # apply dynamic int8 quantization to the linear layers, the weights are stored as int8 and the activations are quantized on the fly.
+    # The quantized model only runs on the cpu, the original model is not changed.
+    def quantize(self):
+        import torch
+        model = copy.deepcopy(self.model).to("cpu").eval()
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    # example inputs for tracing and exporting, an unpadded example followed by longer padded ones
+    def exampleInputs(self, device= "cpu"):
+        import torch
+        example = "All the appetizers and salads were fabulous, the steak was mouth watering and the pasta was delicious!!! [SEP] Die Bewertung des Preises ist positiv."
+        inputs = list()
+        for length in [None, 64, 256]:
+            if length:
+                tokens = self.tokenizer(example, padding="max_length", truncation=True, max_length=min(length, self.max_length))
+            else:
+                tokens = self.tokenizer(example, truncation=True, max_length=self.max_length)
+            inputs.append((torch.tensor([tokens["input_ids"]]).to(device), torch.tensor([tokens["attention_mask"]]).to(device)))
+        return inputs
+
+    # trace the model with torchscript, the model is traced on a short example and checked on longer ones, so the traced model accepts all sequence lengths
+    def trace(self, model, device= "cpu"):
+        import torch
+        inputs = self.exampleInputs(device)
+        model.eval()
+        return torch.jit.trace(model, inputs[0], check_inputs=inputs[1:])
+
+    # export the model to onnx with dynamic batch and sequence axes. Opset 13 is the newest opset which torch 1.8 can export
+    # and onnxruntime 1.7 can run
+    def exportOnnx(self, file_path: str):
+        import torch
+        model = copy.deepcopy(self.model).to("cpu").eval()
+        dynamic_axes = {"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}, "logits": {0: "batch"}}
+        with torch.no_grad():
+            torch.onnx.export(model, self.exampleInputs("cpu")[0], file_path, input_names=["input_ids", "attention_mask"], output_names=["logits"],
+                              dynamic_axes=dynamic_axes, opset_version=13, do_constant_folding=True)
+
+    # function to save the model, with quantize the int8 version of the model is saved (with the suffix _int8) and with onnx the model is exported to onnx.
+    # Returns the path of the saved model file
+    def save(self, file_path: str, quantize: bool = False, onnx: bool = False):
+        if quantize:
+            file_path = file_path + "_int8"
+        if os.path.dirname(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok= True)
         if self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]:
-            # save as torchscript
-            tokens = self.tokenizer("All the appetizers and salads were fabulous, the steak was mouth watering and the pasta was delicious!!! [SEP] Die Bewertung des Preises ist positiv.", padding="max_length", max_length=512)
-            mask = torch.tensor([tokens["attention_mask"]]).to("cuda")
-            tokens = torch.tensor([tokens["input_ids"]]).to("cuda")
-            self.model.eval()
-            traced_model = torch.jit.trace(self.model, (tokens, mask))
-            traced_model.save(file_path + ".pt")
+            if onnx:
+                model_file = file_path + ".onnx"
+                self.exportOnnx(model_file)
+            else:
+                # save as torchscript
+                if quantize:
+                    traced_model = self.trace(self.quantize(), device="cpu")
+                else:
+                    traced_model = self.trace(self.model, device=self.device)
+                model_file = file_path + ".pt"
+                traced_model.save(model_file)
         else:
-            with open(file_path + ".pkl", 'wb') as file:
+            model_file = file_path + ".pkl"
+            with open(model_file, 'wb') as file:
                 pickle.dump(self.model, file)
 
-        pd.DataFrame(data=self.target_columns, columns=["target"]).to_csv(file_path[:-3] + "_targetConfig.csv")
+        pd.DataFrame(data=self.target_columns, columns=["target"]).to_csv(file_path + "_targetConfig.csv")
+        return model_file
 
-    # function to load saved model
-    def load(self, file_path):
-        if self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]:
-            self.model = torch.jit.load(file_path)
+    # load a saved model file, onnx files are run with onnx runtime
+    def loadModelFile(self, file_path, device= None):
+        if file_path.endswith(".onnx"):
+            return OnnxModel(file_path, intraOpThreads= self.onnxIntraOpThreads, interOpThreads= self.onnxInterOpThreads)
+        elif self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]:
+            import torch
+            return torch.jit.load(file_path, map_location=device if device else self.device)
         else:
             with open(file_path, 'rb') as file:
-                self.model = pickle.load(file)
+                return pickle.load(file)
 
-        self.target_columns = list(pd.read_csv(file_path[:-3] + "_targetConfig.csv")["target"])
+    # function to load saved model
+    def load(self, file_path):
+        self.model = self.loadModelFile(file_path)
+        self.target_columns = list(pd.read_csv(os.path.splitext(file_path)[0] + "_targetConfig.csv")["target"])
+
+    # compare the latency, throughput and macroF1 of different versions of the model (e.g. float32 and int8) on the same data
+    def benchmark(self, models: dict, data, target, device= "cpu"):
+        data, mask, target = self.preprocess(data, target, self.max_label_len, self.target_columns)
+        model, mixedPrecision = self.model, self.mixedPrecision
+        # the versions are compared without autocast, the quantized linear layers expect float32 inputs
+        self.mixedPrecision = False
+        report = dict()
+        try:
+            for name, version in models.items():
+                self.model = version
+                self.model.eval()
+                if self.smartBatching:
+                    dataloader = self.applySmartBatching(data, mask, target, text= "Benchmark {}:".format(name), shuffle= False)
+                else:
+                    dataloader = self.applyNormalBatching(data, mask, target, text= "Benchmark {}:".format(name))
+                start_time = time.perf_counter()
+                outputs, targets, batch_times = self.inference(dataloader, device)
+                total_time = time.perf_counter() - start_time
+                report[name] = {"macroF1": f1_score(np.argmax(targets, axis=1), np.argmax(outputs, axis=1), average= "macro"),
+                                "latency_ms_mean": 1000 * float(np.mean(batch_times)),
+                                "latency_ms_p50": 1000 * float(np.percentile(batch_times, 50)),
+                                "latency_ms_p95": 1000 * float(np.percentile(batch_times, 95)),
+                                "throughput_samples_per_sec": len(outputs) / total_time,
+                                "num_samples": len(outputs), "batch_size": self.train_batchSize}
+        finally:
+            self.model, self.mixedPrecision = model, mixedPrecision
+        return report
+
+    # compare saved model files on the given (test) data on the cpu and write the report next to the model
+    def benchmarkFiles(self, file_path: str, model_files: dict, data, target, report_name: str, details: dict = None):
+        import torch
+        models = {name: self.loadModelFile(model_file, device="cpu") for name, model_file in model_files.items()}
+        report = self.benchmark(models, data, target, device= "cpu")
+        report["size_mb"] = {name: os.path.getsize(model_file) / 1024 ** 2 for name, model_file in model_files.items()}
+        first, second = list(model_files.keys())[:2]
+        report["speedup"] = report[second]["throughput_samples_per_sec"] / report[first]["throughput_samples_per_sec"]
+        report["macroF1_difference"] = report[second]["macroF1"] - report[first]["macroF1"]
+        report["torch_threads"] = torch.get_num_threads()
+        report.update(details if details else dict())
+        with open("{}_{}_report.json".format(file_path, report_name), "w") as f:
+            json.dump(report, f, indent= 2)
+        return report
+
+    # compare the binary classification with and without prefix caching on the given (test) data and write the report next to the model
+    def benchmarkPrefixCaching(self, file_path: str, data, target, device= "cpu"):
+        from batching import restore_order
+        data, mask, target = self.preprocess(data, target, self.max_label_len, self.target_columns)
+        target = np.argmax(np.asarray(target), axis=1)
+        outputs, report = dict(), dict()
+        for name in ["full", "prefix_cached"]:
+            start_time = time.perf_counter()
+            if name == "prefix_cached":
+                outputs[name] = self.prefixCachedInference(data, device, text= "Benchmark {}:".format(name))
+            else:
+                self.model.eval()
+                dataloader = self.applyInferenceBatching(data, mask, index= np.arange(len(data)), text= "Benchmark {}:".format(name))
+                all_model_outputs, all_index, _ = self.inference(dataloader, device)
+                outputs[name] = restore_order(all_model_outputs, all_index)
+            total_time = time.perf_counter() - start_time
+            report[name] = {"macroF1": f1_score(target, np.argmax(outputs[name], axis=1), average= "macro"),
+                            "throughput_samples_per_sec": len(data) / total_time, "num_samples": len(data)}
+        report["speedup"] = report["prefix_cached"]["throughput_samples_per_sec"] / report["full"]["throughput_samples_per_sec"]
+        report["macroF1_difference"] = report["prefix_cached"]["macroF1"] - report["full"]["macroF1"]
+        report["max_abs_probability_difference"] = float(np.abs(outputs["prefix_cached"] - outputs["full"]).max())
+        report["prediction_agreement"] = float(np.mean(np.argmax(outputs["prefix_cached"], axis=1) == np.argmax(outputs["full"], axis=1)))
+        with open("{}_prefix_caching_report.json".format(file_path), "w") as f:
+            json.dump(report, f, indent= 2)
+        return report
+
+    # export the float32 and the dynamic int8 quantized model for the cpu inference and write a report which compares both on the given (test) data.
+    # A float32 model which is already saved (e.g. for exportOnnxRuntime) is given with fp32File
+    def exportQuantized(self, file_path: str, data, target, fp32File: str = None):
+        model_files = {"fp32": fp32File if fp32File else self.save(file_path), "int8": self.save(file_path, quantize= True)}
+        return self.benchmarkFiles(file_path, model_files, data, target, "quantization")
+
+    # export the model to torchscript and onnx and compare the cpu inference of torchscript and onnx runtime on the given (test) data,
+    # an already saved torchscript model is given with fp32File
+    def exportOnnxRuntime(self, file_path: str, data, target, fp32File: str = None):
+        model_files = {"torchscript": fp32File if fp32File else self.save(file_path), "onnx": self.save(file_path, onnx= True)}
+        return self.benchmarkFiles(file_path, model_files, data, target, "onnx", details= {"onnx_threads": {"intra_op": self.onnxIntraOpThreads, "inter_op": self.onnxInterOpThreads}})
 
     # function to predict new data
     def predict(self, data, device="cpu"):
-        # Fake target system
-        target = pd.DataFrame(data= np.zeros((data.shape[0], len(self.target_columns))), columns=self.target_columns)
+        # Fake target system (sparse matrices have no len)
+        num_texts = data.shape[0] if hasattr(data, "tocsr") else len(data)
+        target = pd.DataFrame(data= np.zeros((num_texts, len(self.target_columns))), columns=self.target_columns)
 
-        data, mask, target = self.preprocess(data, target, self.max_label_len)
+        data, mask, target = self.preprocess(data, target, self.max_label_len, self.target_columns)
 
-        if self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]:
-            start_index = pd.DataFrame(data= range(data.shape[0]), columns=["index"])
-            if self.smartBatching:
-                dataloader = self.applySmartBatching(data, mask, index= start_index, text="Do Inference")
-            else:
-                dataloader = self.applyNormalBatching(data, mask, text="Do Inference")
+        if self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"] and self.usePrefixCaching():
+            output = pd.DataFrame(data= self.prefixCachedInference(data, device, text= "Do Inference"), columns= self.target_columns)
+
+        elif self.args["model"] in ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]:
+            from batching import restore_order
+            dataloader = self.applyInferenceBatching(data, mask, index= np.arange(len(data)), text="Do Inference")
 
             if self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
                 self.model.eval()
@@ -518,49 +963,12 @@ class Model():
                     else:
                         self.model = self.model.eval()
 
-            all_model_outputs = []
-            all_index = []
-
-            with torch.no_grad():
-                for step, batch in enumerate(dataloader):
-                    data, mask, index = batch
-                    data = data.to(device)
-                    mask = mask.to(device)
-
-                    if self.args["binaryClassification"]:
-                        if self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
-                            model_output = []
-                            for i, label in enumerate(self.target_columns):
-                                ind_model_output = self.model(data[:, i, :], mask[:, i, :])[0]
-                                model_output.append(ind_model_output)
-                            model_output = torch.sigmoid(torch.cat(model_output, 1))
-
-                        else:
-                            model_output = []
-                            for i, label in enumerate(self.target_columns):
-                                ind_model_output = self.model[label](input_ids=data, attention_mask=mask)
-                                model_output.append(ind_model_output)
-                            model_output = torch.sigmoid(torch.cat(model_output, 0))
-                    else:
-                        if self.args["model"] in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
-                            model_output = self.model(input_ids=data, attention_mask=mask)[0]
-                            model_output = torch.sigmoid(model_output)
-
-                        else:
-                            model_output = self.model(input_ids=data, attention_mask=mask)
-                            model_output = torch.sigmoid(model_output)
-
-                    all_model_outputs.append(model_output.detach().cpu().numpy())
-                    all_index.append(index)
-
-            all_index = np.concatenate(all_index)
-            all_model_outputs = np.concatenate(all_model_outputs)
+            all_model_outputs, all_index, _ = self.inference(dataloader, device)
 
-            output = pd.DataFrame(index= all_index.flatten(), data= all_model_outputs, columns= self.target_columns)
-            output = output.reindex(start_index["index"].values)
+            output = pd.DataFrame(data= restore_order(all_model_outputs, all_index), columns= self.target_columns)
 
         else:
-            output = self.model.predict(data)
+            output = pd.DataFrame(data= self.predictScores(data), columns= self.target_columns)
 
         return output
 
@@ -1,7 +1,6 @@
-#TODO: fix fit transform problem allow to save tokenizer and preprocessor
+from startup import import_timer, ensure_nltk_data, startup_report
 
 import json
-import wandb
 import logging
 import os
 import sys
@@ -11,20 +10,11 @@ import time
 import pandas as pd
 import numpy as np
 
-from sklearn.model_selection import train_test_split
+# the heavy dependencies (e.g. torch) of the configured tokenizer and model are imported when they are created
+with import_timer("bundle"):
+    from bundle import load_bundle
 
-import torch
-from torch import optim
-
-from preprocessing import Preprocessor
-from tokenization import Tokenizer
-
-from modeling import Model
-
-from nltk import word_tokenize
 from nltk.tokenize import sent_tokenize
-import nltk
-nltk.download('punkt')
 
 def pd_load_multiple_files(path, encoding):
     if path.split(".")[-1] == "csv":
@@ -37,156 +27,152 @@ def pd_load_multiple_files(path, encoding):
         logging.error("{} datatype not supported.".format(path))
         sys.exit("{} datatype not supported.".format(path))
 
-#created custom to gain optimal benefit from precision recall tradeoff
-#decision_dict = {
-#        "ambience_neg": 0.34,
-#        "ambience_pos": 0.46,
-#        "drinks_neg": 0.13,
-#        "drinks_pos": 0.44,
-#        "food_neg": 0.42,
-#        "food_pos": 0.52,
-#        "price_neg": 0.44,
-#        "price_pos": 0.64,
-#        "quality_neg": 0.54,
-#        "quality_pos": 0.5,
-#        "restaurant_neg": 0.25,
-#        "restaurant_pos": 0.32,
-#        "service_neg": 0.5,
-#        "service_pos": 0.51
-#    }
-
-decision_dict = {
-        "ambience_neg": 0.4,
-        "ambience_pos": 0.4,
-        "drinks_neg": 0.4,
-        "drinks_pos": 0.4,
-        "food_neg": 0.4,
-        "food_pos": 0.4,
-        "price_neg": 0.4,
-        "price_pos": 0.4,
-        "quality_neg": 0.4,
-        "quality_pos": 0.4,
-        "restaurant_neg": 0.4,
-        "restaurant_pos": 0.4,
-        "service_neg": 0.4,
-        "service_pos": 0.4
-    }
-
-
-# for sensitive: reduce threshold by 20%
-#for key in decision_dict.keys():
-#    if "_neg" in key:
-#        decision_dict[key] = decision_dict[key] * 0.6
-#    else:
-#        decision_dict[key] = decision_dict[key] * 0.8
-
-if __name__ == "__main__":
+# the decision thresholds of the targets are saved in the inference bundle (bundle_thresholds of the training config),
+# for the restaurant reviews 0.4 was used for all targets (reduce them by 20% for a sensitive prediction)
 
-    filename = "Full_Competitor_Reviews_translated.csv"
-    data_columns = "text_german"
-
-    with open(r"config_experimentation.json") as f:
-        args = json.load(f)
-
-    tokenizer_model = args["tokenizer_model"].split("-")
-    if "%" in args["tokenizer_model"][0]:
-        preperation_technique = args["tokenizer_model"][0].split("%")[0]
-        preperation_ngram = args["tokenizer_model"][0].split("%")[1]
-    else:
-        preperation_technique = args["tokenizer_model"][0]
-        preperation_ngram = 0
-
-    if "%" in args["tokenizer_model"][1]:
-        use_bin_dict = {"Binary": True, "Multi": False}
-        model_technique = args["tokenizer_model"][1].split("%")[0]
-        model_useBinary = use_bin_dict[args["tokenizer_model"][1].split("%")[0]]
+# read the input in chunks of chunkSize rows, only csv files can be read in chunks the other file types are split after loading
+def pd_iterate_multiple_files(path, encoding, chunkSize):
+    if path.split(".")[-1] == "csv":
+        yield from pd.read_csv(path, encoding= encoding, chunksize= chunkSize)
     else:
-        model_technique = args["tokenizer_model"][1]
-        model_useBinary = False
-
-    random.seed(42)
-    np.random.seed(42)
-    torch.manual_seed(42)
-
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-    logging.info("prediction will be done on {}", device)
-
-    ## do the data loading
+        df = pd_load_multiple_files(path, encoding)
+        for start in range(0, len(df), chunkSize):
+            yield df.iloc[start:start + chunkSize]
 
-    # do preprocessing
-    ### train
-    predict_df = pd_load_multiple_files(os.path.join(args["data_path"], "predict", filename), encoding="utf-8")
-    predict_df = predict_df.dropna(subset= [data_columns], axis=0)
+# split the reviews of a chunk into sentences and predict them, returns the raw, the thresholded and the melted predictions
+def predict_chunk(chunk_df, data_columns, sentence_offset, bundle, device):
+    predict_df = chunk_df.dropna(subset= [data_columns], axis=0).copy()
 
     # split into sentences
-    print("Split sentences")
-    ##currently not used
-    #def spacy_sent_tokenize(text):
-    #    doc = nlp(text)
-    #    return [sent.string.strip() for sent in doc.sents]
-
-    #time.sleep(0.5)
-    predict_df[data_columns] = predict_df[data_columns].progress_apply(lambda x: sent_tokenize(x))
+    predict_df[data_columns] = predict_df[data_columns].apply(lambda x: sent_tokenize(x))
     predict_df = predict_df.explode(data_columns)
     predict_df = predict_df.reset_index(drop= True)
     predict_df = predict_df.reset_index(drop=False)
+    # the sentence index continues over the chunks
+    predict_df["index"] += sentence_offset
+    predict_df.index = predict_df["index"].values
+    num_sentences = len(predict_df)
 
     ## do the preprocessing
-    print("Preprocess")
-    preprocessor = Preprocessor(doLower= args["doLower"], doLemmatization= args["doLemmatization"], removeStopWords= args["removeStopWords"], doSpellingCorrection= args["doSpellingCorrection"], removeNewLine= args["removeNewLine"], removePunctuation=args["removePunctuation"], removeHtmlTags= args["removeHtmlTags"], minTextLength = args["minTextLength"])
-    predict_df["processed"] = preprocessor.fit_transform(predict_df["text_german"])
+    predict_df["processed"] = bundle.preprocessor.transform(predict_df[data_columns])
     predict_df = predict_df.dropna(subset=["processed"], axis=0)
+    if len(predict_df) == 0:
+        return None, None, None, num_sentences
 
-    print("Tokenize")
-    tokenizer = Tokenizer(tokenizeStr= preperation_technique, ngram= preperation_ngram, fasttextFile= args["fasttext_file"], doLower= args["doLower"])
-    predict_df["processed"] = tokenizer.fit_transform(predict_df["processed"])
-
-    ## for testing purposes
-    #train_df = train_df.sample(100)
-    #val_df = val_df.sample(20)
-    #test_df = test_df.sample(20)
+    ## do the tokenization with the tokenizer of the bundle
+    processed = bundle.tokenizer.transform(predict_df["processed"])
 
     ## apply the model
-    labels = ["price_pos", "price_neg", "quality_pos", "quality_neg", "restaurant_pos", "restaurant_neg", "food_pos", "food_neg", "drinks_pos", "drinks_neg", "ambience_pos",
-       "ambience_neg", "service_pos", "service_neg"]
-    sentimentDict = {"pos": "positiv", "neu": "neutral", "neg": "negativ", "con": "uneinig"}
-    cathegoryDict = {"price": "des Preises", "quality": "der Qualität", "restaurant": "des Restaurants", "food": "des Essens", "drinks": "der Getränke", "ambience": "des Ambientes", "service": "des Service"}
-    texts = ["Die Bewertung {} ist {}.".format(cathegoryDict[x.split("_")[0]], sentimentDict[x.split("_")[1]]) for x in labels]
-    labelSentencesDict = dict(zip(labels, texts))
-    max_label_len = max([len(word_tokenize(x)) for x in labelSentencesDict.values()])
-
-    print("Make Predictions")
-    model = Model(binaryClassification= model_useBinary, model_str= model_technique, doLower= args["doLower"], train_batchSize= args["train_batchSize"], testval_batchSize= args["testval_batchSize"], learningRate= args["learningRate"], doLearningRateScheduler= args["doLearningRateScheduler"], labelSentences= labelSentencesDict, smartBatching=args["smartBatching"], max_label_len= max_label_len, device= device)
-
-    model.load(os.path.join(args["model_path"], "apple-flambee-545.pt"))
-
-    pred = model.predict(data=predict_df["processed"], device= device)
+    pred = bundle.model.predict(data= processed, device= device)
+    pred.index = predict_df.index
 
-    pd.concat((predict_df.reset_index(drop= True), pred), axis= 1).to_csv(os.path.join(args["data_path"], "predict", filename[:-4] + "_predictions_raw.csv"))
+    raw_df = pd.concat((predict_df, pred), axis= 1)
 
-    def logits_to_pred(column):
-        thrshld = decision_dict[column.name]
-        return (column > thrshld).astype(int)
+    pred = pd.concat((pred, pred.apply(lambda column: (column > bundle.thresholds[column.name]).astype(int), axis= 0).add_suffix("_pred")), axis=1)
 
-    pred = pd.concat((pred, pred.apply(logits_to_pred, axis= 0).add_suffix("_pred")), axis=1)
-
-    for category in ["ambience", "drinks", "food", "price", "quality", "restaurant", "service"]:
-        pred[category] = np.nan
+    # targets with a positive and a negative column (e.g. food_pos and food_neg) are combined into one sentiment
+    categories = [x[:-4] for x in bundle.target_columns if x.endswith("_pos") and x[:-4] + "_neg" in bundle.target_columns]
+    for category in categories:
+        pred[category] = pd.Series(np.nan, index= pred.index, dtype= object)
         pred.loc[(pred["{}_pos_pred".format(category)] != pred["{}_neg_pred".format(category)]) & (pred["{}_pos_pred".format(category)] == 1), category] = "positive"
         pred.loc[(pred["{}_pos_pred".format(category)] != pred["{}_neg_pred".format(category)]) & (pred["{}_pos_pred".format(category)] == 0), category] = "negative"
         pred.loc[(pred["{}_pos_pred".format(category)] == pred["{}_neg_pred".format(category)]) & (pred["{}_pos_pred".format(category)] == 0), category] = "neutral"
         pred.loc[(pred["{}_pos_pred".format(category)] == pred["{}_neg_pred".format(category)]) & (pred["{}_pos_pred".format(category)] == 1), category] = "conflict"
 
-    export_df = pd.concat((predict_df.reset_index(drop= True), pred), axis=1)
+    export_df = pd.concat((predict_df, pred), axis=1)
     # drop unnecessary Unnamed columns
     export_df = export_df.rename({"Unnamed: 0": "review_id"}, axis= 1)
     export_df = export_df.drop([x for x in export_df.columns if "Unnamed" in x], axis= 1)
 
-    export_df.to_csv(os.path.join(args["data_path"], "predict", filename[:-4] + "_predictions.csv"))
-
     ind_vars = ["name", "review_id", "reviewRating", "Review Date", "reviewUrl", "text_german", "lang", "address"]
-    pred_vars = ['ambience', 'drinks', 'food', 'price', 'quality', 'restaurant', 'service']
-    export_df = export_df.drop(list(set(export_df.columns) - set(ind_vars + pred_vars)), axis= 1)
-    export_df = export_df.melt(id_vars= ind_vars, var_name="type", value_name="value")
-    export_df.to_csv(os.path.join(args["data_path"], "predict", filename[:-4] + "_predictions_melted.csv"))
\ No newline at end of file
+    pred_vars = categories if categories else [x + "_pred" for x in bundle.target_columns]
+    melted_df = export_df.drop(list(set(export_df.columns) - set(ind_vars + pred_vars)), axis= 1)
+    melted_df = melted_df.melt(id_vars= [x for x in ind_vars if x in melted_df.columns], var_name="type", value_name="value")
+    return raw_df, export_df, melted_df, num_sentences
+
+# the progress holds the number of finished chunks and the size of the output files after the last finished chunk
+def load_progress(progress_file, input_file, chunkSize):
+    input_stat = os.stat(input_file)
+    progress = {"input_file": os.path.abspath(input_file), "input_size": input_stat.st_size, "input_mtime": input_stat.st_mtime, "chunkSize": chunkSize,
+                "chunks_done": 0, "sentences_done": 0, "output_sizes": dict()}
+    if os.path.exists(progress_file):
+        with open(progress_file) as f:
+            saved = json.load(f)
+        if all(saved.get(x) == progress[x] for x in ["input_file", "input_size", "input_mtime", "chunkSize"]):
+            return saved
+        logging.warning("the input file or the chunk size changed, the prediction is started from the beginning")
+    return progress
+
+def save_progress(progress_file, progress):
+    with open(progress_file + ".tmp", "w") as f:
+        json.dump(progress, f, indent= 2)
+    os.replace(progress_file + ".tmp", progress_file)
+
+# output files are cut to the size after the last finished chunk, so rows of an interrupted chunk are not written twice. An output
+# file which was deleted (or cut) after the progress was saved misses the rows of the finished chunks, the prediction is not resumed
+def prepare_output_files(output_files, progress, progress_file):
+    for output_file in output_files:
+        size = progress["output_sizes"].get(output_file, 0)
+        if size == 0:
+            if os.path.exists(output_file):
+                os.remove(output_file)
+        elif not os.path.exists(output_file) or os.path.getsize(output_file) < size:
+            logging.error("The output file {} is missing or shorter than recorded in {}, delete the progress file to start the prediction from the beginning.".format(output_file, progress_file))
+            sys.exit("The output file {} is missing or shorter than recorded in {}, delete the progress file to start the prediction from the beginning.".format(output_file, progress_file))
+        else:
+            with open(output_file, "r+b") as f:
+                f.truncate(size)
+
+
+if __name__ == "__main__":
+    # get all the configuration details from the config.json file
+    with open(r"config.json") as f:
+        args = json.load(f)
+
+    # the sentence tokenizer data of nltk is only downloaded if it is missing
+    ensure_nltk_data("punkt", "tokenizers/punkt")
+
+    filename = args["predict_file"]
+    data_columns = args["predict_column"]
+
+    # the tokenizer and the model are configured by the bundle
+    random.seed(42)
+    np.random.seed(42)
+
+    logging.basicConfig(level= logging.INFO)
+
+    ## load the preprocessor, the tokenizer and the model of the bundle once, they are applied to every chunk
+    bundle = load_bundle(os.path.join(args["model_path"], args["predict_bundle"]), batchSize= args["testval_batchSize"], bucketBoundaries= args["dataloader_bucketBoundaries"],
+                         foldLabelSentences= args["binary_foldLabelSentences"], maxForwardBatch= args["binary_maxForwardBatch"], inferenceMaxTokens= args["inference_maxTokens"],
+                         onnxIntraOpThreads= args["onnx_intraOpThreads"], onnxInterOpThreads= args["onnx_interOpThreads"])
+    # the device is chosen by the model of the bundle, only the torch models are run on cuda
+    device = bundle.model.device
+    logging.info("prediction will be done on {}".format(device))
+
+    # log the time until the prediction starts and the time of every (lazy) import
+    startup_report()
+
+    ## stream the input file in chunks, the results of every chunk are appended to the output files
+    input_file = os.path.join(args["data_path"], "predict", filename)
+    output_base = os.path.join(args["data_path"], "predict", filename[:-4])
+    output_files = {"raw": output_base + "_predictions_raw.csv", "export": output_base + "_predictions.csv", "melted": output_base + "_predictions_melted.csv"}
+    progress_file = output_base + "_predictions_progress.json"
+
+    progress = load_progress(progress_file, input_file, args["predict_chunkSize"])
+    prepare_output_files(output_files.values(), progress, progress_file)
+    if progress["chunks_done"] > 0:
+        print("Resume after chunk {} ({} sentences)".format(progress["chunks_done"], progress["sentences_done"]))
+
+    for i, chunk_df in enumerate(pd_iterate_multiple_files(input_file, "utf-8", args["predict_chunkSize"])):
+        if i < progress["chunks_done"]:
+            continue
+        print("Predict chunk {}".format(i))
+        outputs = predict_chunk(chunk_df, data_columns, progress["sentences_done"], bundle, device)
+        for name, output_df in zip(["raw", "export", "melted"], outputs[:3]):
+            if output_df is not None:
+                # the header is only written into a new file
+                output_df.to_csv(output_files[name], mode= "a", header= not os.path.exists(output_files[name]))
+        progress["chunks_done"] = i + 1
+        progress["sentences_done"] += outputs[3]
+        progress["output_sizes"] = {x: os.path.getsize(x) if os.path.exists(x) else 0 for x in output_files.values()}
+        save_progress(progress_file, progress)
@@ -1,4 +1,4 @@
-import spacy
+import multiprocessing
 import pandas as pd
 import numpy as np
 from string import punctuation
@@ -7,24 +7,46 @@ from tqdm import tqdm
 tqdm.pandas()
 from nltk import word_tokenize
 
-import en_core_web_md
+from startup import import_timer
 
-import pkg_resources
-from symspellpy import SymSpell, Verbosity
+# the spelling correction dictionaries are large, they are only loaded (once per process) if the spelling correction is used
+sym_spell = None
 
-sym_spell = SymSpell(max_dictionary_edit_distance=2, prefix_length=7)
-dictionary_path = pkg_resources.resource_filename(
-    "symspellpy", "frequency_dictionary_en_82_765.txt")
-bigram_path = pkg_resources.resource_filename(
-    "symspellpy", "frequency_bigramdictionary_en_243_342.txt")
-# term_index is the column of the term and count_index is the
-# column of the term frequency
-sym_spell.load_dictionary(dictionary_path, term_index=0, count_index=1)
-sym_spell.load_bigram_dictionary(bigram_path, term_index=0, count_index=2)
+def get_sym_spell():
+    global sym_spell
+    if sym_spell is None:
+        with import_timer("symspellpy"):
+            import pkg_resources
+            from symspellpy import SymSpell
+        sym_spell = SymSpell(max_dictionary_edit_distance=2, prefix_length=7)
+        dictionary_path = pkg_resources.resource_filename(
+            "symspellpy", "frequency_dictionary_en_82_765.txt")
+        bigram_path = pkg_resources.resource_filename(
+            "symspellpy", "frequency_bigramdictionary_en_243_342.txt")
+        # term_index is the column of the term and count_index is the
+        # column of the term frequency
+        sym_spell.load_dictionary(dictionary_path, term_index=0, count_index=1)
+        sym_spell.load_bigram_dictionary(bigram_path, term_index=0, count_index=2)
+    return sym_spell
+
+
+# components of the spacy pipeline which are needed to get the lemmas, all others are disabled during nlp.pipe
+lemmatizer_components = ["tok2vec", "tagger", "attribute_ruler", "lemmatizer"]
+
+# every worker process of the pool holds its own fitted preprocessor
+worker_preprocessor = None
+
+def init_worker(config: dict):
+    global worker_preprocessor
+    worker_preprocessor = Preprocessor(**config)
+    worker_preprocessor.fit(None)
+
+def process_worker_batch(texts: list):
+    return worker_preprocessor.process_batch(texts)
 
 
 class Preprocessor():
-    def __init__(self, doLower: bool, removeStopWords: bool, doLemmatization: bool, doSpellingCorrection: bool, removeNewLine: bool, removePunctuation: bool, removeHtmlTags: bool, minTextLength: bool, maxTextLength= None):
+    def __init__(self, doLower: bool, removeStopWords: bool, doLemmatization: bool, doSpellingCorrection: bool, removeNewLine: bool, removePunctuation: bool, removeHtmlTags: bool, minTextLength: bool, maxTextLength= None, doBatchProcessing: bool = False, batchSize: int = 1000, numWorkers: int = 1):
         self.doLower = doLower
         self.removeStopWords = removeStopWords
         self.doLemmatization = doLemmatization
@@ -34,38 +56,91 @@ class Preprocessor():
         self.removeHtmlTags = removeHtmlTags
         self.minTextLength = minTextLength
         self.maxTextLength = maxTextLength
+        self.doBatchProcessing = doBatchProcessing
+        self.batchSize = batchSize
+        self.numWorkers = numWorkers
         self.processor = None
+        self.nlp = None
+        self.stop_words = None
+
+    # arguments needed to recreate the preprocessor (e.g. in a worker process)
+    def get_config(self):
+        return {"doLower": self.doLower, "removeStopWords": self.removeStopWords, "doLemmatization": self.doLemmatization, "doSpellingCorrection": self.doSpellingCorrection,
+                "removeNewLine": self.removeNewLine, "removePunctuation": self.removePunctuation, "removeHtmlTags": self.removeHtmlTags, "minTextLength": self.minTextLength,
+                "maxTextLength": self.maxTextLength, "doBatchProcessing": self.doBatchProcessing, "batchSize": self.batchSize, "numWorkers": self.numWorkers}
+
+    # string level cleaning which is done before the tokenization
+    def clean_text(self, text):
+        if self.removeHtmlTags:
+            text = text.replace("&lt;", "").replace("&gt;", "").replace("&amp;", "")
+        if self.removeNewLine:
+            text = text.replace("\n", "")
+        if self.doLower:
+            text = text.lower()
+        if self.doSpellingCorrection:
+            suggestions = get_sym_spell().lookup_compound(text, max_edit_distance=2)
+            text = suggestions[0].term
+        return text
+
+    # token level cleaning which is done after the tokenization, returns the joined text
+    def join_tokens(self, text_tokens):
+        if self.removeStopWords:
+            text_tokens = [word for word in text_tokens if not word in self.stop_words]
+        if self.removePunctuation:
+            text_tokens = [word for word in text_tokens if not word in punc]
+        text_tokens = [x for x in text_tokens if not x == " "]
+        output = ''.join(w if set(w) <= punc else ' '+w for w in text_tokens).lstrip()
+        if self.maxTextLength:
+            output = output[:self.maxTextLength]
+        return output
 
     def fit(self, series: pd.Series):
-        self.nlp = en_core_web_md.load()
+        # the spacy model is only loaded for the lemmatization, the stop words are the defaults of the english language
+        if self.doLemmatization:
+            with import_timer("en_core_web_md"):
+                import en_core_web_md
+            self.nlp = en_core_web_md.load()
+            self.stop_words = self.nlp.Defaults.stop_words
+        elif self.removeStopWords:
+            with import_timer("spacy"):
+                from spacy.lang.en import English
+            self.stop_words = English.Defaults.stop_words
+        if self.doSpellingCorrection:
+            get_sym_spell()
         def processor(text):
-            if self.removeHtmlTags:
-                text = text.replace("&lt;", "").replace("&gt;", "").replace("&amp;", "")
-            if self.removeNewLine:
-                text = text.replace("\n", "")
-            if self.doLower:
-                text = text.lower()
-            if self.doSpellingCorrection:
-                suggestions = sym_spell.lookup_compound(text, max_edit_distance=2)
-                text = suggestions[0].term
+            text = self.clean_text(text)
             if self.doLemmatization:
                 text_tokens = self.nlp(text)
                 text_tokens = [token.lemma_ for token in text_tokens]
             else:
                 text_tokens = word_tokenize(text)
-            if self.removeStopWords:
-                text_tokens = [word for word in text_tokens if not word in self.nlp.Defaults.stop_words]
-            if self.removePunctuation:
-                text_tokens = [word for word in text_tokens if not word in punc]
-            text_tokens = [x for x in text_tokens if not x == " "]
-            output = ''.join(w if set(w) <= punc else ' '+w for w in text_tokens).lstrip()
-            if self.maxTextLength:
-                output = output[:self.maxTextLength]
-            return output
+            return self.join_tokens(text_tokens)
         self.processor = processor
 
+    # process a list of texts at once, the lemmatization streams the texts through nlp.pipe with only the needed components
+    def process_batch(self, texts: list):
+        texts = [self.clean_text(text) for text in texts]
+        if self.doLemmatization:
+            disable = [name for name in self.nlp.pipe_names if name not in lemmatizer_components]
+            docs = self.nlp.pipe(texts, batch_size= self.batchSize, disable= disable)
+            text_tokens = [[token.lemma_ for token in doc] for doc in docs]
+        else:
+            text_tokens = [word_tokenize(text) for text in texts]
+        return [self.join_tokens(tokens) for tokens in text_tokens]
+
     def transform(self, series: pd.Series):
-        temp = series.progress_apply(self.processor)
+        if self.doBatchProcessing:
+            texts = list(series)
+            chunks = [texts[i:i + self.batchSize] for i in range(0, len(texts), self.batchSize)]
+            if self.numWorkers > 1:
+                # imap keeps the order of the chunks
+                with multiprocessing.Pool(self.numWorkers, initializer= init_worker, initargs= (self.get_config(),)) as pool:
+                    processed = list(tqdm(pool.imap(process_worker_batch, chunks), total= len(chunks), desc= "Preprocess batches"))
+            else:
+                processed = [self.process_batch(chunk) for chunk in tqdm(chunks, desc= "Preprocess batches")]
+            temp = pd.Series([text for chunk in processed for text in chunk], index= series.index, dtype= object)
+        else:
+            temp = series.progress_apply(self.processor)
         temp[temp.apply(len) < self.minTextLength] = np.nan
         return temp.values
 
@@ -0,0 +1,248 @@
+from startup import ensure_nltk_data, get_device
+
+import os
+import gc
+import json
+import math
+import time
+import logging
+import argparse
+
+import numpy as np
+import yaml
+
+import tracking
+import main
+import sweep
+from caching import ArtifactCache
+
+# multi-fidelity scheduler for the transformer sweeps (successive halving and hyperband). All trials of a rung are trained to the same
+# (fractional) epoch and are validated on a fixed subsample of the validation data, only the best 1 / eta of them are trained further.
+# The training state of a trial is saved as checkpoint after every rung, a promoted trial resumes at its checkpoint (epoch and batch).
+# Only one model is in memory at a time. The trials of a rung are ordered by their preprocessing and tokenization key, so the data is
+# shared by the trials with the same key which follow each other and only the data of the current key is kept in memory.
+
+# the data of the current preprocessing and tokenization key
+memory = dict()
+
+
+class Trial():
+    def __init__(self, trial_id: str, args: dict, parameters: dict, checkpoint_dir: str):
+        self.trial_id = trial_id
+        self.args = args
+        self.parameters = parameters
+        self.tokenizer_model = main.parse_tokenizer_model(args["tokenizer_model"])
+        self.device = get_device(self.tokenizer_model["model"])
+        self.checkpoint_file = os.path.join(checkpoint_dir, "{}.pt".format(trial_id))
+        self.epoch = 0.0
+        # (epoch, validation score on the subsample) of every rung
+        self.history = list()
+        self.status = "running"
+        self.metrics = dict()
+        self.seconds = 0.0
+
+    # wandb run of the trial, the run is resumed for every rung
+    def start_run(self, project: str):
+        if not tracking.use_wandb:
+            return None
+        import wandb
+        return wandb.init(project= project, entity= 'faruman', config= self.args, id= self.trial_id, resume= "allow", reinit= True)
+
+    # preprocessing and tokenization key of the data of the trial
+    def data_keys(self, cache: ArtifactCache):
+        keys = main.artifact_keys(self.args, self.tokenizer_model, cache)
+        return keys["preprocessing"], keys["tokenization"]
+
+    # create the model of the trial and its data, the training state is loaded from the checkpoint of the last rung
+    def load(self, cache: ArtifactCache):
+        # the data of other keys is removed, it is loaded again from the cache if a later trial needs it
+        for key in [x for x in memory.keys() if x not in self.data_keys(cache)]:
+            del memory[key]
+        main.set_seeds(42)
+        artifacts = main.load_artifacts(self.args, self.tokenizer_model, cache, memory)
+        model = main.create_model(self.args, self.tokenizer_model, self.device)
+        data = {name: model.preprocess(artifacts["{}_data".format(name)], artifacts["{}_target".format(name)], model.max_label_len, model.target_columns) for name in ["train", "val", "test"]}
+        model.prepareTraining(data["train"][0], self.args["numEpochs"])
+        if os.path.exists(self.checkpoint_file):
+            model.loadCheckpoint(self.checkpoint_file)
+        return model, data
+
+    # train the trial until the given epoch (resuming at its checkpoint) and return the score on the validation subsample
+    def advance(self, untilEpoch: float, cache: ArtifactCache, val_indices: dict, project: str = None):
+        hook = self.metrics.update
+        tracking.hooks.append(hook)
+        run = self.start_run(project)
+        start_time = time.perf_counter()
+        model = data = None
+        try:
+            model, data = self.load(cache)
+            model.trainUntil(*data["train"], untilEpoch, device= self.device)
+            model.saveCheckpoint(self.checkpoint_file)
+
+            val_data, _, val_target = data["val"]
+            indices = val_indices.setdefault(len(val_data), subsample_indices(len(val_data), self.args["scheduler_valSubsample"]))
+            scores = model.test_validate(val_data.subset(indices), None, val_target[indices], type= "rung", device= self.device, use_wandb= False)
+            self.epoch = untilEpoch
+            self.history.append((untilEpoch, scores["rung_macroF1"]))
+            tracking.log({"rung_epoch": untilEpoch, **scores})
+            return scores["rung_macroF1"]
+        finally:
+            self.seconds += time.perf_counter() - start_time
+            tracking.hooks.remove(hook)
+            if run:
+                run.finish()
+            model = data = None
+            release()
+
+    # validate and test the trial which survived its bracket on the full validation and test data
+    def finish(self, cache: ArtifactCache, project: str = None):
+        hook = self.metrics.update
+        tracking.hooks.append(hook)
+        run = self.start_run(project)
+        model = data = None
+        try:
+            model, data = self.load(cache)
+            model.test_validate(*data["val"], type= "validate", device= self.device)
+            model.test_validate(*data["test"], type= "test", device= self.device)
+            tracking.log({'finished': True})
+            self.status = "finished"
+        finally:
+            tracking.hooks.remove(hook)
+            if run:
+                run.finish()
+            model = data = None
+            release()
+
+    def remove_checkpoint(self):
+        if os.path.exists(self.checkpoint_file):
+            os.remove(self.checkpoint_file)
+
+    def result(self):
+        return {"trial_id": self.trial_id, "parameters": self.parameters, "status": self.status, "epoch": self.epoch, "history": self.history, "seconds": self.seconds, "metrics": self.metrics}
+
+
+# fixed random subsample of the validation data which is used at every rung
+def subsample_indices(size: int, subsample: int, seed: int = 42):
+    if not subsample or subsample >= size:
+        return np.arange(size)
+    return np.sort(np.random.default_rng(seed).choice(size, subsample, replace= False))
+
+# free the memory of the last model before the next trial is loaded
+def release():
+    import torch
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+# successive halving over the trials, starting with minEpochs and multiplying the epochs by eta every rung up to maxEpochs.
+# The best trial of the last rung is validated and tested on the full data, the results of all trials are written to output
+def successive_halving(trials: list, minEpochs: float, maxEpochs: float, eta: int, cache: ArtifactCache, project: str = None, output: str = None):
+    val_indices = dict()
+    rung = 0
+    while trials:
+        epoch = minEpochs * eta ** rung
+        # rounding errors (e.g. 3 * 3 ** -2 * 3 ** 2) must not add a rung just below maxEpochs
+        if epoch >= maxEpochs * (1 - 1e-6):
+            epoch = maxEpochs
+        print("Rung {}: train {} trials until epoch {:.3f}".format(rung, len(trials), epoch))
+        trials.sort(key= lambda trial: trial.data_keys(cache))
+        scores = list()
+        for trial in trials:
+            try:
+                scores.append((trial.advance(epoch, cache, val_indices, project), trial))
+            except Exception as e:
+                logging.exception("trial {} failed".format(trial.parameters))
+                trial.status, trial.metrics["error"] = "failed", str(e)
+                trial.remove_checkpoint()
+                write_result(trial, output)
+        scores.sort(key= lambda x: x[0], reverse= True)
+
+        if epoch >= maxEpochs:
+            if scores:
+                scores[0][1].finish(cache, project)
+            for _, trial in scores[1:]:
+                trial.status = "stopped"
+            for _, trial in scores:
+                trial.remove_checkpoint()
+                write_result(trial, output)
+            break
+
+        keep = max(int(len(scores) / eta), 1)
+        for _, trial in scores[keep:]:
+            trial.status = "pruned"
+            trial.remove_checkpoint()
+            write_result(trial, output)
+        trials = [trial for _, trial in scores[:keep]]
+        rung += 1
+
+def write_result(trial: Trial, output: str):
+    if output:
+        with open(output, "a") as f:
+            f.write(json.dumps(trial.result(), default= str) + "\n")
+
+
+# hyperband runs successive halving brackets with different trade offs between the number of trials and their minimal epochs
+def hyperband_brackets(minEpochs: float, maxEpochs: float, eta: int):
+    s_max = int(math.floor(math.log(maxEpochs / minEpochs, eta) + 1e-9))
+    brackets = list()
+    for s in range(s_max, -1, -1):
+        num_trials = int(math.ceil((s_max + 1) / (s + 1) * eta ** s))
+        brackets.append((num_trials, maxEpochs * eta ** -s))
+    return brackets
+
+def create_trials(base_args: dict, sweep_config: dict, count: int, checkpoint_dir: str, maxEpochs: float, seed: int, prefix: str):
+    trials = list()
+    # the number of epochs is set by the scheduler, the learning rate schedule is created for maxEpochs
+    for i, parameters in enumerate(sweep.create_trials(dict(sweep_config, method= "random"), count, seed)):
+        args = dict(base_args, **parameters)
+        if main.parse_tokenizer_model(args["tokenizer_model"])["model"] not in ["distilbert", "bert", "xlnet", "roberta", "distilroberta"]:
+            logging.warning("{} is skipped, the scheduler only trains the transformer models (use sweep.py for the others).".format(parameters))
+            continue
+        args["numEpochs"] = int(math.ceil(maxEpochs))
+        trials.append(Trial("{}_{}".format(prefix, i), args, parameters, checkpoint_dir))
+    return trials
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description= "Successive halving and hyperband for the transformer sweeps, weak trials are stopped after a part of an epoch.")
+    parser.add_argument("--sweep", default= "sweep_transformer.yaml", help= "sweep yaml whose parameters are sampled")
+    parser.add_argument("--config", default= "config.json", help= "config with the values of all parameters which are not part of the sweep")
+    parser.add_argument("--mode", default= "hyperband", choices= ["hyperband", "successive_halving"])
+    parser.add_argument("--count", type= int, default= 27, help= "number of trials of successive halving")
+    parser.add_argument("--minEpochs", type= float, default= None, help= "epochs of the first rung, default is scheduler_minEpochs of the config")
+    parser.add_argument("--maxEpochs", type= float, default= None, help= "epochs of the last rung, default is numEpochs of the config")
+    parser.add_argument("--eta", type= int, default= None, help= "only the best 1 / eta trials of a rung are promoted, default is scheduler_eta of the config")
+    parser.add_argument("--offline", action= "store_true", help= "do not use wandb, the metrics are only written to the results file")
+    parser.add_argument("--project", default= "NewsClassification", help= "wandb project of the trials")
+    parser.add_argument("--output", default= "scheduler_results.jsonl", help= "every finished or stopped trial is appended to this file")
+    parser.add_argument("--seed", type= int, default= 42, help= "seed of the sampling of the trials")
+    cli_args = parser.parse_args()
+
+    logging.basicConfig(level= logging.INFO)
+    with open(cli_args.config) as f:
+        base_args = json.load(f)
+    with open(cli_args.sweep) as f:
+        sweep_config = yaml.safe_load(f)
+    minEpochs = cli_args.minEpochs if cli_args.minEpochs else base_args["scheduler_minEpochs"]
+    maxEpochs = cli_args.maxEpochs if cli_args.maxEpochs else base_args["numEpochs"]
+    eta = cli_args.eta if cli_args.eta else base_args["scheduler_eta"]
+
+    tracking.use_wandb = not cli_args.offline
+    ensure_nltk_data("punkt", "tokenizers/punkt")
+    cache = ArtifactCache(os.path.join(base_args["data_path"], "temp"), maxSizeGB= base_args["cache_maxSizeGB"])
+    checkpoint_dir = os.path.join(base_args["model_path"], "checkpoints")
+    os.makedirs(checkpoint_dir, exist_ok= True)
+    prefix = "sched{}".format(int(time.time()))
+
+    if cli_args.mode == "successive_halving":
+        brackets = [(cli_args.count, minEpochs)]
+    else:
+        brackets = hyperband_brackets(minEpochs, maxEpochs, eta)
+
+    for i, (num_trials, bracket_minEpochs) in enumerate(brackets):
+        print("Bracket {}: {} trials starting with {:.3f} epochs".format(i, num_trials, bracket_minEpochs))
+        trials = create_trials(base_args, sweep_config, num_trials, checkpoint_dir, maxEpochs, cli_args.seed + i, "{}_b{}".format(prefix, i))
+        successive_halving(trials, bracket_minEpochs, maxEpochs, eta, cache, cli_args.project, cli_args.output)
+
+    print("Results are in {}".format(cli_args.output))
@@ -0,0 +1,187 @@
+from startup import import_timer, ensure_nltk_data, startup_report
+
+import json
+import logging
+import os
+import time
+import queue
+import threading
+import collections
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+
+import numpy as np
+
+with import_timer("bundle"):
+    from bundle import load_bundle
+
+
+# collects the texts of concurrent requests into micro batches, a batch is run as soon as it holds maxBatchSize texts
+# or the first request of the batch waited maxWaitMs. The model is only called from the worker thread.
+class MicroBatcher():
+    def __init__(self, predict_fn, maxBatchSize: int = 64, maxWaitMs: float = 10, latencyWindow: int = 10000):
+        self.predict_fn = predict_fn
+        self.maxBatchSize = maxBatchSize
+        self.maxWait = maxWaitMs / 1000
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # latencies (in seconds) of the last requests and sizes of the last batches
+        self.latencies = collections.deque(maxlen= latencyWindow)
+        self.batch_sizes = collections.deque(maxlen= latencyWindow)
+        self.num_requests = 0
+        self.num_texts = 0
+        self.num_errors = 0
+        self.worker = threading.Thread(target= self.run, daemon= True)
+        self.worker.start()
+
+    # queue the texts of one request, the future is resolved with one prediction per text
+    def submit(self, texts: list):
+        future = Future()
+        self.queue.put((texts, future, time.perf_counter()))
+        return future
+
+    def collect_batch(self):
+        batch = [self.queue.get()]
+        num_texts = len(batch[0][0])
+        deadline = time.perf_counter() + self.maxWait
+        while num_texts < self.maxBatchSize:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self.queue.get(timeout= remaining)
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_texts += len(request[0])
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect_batch()
+            texts = [text for request in batch for text in request[0]]
+            try:
+                predictions = self.predict_fn(texts)
+            except Exception as e:
+                logging.exception("prediction of a batch failed")
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                with self.lock:
+                    self.num_errors += len(batch)
+                continue
+
+            start = 0
+            now = time.perf_counter()
+            with self.lock:
+                for request_texts, future, arrival in batch:
+                    future.set_result(predictions[start:start + len(request_texts)])
+                    start += len(request_texts)
+                    self.latencies.append(now - arrival)
+                self.batch_sizes.append(len(texts))
+                self.num_requests += len(batch)
+                self.num_texts += len(texts)
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = np.array(self.batch_sizes)
+            metrics = {"requests": self.num_requests, "texts": self.num_texts, "errors": self.num_errors, "queue_depth": self.queue.qsize(),
+                       "batch_size_mean": float(batch_sizes.mean()) if len(batch_sizes) else None}
+        metrics["latency_ms"] = {"p{}".format(p): float(np.percentile(latencies, p)) if len(latencies) else None for p in [50, 90, 95, 99]}
+        return metrics
+
+
+# preprocessing, tokenization and model of an inference bundle which are loaded once and applied to a list of texts
+class InferencePipeline():
+    def __init__(self, args: dict, device= None):
+        self.bundle = load_bundle(args["serve_bundle"], device= device, batchSize= args["serve_maxBatchSize"], bucketBoundaries= args["dataloader_bucketBoundaries"],
+                                  foldLabelSentences= args["binary_foldLabelSentences"], maxForwardBatch= args["binary_maxForwardBatch"], inferenceMaxTokens= args["inference_maxTokens"],
+                                  onnxIntraOpThreads= args["onnx_intraOpThreads"], onnxInterOpThreads= args["onnx_interOpThreads"])
+        # without device the model of the bundle decides it (cuda is only used for the torch models)
+        self.device = self.bundle.model.device
+
+    # returns one dict of target probabilities per text, texts which are too short after the preprocessing get None
+    def __call__(self, texts: list):
+        return self.bundle.predict(texts, device= self.device)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    batcher = None
+    timeout_s = 60
+
+    def send_json(self, status: int, content: dict):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            self.send_json(200, self.batcher.metrics())
+        else:
+            self.send_json(404, {"error": "unknown path {}".format(self.path)})
+
+    # accepts {"text": "..."} or {"texts": ["...", ...]}
+    def do_POST(self):
+        if self.path != "/predict":
+            self.send_json(404, {"error": "unknown path {}".format(self.path)})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            texts = [request["text"]] if "text" in request else list(request["texts"])
+            if not all(isinstance(x, str) for x in texts):
+                raise ValueError("texts need to be strings")
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {"error": "invalid request: {}".format(e)})
+            return
+        if len(texts) == 0:
+            self.send_json(200, {"predictions": []})
+            return
+        try:
+            predictions = self.batcher.submit(texts).result(timeout= self.timeout_s)
+        except Exception as e:
+            self.send_json(500, {"error": str(e)})
+            return
+        self.send_json(200, {"predictions": predictions})
+
+    # unix sockets have no client address
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix"
+
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    # get all the configuration details from the config.json file
+    with open(r"config.json") as f:
+        args = json.load(f)
+
+    logging.basicConfig(level= logging.INFO)
+    # the word tokenizer data of nltk is only downloaded if it is missing
+    ensure_nltk_data("punkt", "tokenizers/punkt")
+
+    start_time = time.perf_counter()
+    pipeline = InferencePipeline(args)
+    logging.info("loaded the inference pipeline on {} in {:.1f}s".format(pipeline.device, time.perf_counter() - start_time))
+    startup_report()
+
+    RequestHandler.batcher = MicroBatcher(pipeline, maxBatchSize= args["serve_maxBatchSize"], maxWaitMs= args["serve_maxWaitMs"])
+    if args["serve_socket"]:
+        if os.path.exists(args["serve_socket"]):
+            os.remove(args["serve_socket"])
+        server = ThreadingUnixHTTPServer(args["serve_socket"], RequestHandler)
+        logging.info("serving on unix socket {}".format(args["serve_socket"]))
+    else:
+        server = ThreadingHTTPServer((args["serve_host"], args["serve_port"]), RequestHandler)
+        logging.info("serving on http://{}:{}".format(args["serve_host"], args["serve_port"]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,48 @@
+import sys
+import time
+import logging
+import contextlib
+
+# the process start is approximated with the first import of this module (it is imported first by the scripts)
+start_time = time.perf_counter()
+# seconds every timed import took, nested imports are included in the time of the outer import
+import_times = dict()
+
+
+# time the import of a heavy dependency, only the first import is recorded (later ones come from sys.modules)
+@contextlib.contextmanager
+def import_timer(name: str):
+    if name in sys.modules:
+        yield
+        return
+    begin = time.perf_counter()
+    yield
+    import_times[name] = time.perf_counter() - begin
+
+# the models which are trained and run with torch, torch is only imported for them
+torch_models = ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]
+
+# device of a model, cuda (if available) for the torch models and the cpu for the sklearn models which do not need torch
+def get_device(model: str):
+    if model not in torch_models:
+        return "cpu"
+    with import_timer("torch"):
+        import torch
+    return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# download a nltk resource only if it is not installed yet, e.g. ensure_nltk_data("punkt", "tokenizers/punkt")
+def ensure_nltk_data(resource: str, path: str):
+    import nltk
+    try:
+        nltk.data.find(path)
+    except LookupError:
+        nltk.download(resource, quiet= True)
+
+# seconds since the start and of every timed import (slowest first), the report is logged as well
+def startup_report():
+    report = {"startup_seconds": time.perf_counter() - start_time}
+    imports = sorted(import_times.items(), key= lambda x: x[1], reverse= True)
+    for name, seconds in imports:
+        report["import_seconds_{}".format(name)] = seconds
+    logging.info("startup took {:.2f}s: {}".format(report["startup_seconds"], ", ".join("{} {:.2f}s".format(name, seconds) for name, seconds in imports)))
+    return report
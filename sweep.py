@@ -0,0 +1,186 @@
+from startup import ensure_nltk_data, get_device
+
+import os
+import sys
+import json
+import time
+import math
+import logging
+import argparse
+import itertools
+import multiprocessing
+
+import numpy as np
+import yaml
+
+import tracking
+import main
+from caching import ArtifactCache
+
+# local sweep executor: the trials of a sweep yaml (e.g. sweep.yaml) are run in this process instead of one main.py process per trial.
+# The trials are ordered by their preprocessing and tokenization key, so the preprocessed and tokenized data is created (or read from
+# the cache) once and shared in memory by all trials with the same key. The sklearn trials of a key are run in parallel in forked
+# worker processes which inherit the data. With --offline wandb is not used, the metrics of every trial are only written to the results.
+
+# models which are trained in the main process one after another (they use the gpu and all cores themselves)
+sequential_models = ["distilbert", "bert", "xlnet", "lstm", "roberta", "distilroberta"]
+
+# the data of the current key, the forked workers inherit it
+memory = dict()
+
+
+# draw one value of a parameter of the sweep yaml
+def sample_value(spec: dict, rng):
+    if "value" in spec:
+        return spec["value"]
+    if "values" in spec:
+        return spec["values"][int(rng.integers(len(spec["values"])))]
+    # yaml reads numbers like 1e-08 as strings
+    low, high = float(spec["min"]), float(spec["max"])
+    distribution = spec.get("distribution", "int_uniform" if isinstance(spec["min"], int) and isinstance(spec["max"], int) else "uniform")
+    if distribution == "int_uniform":
+        return int(rng.integers(int(low), int(high) + 1))
+    elif distribution == "uniform":
+        return float(rng.uniform(low, high))
+    elif distribution in ["log_uniform_values", "log_uniform"]:
+        # log_uniform gives the bounds as exponents of e
+        if distribution == "log_uniform_values":
+            low, high = math.log(low), math.log(high)
+        return float(math.exp(rng.uniform(low, high)))
+    else:
+        raise ValueError("distribution {} is not supported".format(distribution))
+
+# the parameter sets of the trials, grid runs all combinations of the values, random and bayes draw count random sets
+# (bayes is done as random search as the trials are not run one after another)
+def create_trials(sweep: dict, count: int = None, seed: int = 42):
+    parameters = sweep["parameters"]
+    if sweep.get("method", "grid") == "grid":
+        for name, spec in parameters.items():
+            if "value" not in spec and "values" not in spec:
+                raise ValueError("the grid search needs values for the parameter {}".format(name))
+        names = list(parameters.keys())
+        grid = [[parameters[x]["value"]] if "value" in parameters[x] else parameters[x]["values"] for x in names]
+        trials = [dict(zip(names, values)) for values in itertools.product(*grid)]
+        return trials[:count] if count else trials
+
+    if not count:
+        raise ValueError("the {} search needs a count".format(sweep["method"]))
+    rng = np.random.default_rng(seed)
+    return [{name: sample_value(spec, rng) for name, spec in parameters.items()} for _ in range(count)]
+
+
+# run one trial on the data in memory and return its parameters, the last value of every metric and the time it took
+def run_trial(args: dict, parameters: dict, cache: ArtifactCache, project: str = None, device= None):
+    metrics = dict()
+    tracking.hooks.append(metrics.update)
+    run = None
+    start_time = time.perf_counter()
+    try:
+        if tracking.use_wandb:
+            import wandb
+            run = wandb.init(project= project, entity= 'faruman', config= args, reinit= True)
+        run_name = run.name if run else "sweep_{}".format(int(time.time() * 1000))
+        tokenizer_model = main.parse_tokenizer_model(args["tokenizer_model"])
+        device = device if device else get_device(tokenizer_model["model"])
+        main.set_seeds(42)
+        artifacts = main.load_artifacts(args, tokenizer_model, cache, memory)
+        model = main.create_model(args, tokenizer_model, device)
+        main.train_model(args, tokenizer_model, model, artifacts, device, run_name= run_name)
+        tracking.log({'finished': True})
+        status = "finished"
+    except Exception as e:
+        logging.exception("trial {} failed".format(parameters))
+        metrics["error"] = str(e)
+        status = "failed"
+    finally:
+        tracking.hooks.remove(metrics.update)
+        if run:
+            run.finish()
+    return {"parameters": parameters, "status": status, "seconds": time.perf_counter() - start_time, "metrics": metrics}
+
+def run_worker_trial(trial):
+    args, parameters, cache, project = trial
+    # the worker only uses the cpu, cuda can not be used in a forked process
+    return run_trial(args, parameters, cache, project, device= "cpu")
+
+
+def run_sweep(base_args: dict, sweep: dict, count: int = None, numWorkers: int = 1, project: str = None, output: str = None, seed: int = 42):
+    cache = ArtifactCache(os.path.join(base_args["data_path"], "temp"), maxSizeGB= base_args["cache_maxSizeGB"])
+    trials = list()
+    for parameters in create_trials(sweep, count, seed):
+        args = dict(base_args, **parameters)
+        # the models of the trials are not saved, only the best one is trained again with export_bundle
+        args["export_bundle"] = False
+        keys = main.artifact_keys(args, main.parse_tokenizer_model(args["tokenizer_model"]), cache)
+        trials.append((keys["preprocessing"], keys["tokenization"], args, parameters))
+    trials.sort(key= lambda x: (x[0], x[1]))
+    print("Run {} trials with {} different tokenized datasets".format(len(trials), len(set(x[1] for x in trials))))
+
+    # fork shares the data in memory with the workers, on other platforms the trials are run one after another
+    parallel = numWorkers > 1 and "fork" in multiprocessing.get_all_start_methods()
+    if numWorkers > 1 and not parallel:
+        logging.warning("Parallel trials need the fork start method, the trials are run one after another.")
+
+    results = list()
+    for (pre_key, tok_key), group in itertools.groupby(trials, key= lambda x: (x[0], x[1])):
+        group = list(group)
+        # the preprocessed data is only kept while trials with the same preprocessing key follow
+        for key in [x for x in memory.keys() if x not in [pre_key, tok_key]]:
+            del memory[key]
+        sequential = [x for x in group if main.parse_tokenizer_model(x[2]["tokenizer_model"])["model"] in sequential_models]
+        independent = [x for x in group if x not in sequential]
+
+        if parallel and len(independent) > 1:
+            # create the data once before forking, the workers inherit it
+            main.set_seeds(42)
+            main.load_artifacts(independent[0][2], main.parse_tokenizer_model(independent[0][2]["tokenizer_model"]), cache, memory)
+            with multiprocessing.get_context("fork").Pool(min(numWorkers, len(independent))) as pool:
+                group_results = pool.map(run_worker_trial, [(args, parameters, cache, project) for _, _, args, parameters in independent], chunksize= 1)
+        else:
+            group_results = [run_trial(args, parameters, cache, project) for _, _, args, parameters in independent]
+        group_results += [run_trial(args, parameters, cache, project) for _, _, args, parameters in sequential]
+
+        for result in group_results:
+            result["cache_keys"] = {"preprocessing": pre_key, "tokenization": tok_key}
+            results.append(result)
+            if output:
+                with open(output, "a") as f:
+                    f.write(json.dumps(result, default= str) + "\n")
+    memory.clear()
+    return results
+
+# the trials sorted by the metric of the sweep (best first)
+def rank_results(results: list, metric: dict):
+    finished = [x for x in results if metric["name"] in x["metrics"]]
+    return sorted(finished, key= lambda x: x["metrics"][metric["name"]], reverse= metric.get("goal", "maximize") == "maximize")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description= "Run the trials of a wandb sweep yaml in one process, the data is shared between trials with the same preprocessing and tokenization.")
+    parser.add_argument("--sweep", default= "sweep.yaml", help= "sweep yaml, e.g. sweep.yaml or sweep_count.yaml")
+    parser.add_argument("--config", default= "config.json", help= "config with the values of all parameters which are not part of the sweep")
+    parser.add_argument("--count", type= int, default= None, help= "number of trials, needed for the random and bayes search")
+    parser.add_argument("--workers", type= int, default= 1, help= "number of processes for the sklearn trials, reduce it for models which use all cores (xgboost, randomforest)")
+    parser.add_argument("--offline", action= "store_true", help= "do not use wandb, the metrics are only written to the results file")
+    parser.add_argument("--project", default= "NewsClassification", help= "wandb project of the trials")
+    parser.add_argument("--output", default= "sweep_results.jsonl", help= "every finished trial is appended to this file")
+    parser.add_argument("--seed", type= int, default= 42, help= "seed of the random search")
+    cli_args = parser.parse_args()
+
+    logging.basicConfig(level= logging.INFO)
+    with open(cli_args.config) as f:
+        base_args = json.load(f)
+    with open(cli_args.sweep) as f:
+        sweep = yaml.safe_load(f)
+
+    tracking.use_wandb = not cli_args.offline
+    ensure_nltk_data("punkt", "tokenizers/punkt")
+
+    results = run_sweep(base_args, sweep, count= cli_args.count, numWorkers= cli_args.workers, project= cli_args.project, output= cli_args.output, seed= cli_args.seed)
+    metric = sweep.get("metric", {"name": "validate_macroF1", "goal": "maximize"})
+    ranked = rank_results(results, metric)
+    print("{} of {} trials finished, results are in {}".format(len(ranked), len(results), cli_args.output))
+    for result in ranked[:10]:
+        print("{:.4f} {:.1f}s {}".format(result["metrics"][metric["name"]], result["seconds"], result["parameters"]))
+    if not ranked:
+        sys.exit("No trial finished.")
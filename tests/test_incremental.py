@@ -0,0 +1,37 @@
+import os
+import sys
+
+import numpy as np
+import scipy.sparse as sp
+
+from sklearn.multiclass import OneVsRestClassifier
+from sklearn.naive_bayes import MultinomialNB
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import tracking
+from modeling import Model
+
+target_columns = ["world", "sports", "business", "science"]
+
+
+def make_data(num_rows= 103, num_features= 50, seed= 0):
+    rng = np.random.default_rng(seed)
+    data = sp.random(num_rows, num_features, density= 0.2, format= "csr", random_state= seed, data_rvs= lambda n: rng.integers(1, 5, n).astype(float))
+    target = np.eye(len(target_columns))[rng.integers(0, len(target_columns), num_rows)]
+    return data, target
+
+
+# partial_fit over minibatches has to give the same naive bayes as fit on the full matrix, also when run is called with several epochs
+def test_incremental_naivebayes_equals_fit(monkeypatch):
+    data, target = make_data()
+    model = Model(args= {"tokenizer": "bow", "model": "naivebayes"}, doLower= True, train_batchSize= 8, testval_batchSize= 8, learningRate= 1.0,
+                  doLearningRateScheduler= False, target_columns= target_columns, incrementalTraining= True, incrementalBatchSize= 10)
+    # only partial_fit is compared with fit, the metrics are neither sent to wandb nor validated
+    monkeypatch.setattr(tracking, "use_wandb", False)
+    monkeypatch.setattr(model, "test_validate", lambda *args, **kwargs: None)
+    model.run(data, target, data, target, data, target, epochs= 3)
+
+    reference = OneVsRestClassifier(MultinomialNB(alpha= 1.0)).fit(data, np.argmax(target, axis=1))
+    np.testing.assert_allclose(model.predictScores(data), reference.predict_proba(data))
+    for estimator, reference_estimator in zip(model.model.estimators_, reference.estimators_):
+        np.testing.assert_allclose(estimator.feature_count_, reference_estimator.feature_count_)
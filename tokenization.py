@@ -1,28 +1,208 @@
+import os
+import json
+import pickle
+import multiprocessing
+from functools import partial
+
 import pandas as pd
 import numpy as np
+from scipy import sparse
 
-from transformers import DistilBertTokenizer, BertTokenizer, XLNetTokenizer, RobertaTokenizer
 from nltk import word_tokenize
-import fasttext
-from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
+from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer, HashingVectorizer
+from sklearn.preprocessing import normalize
+from joblib import Parallel, delayed
 
 from tqdm import tqdm
 tqdm.pandas()
 
+from tokenstore import TokenStore
+from fasttext_vectors import MmapFastText
+from startup import import_timer
+
+# rust backed tokenizers with the pretrained vocabulary for the doLower (uncased) and the cased case,
+# the classes are given by name as transformers is only imported if a transformer tokenizer is used
+fast_tokenizers = {
+    "bert": ("BertTokenizerFast", 'bert-base-uncased', 'bert-base-cased'),
+    # distilbert german uncased should be used, however a pretrained model does not exist
+    "distilbert": ("DistilBertTokenizerFast", 'distilbert-base-uncased', 'distilbert-base-cased'),
+    # no uncased version exists for xlnet and the roberta models, therefore the cased version is used in both cases
+    "xlnet": ("XLNetTokenizerFast", 'xlnet-base-cased', 'xlnet-base-cased'),
+    "roberta": ("RobertaTokenizerFast", 'roberta-base', 'roberta-base'),
+    "distilroberta": ("RobertaTokenizerFast", 'distilroberta-base', 'distilroberta-base'),
+}
+
+# split the texts into words and keep only the alphabetic ones, if max_words is given only the first max_words words are used
+def tokenize_words(texts: list, max_words: int = None):
+    return [[w for w in word_tokenize(text)[:max_words] if w.isalpha()] for text in texts]
+
+
+# creates document vectors out of fasttext word vectors. Every distinct word is embedded only once, the vectors are kept
+# in a float32 matrix which grows with the vocabulary of the transformed texts (train, validation and test share it).
+# Mean pooling is a sparse (documents x vocabulary) matrix product, max pooling uses np.maximum.reduceat over the word rows.
+# Documents without alphabetic words get a zero vector.
+class FastTextFeaturizer():
+    def __init__(self, embeddingModel, pooling: str = "mean", max_length: int = 512, batchSize: int = 1000, numWorkers: int = 1):
+        self.embeddingModel = embeddingModel
+        self.pooling = pooling
+        self.max_length = max_length
+        self.batchSize = batchSize
+        self.numWorkers = numWorkers
+        self.word_index = dict()
+        self.vectors = np.zeros((0, embeddingModel.get_dimension()), dtype=np.float32)
+
+    def tokenize(self, texts: list):
+        max_words = None if self.pooling in ["mean", "max"] else self.max_length
+        chunks = [texts[i:i + self.batchSize] for i in range(0, len(texts), self.batchSize)]
+        if self.numWorkers > 1:
+            # imap keeps the order of the chunks
+            with multiprocessing.Pool(self.numWorkers) as pool:
+                tokenized = list(tqdm(pool.imap(partial(tokenize_words, max_words= max_words), chunks), total= len(chunks), desc= "Tokenize batches"))
+        else:
+            tokenized = [tokenize_words(chunk, max_words) for chunk in tqdm(chunks, desc= "Tokenize batches")]
+        return [words for chunk in tokenized for words in chunk]
+
+    # row of every word in the vector matrix, the words which were not seen before are embedded
+    def lookup(self, words: list):
+        codes, uniques = pd.factorize(pd.Series(words, dtype=object))
+        new_words = [w for w in uniques if w not in self.word_index]
+        if new_words:
+            new_vectors = np.empty((len(new_words), self.vectors.shape[1]), dtype=np.float32)
+            for i, w in enumerate(tqdm(new_words, desc= "Embed words")):
+                new_vectors[i] = self.embeddingModel.get_word_vector(w)
+                self.word_index[w] = len(self.vectors) + i
+            self.vectors = np.concatenate([self.vectors, new_vectors])
+        unique_rows = np.fromiter((self.word_index[w] for w in uniques), dtype=np.int64, count=len(uniques))
+        return unique_rows[codes]
+
+    def __call__(self, series):
+        documents = self.tokenize(list(series))
+        lengths = np.fromiter((len(x) for x in documents), dtype=np.int64, count=len(documents))
+        offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        rows = self.lookup([w for words in documents for w in words])
+
+        if self.pooling == "mean":
+            weights = np.repeat(1 / np.maximum(lengths, 1), lengths).astype(np.float32)
+            pooling_matrix = sparse.csr_matrix((weights, rows, offsets), shape=(len(documents), len(self.vectors)))
+            return np.asarray(pooling_matrix @ self.vectors, dtype=np.float32)
+        elif self.pooling == "max":
+            output = np.zeros((len(documents), self.vectors.shape[1]), dtype=np.float32)
+            # the word vectors are gathered per chunk of documents to bound the memory
+            for start in range(0, len(documents), self.batchSize):
+                end = min(start + self.batchSize, len(documents))
+                non_empty = np.flatnonzero(lengths[start:end] > 0)
+                if len(non_empty) > 0:
+                    word_vectors = self.vectors[rows[offsets[start]:offsets[end]]]
+                    output[start + non_empty] = np.maximum.reduceat(word_vectors, offsets[start:end][non_empty] - offsets[start], axis=0)
+            return output
+        else:
+            sequences = np.empty(len(documents), dtype=object)
+            for i in range(len(documents)):
+                sequences[i] = list(self.vectors[rows[offsets[i]:offsets[i + 1]]])
+            return sequences
+
+
+# bag of words features without a vocabulary, the n-grams are hashed into n_features columns. The chunks of the texts are
+# transformed in parallel and stacked. With useIdf the document frequencies are counted in a streaming pass over the training texts
+# and the features are weighted like the TfidfVectorizer (smooth idf, l2 norm). The state is only the config and the idf array.
+class HashingFeaturizer():
+    def __init__(self, ngram: int = 1, n_features: int = 2 ** 20, doLower: bool = True, useIdf: bool = False, batchSize: int = 1000, numWorkers: int = 1):
+        self.ngram = ngram
+        self.n_features = n_features
+        self.doLower = doLower
+        self.useIdf = useIdf
+        self.batchSize = batchSize
+        self.numWorkers = numWorkers
+        self.idf = None
+        # counts are not signed and not normed, so they can be used by naive bayes
+        self.vectorizer = HashingVectorizer(ngram_range= (1, ngram), n_features= n_features, lowercase= doLower, alternate_sign= False, norm= None, dtype= np.float32)
+
+    def transform_chunks(self, texts: list):
+        chunks = [texts[i:i + self.batchSize] for i in range(0, len(texts), self.batchSize)]
+        if self.numWorkers > 1:
+            return Parallel(n_jobs= self.numWorkers)(delayed(self.vectorizer.transform)(chunk) for chunk in chunks)
+        return [self.vectorizer.transform(chunk) for chunk in tqdm(chunks, desc= "Hash batches")]
+
+    def fit(self, series):
+        if self.useIdf:
+            texts = list(series)
+            document_frequency = np.zeros(self.n_features, dtype= np.int64)
+            # the chunks are counted one after the other, so only one chunk is held in memory
+            for start in tqdm(range(0, len(texts), self.batchSize * max(self.numWorkers, 1)), desc= "Count document frequencies"):
+                for counts in self.transform_chunks(texts[start:start + self.batchSize * max(self.numWorkers, 1)]):
+                    document_frequency += np.bincount(counts.indices, minlength= self.n_features)
+            self.idf = (np.log((1 + len(texts)) / (1 + document_frequency)) + 1).astype(np.float32)
+        return self
+
+    def __call__(self, series):
+        features = sparse.vstack(self.transform_chunks(list(series)), format= "csr")
+        if self.idf is not None:
+            features = normalize(features @ sparse.diags(self.idf), norm= "l2", copy= False).tocsr()
+        return features
+
+    def get_state(self):
+        return {"ngram": self.ngram, "n_features": self.n_features, "doLower": self.doLower, "useIdf": self.useIdf, "idf": None if self.idf is None else self.idf.tolist()}
+
+    @classmethod
+    def from_state(cls, state: dict, batchSize: int = 1000, numWorkers: int = 1):
+        featurizer = cls(state["ngram"], state["n_features"], state["doLower"], state["useIdf"], batchSize, numWorkers)
+        featurizer.idf = None if state["idf"] is None else np.asarray(state["idf"], dtype= np.float32)
+        return featurizer
+
+
 class Tokenizer():
-    def __init__(self, args: dict, fasttextFile: str, doLower: bool, max_length= 512):
+    def __init__(self, args: dict, fasttextFile: str, doLower: bool, max_length= 512, useFastTokenizer: bool = False, batchSize: int = 1000, numWorkers: int = 1):
         self.fasttextFile = fasttextFile
         self.doLower = doLower
         self.args = args
         self.tokenizer = None
         self.max_length = max_length
+        self.useFastTokenizer = useFastTokenizer
+        self.batchSize = batchSize
+        self.numWorkers = numWorkers
+        # the pretrained transformers tokenizer and the fitted sklearn vectorizer, they are saved with save
+        self.pretrained = None
+        self.vectorizer = None
+        # directory of a saved pretrained tokenizer which is loaded instead of the one of the hub
+        self.pretrainedPath = None
+
+    # arguments needed to recreate the tokenizer
+    def get_config(self):
+        return {"args": self.args, "fasttextFile": self.fasttextFile, "doLower": self.doLower, "max_length": self.max_length, "useFastTokenizer": self.useFastTokenizer,
+                "batchSize": self.batchSize, "numWorkers": self.numWorkers}
+
+    # load a pretrained transformers tokenizer, a loaded tokenizer (see load) reads it from its directory instead of the hub
+    def from_pretrained(self, tokenizer_class, name: str):
+        self.pretrained = tokenizer_class.from_pretrained(self.pretrainedPath if self.pretrainedPath else name)
+        return self.pretrained
 
     def fit(self, series: pd.Series):
-        if self.args["tokenizer"] == "bert":
+        if self.args["tokenizer"] in fast_tokenizers:
+            with import_timer("transformers"):
+                import transformers
+        if self.useFastTokenizer and self.args["tokenizer"] in fast_tokenizers:
+            class_name, uncased, cased = fast_tokenizers[self.args["tokenizer"]]
+            tokenizer_class = getattr(transformers, class_name)
+            if self.doLower:
+                tokenizer = self.from_pretrained(tokenizer_class, uncased)
+            else:
+                tokenizer = self.from_pretrained(tokenizer_class, cased)
+            # encode whole chunks at once and keep the unpadded token ids, padding is done per batch in the model
+            def tokenizer_fun(series):
+                texts = list(series)
+                sequences = list()
+                for i in tqdm(range(0, len(texts), self.batchSize), desc= "Tokenize batches"):
+                    toks = tokenizer(texts[i:i + self.batchSize], truncation= True, max_length= self.max_length, return_attention_mask= False, return_token_type_ids= False)
+                    sequences += toks["input_ids"]
+                return TokenStore.from_sequences(sequences)
+            self.tokenizer = tokenizer_fun
+
+        elif self.args["tokenizer"] == "bert":
             if self.doLower:
-                tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+                tokenizer = self.from_pretrained(transformers.BertTokenizer, 'bert-base-uncased')
             else:
-                tokenizer = BertTokenizer.from_pretrained('bert-base-cased')
+                tokenizer = self.from_pretrained(transformers.BertTokenizer, 'bert-base-cased')
             def generate_BERT_vectors(s):
                 toks = tokenizer(s,  return_attention_mask= True, padding="max_length", truncation= True, max_length= self.max_length)
                 return (toks["input_ids"], toks["attention_mask"])
@@ -33,9 +213,9 @@ class Tokenizer():
         elif self.args["tokenizer"] == "distilbert":
             if self.doLower:
                 # distilbert german uncased should be used, however a pretrained model does not exist
-                tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-uncased')
+                tokenizer = self.from_pretrained(transformers.DistilBertTokenizer, 'distilbert-base-uncased')
             else:
-                tokenizer = DistilBertTokenizer.from_pretrained('distilbert-base-cased')
+                tokenizer = self.from_pretrained(transformers.DistilBertTokenizer, 'distilbert-base-cased')
             def generate_DistilBERT_vectors(s):
                 toks = tokenizer(s, return_attention_mask=True, padding="max_length", truncation= True, max_length= self.max_length)
                 return (toks["input_ids"], toks["attention_mask"])
@@ -46,9 +226,9 @@ class Tokenizer():
         elif self.args["tokenizer"] == "xlnet":
             if self.doLower:
                 # XLNET uncased should be used, however a pretrained model does not exist
-                tokenizer = XLNetTokenizer.from_pretrained('xlnet-base-cased')
+                tokenizer = self.from_pretrained(transformers.XLNetTokenizer, 'xlnet-base-cased')
             else:
-                tokenizer = XLNetTokenizer.from_pretrained('xlnet-base-cased')
+                tokenizer = self.from_pretrained(transformers.XLNetTokenizer, 'xlnet-base-cased')
 
             def generate_XLM_vectors(s):
                 toks = tokenizer(s, return_attention_mask=True, padding=True, truncation=True, max_length= self.max_length)
@@ -61,9 +241,9 @@ class Tokenizer():
         elif self.args["tokenizer"] == "roberta":
             if self.doLower:
                 # roberta uncased should be used, however a pretrained model does not exist
-                tokenizer = RobertaTokenizer.from_pretrained('roberta-base')
+                tokenizer = self.from_pretrained(transformers.RobertaTokenizer, 'roberta-base')
             else:
-                tokenizer = RobertaTokenizer.from_pretrained('roberta-base')
+                tokenizer = self.from_pretrained(transformers.RobertaTokenizer, 'roberta-base')
 
             def generate_Roberta_vectors(s):
                 toks = tokenizer(s, return_attention_mask=True, padding="max_length", truncation=True, max_length= self.max_length)
@@ -75,9 +255,9 @@ class Tokenizer():
         elif self.args["tokenizer"] == "distilroberta":
             if self.doLower:
                 # distilroberta uncased should be used, however a pretrained model does not exist
-                tokenizer = RobertaTokenizer.from_pretrained('distilroberta-base')
+                tokenizer = self.from_pretrained(transformers.RobertaTokenizer, 'distilroberta-base')
             else:
-                tokenizer = RobertaTokenizer.from_pretrained('distilroberta-base')
+                tokenizer = self.from_pretrained(transformers.RobertaTokenizer, 'distilroberta-base')
 
             def generate_DistilRoberta_vectors(s):
                 toks = tokenizer(s, return_attention_mask=True, padding="max_length", truncation=True, max_length= self.max_length)
@@ -87,43 +267,99 @@ class Tokenizer():
             self.tokenizer = tokenizer_fun
 
         elif "fasttext" in self.args["tokenizer"]:
-            embeddingModel = fasttext.load_model(self.fasttextFile)
-            def generate_fasttext_vectors(s):
-                words = word_tokenize(s)
-                if "mean" in self.args["tokenizer"]:
-                    words_embed = [embeddingModel.get_word_vector(w) for w in words if w.isalpha()]
-                    words_embed = np.column_stack(words_embed).mean(axis=1)
-                elif "max" in self.args["tokenizer"]:
-                    words_embed = [embeddingModel.get_word_vector(w) for w in words if w.isalpha()]
-                    words_embed = np.column_stack(words_embed).max(axis=1)
-                else:
-                    words = words[:self.max_length]
-                    words_embed = [embeddingModel.get_word_vector(w) for w in words if w.isalpha()]
-                return words_embed
-            def tokenizer_fun(series):
-                if "mean" in self.args["tokenizer"] or "max" in self.args["tokenizer"]:
-                    return np.row_stack(pd.Series(series).progress_apply(generate_fasttext_vectors).values)
-                else:
-                    return pd.Series(series).progress_apply(generate_fasttext_vectors).values
-            self.tokenizer = tokenizer_fun
+            # a directory holds the vectors converted with fasttext_vectors.py, they are memory mapped instead of loading the whole model
+            if os.path.isdir(self.fasttextFile):
+                embeddingModel = MmapFastText.load(self.fasttextFile)
+            else:
+                with import_timer("fasttext"):
+                    import fasttext
+                embeddingModel = fasttext.load_model(self.fasttextFile)
+            if "mean" in self.args["tokenizer"]:
+                pooling = "mean"
+            elif "max" in self.args["tokenizer"]:
+                pooling = "max"
+            else:
+                pooling = None
+            self.tokenizer = FastTextFeaturizer(embeddingModel, pooling= pooling, max_length= self.max_length, batchSize= self.batchSize, numWorkers= self.numWorkers)
+
+        elif self.args["tokenizer"] in ["bow_hash", "tfidf_hash"]:
+            self.tokenizer = HashingFeaturizer(ngram= self.args["ngram"], n_features= self.args.get("n_features", 2 ** 20), doLower= self.doLower, useIdf= self.args["tokenizer"] == "tfidf_hash",
+                                               batchSize= self.batchSize, numWorkers= self.numWorkers).fit(series)
 
         elif self.args["tokenizer"] == "bow":
-            vectorizer = CountVectorizer(ngram_range= (1, self.args["ngram"]), lowercase= self.doLower)
-            vectorizer.fit(series)
-            def tokenizer_fun(series):
-                return vectorizer.transform(series)
-            self.tokenizer = tokenizer_fun
+            self.vectorizer = CountVectorizer(ngram_range= (1, self.args["ngram"]), lowercase= self.doLower)
+            self.vectorizer.fit(series)
+            self.tokenizer = self.vectorizer.transform
 
         elif self.args["tokenizer"] == "tfidf":
-            vectorizer = TfidfVectorizer(ngram_range= (1, self.args["ngram"]), lowercase= self.doLower)
-            vectorizer.fit(series)
-            def tokenizer_fun(series):
-                return vectorizer.transform(series)
-            self.tokenizer = tokenizer_fun
+            self.vectorizer = TfidfVectorizer(ngram_range= (1, self.args["ngram"]), lowercase= self.doLower)
+            self.vectorizer.fit(series)
+            self.tokenizer = self.vectorizer.transform
 
     def transform(self, series):
-        return self.tokenizer(pd.Series(series))
+        output = self.tokenizer(pd.Series(series))
+        # the padded output of the slow transformer tokenizers is stored in the same columnar format
+        if self.args["tokenizer"] in fast_tokenizers and not isinstance(output, TokenStore):
+            output = TokenStore.from_pairs(output)
+        return output
 
     def fit_transform(self, series):
         self.fit(pd.Series(series))
-        return self.transform(series)
\ No newline at end of file
+        return self.transform(series)
+
+    # the state which was learned from the training texts (it can be pickled, e.g. into the artifact cache). The pretrained
+    # tokenizers and fasttext do not learn from the texts, they have no state
+    def get_state(self):
+        if isinstance(self.tokenizer, HashingFeaturizer):
+            return {"hashing": self.tokenizer.get_state()}
+        if self.vectorizer is not None:
+            return {"vectorizer": self.vectorizer}
+        return dict()
+
+    # restore the state of get_state without fitting on the texts again. The fasttext vectors are not loaded, the config
+    # is all that is saved of them (load loads them for the inference)
+    def set_state(self, state: dict):
+        if "hashing" in state:
+            self.tokenizer = HashingFeaturizer.from_state(state["hashing"], batchSize= self.batchSize, numWorkers= self.numWorkers)
+        elif "vectorizer" in state:
+            self.vectorizer = state["vectorizer"]
+            self.tokenizer = self.vectorizer.transform
+        elif "fasttext" not in self.args["tokenizer"]:
+            # only loads the pretrained tokenizer, nothing is fitted
+            self.fit(None)
+        return self
+
+    # save the fitted tokenizer into a directory, the pretrained tokenizer is saved with its vocabulary so it is loaded without the hub.
+    # The fasttext vectors are not copied, they are loaded from fasttextFile
+    def save(self, path: str):
+        os.makedirs(path, exist_ok= True)
+        with open(os.path.join(path, "tokenizer_config.json"), "w") as f:
+            json.dump(self.get_config(), f, indent= 2)
+        state = self.get_state()
+        if "hashing" in state:
+            with open(os.path.join(path, "hashing.json"), "w") as f:
+                json.dump(state["hashing"], f)
+        elif "vectorizer" in state:
+            with open(os.path.join(path, "vectorizer.pkl"), "wb") as f:
+                pickle.dump(state["vectorizer"], f)
+        elif self.pretrained is not None:
+            self.pretrained.save_pretrained(os.path.join(path, "pretrained"))
+
+    # load a tokenizer saved with save
+    @classmethod
+    def load(cls, path: str):
+        with open(os.path.join(path, "tokenizer_config.json")) as f:
+            tokenizer = cls(**json.load(f))
+        state = dict()
+        if os.path.exists(os.path.join(path, "hashing.json")):
+            with open(os.path.join(path, "hashing.json")) as f:
+                state["hashing"] = json.load(f)
+        elif os.path.exists(os.path.join(path, "vectorizer.pkl")):
+            with open(os.path.join(path, "vectorizer.pkl"), "rb") as f:
+                state["vectorizer"] = pickle.load(f)
+        elif os.path.isdir(os.path.join(path, "pretrained")):
+            tokenizer.pretrainedPath = os.path.join(path, "pretrained")
+        tokenizer.set_state(state)
+        if tokenizer.tokenizer is None:
+            tokenizer.fit(None)
+        return tokenizer
\ No newline at end of file
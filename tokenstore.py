@@ -0,0 +1,134 @@
+import os
+import json
+
+import numpy as np
+
+
+# columnar storage of tokenized texts, the token ids of all texts are kept in one flat int32 buffer
+# and text i is tokens[offsets[i]:offsets[i + 1]]. Saved stores are opened with np.memmap, so loading is instant
+# and batches only read the rows they need.
+class TokenStore():
+    version = 1
+
+    def __init__(self, tokens, offsets, labels= None, path= None):
+        self.tokens = tokens
+        self.offsets = offsets
+        self.labels = labels
+        self.path = path
+
+    @classmethod
+    def from_sequences(cls, sequences, labels= None):
+        lengths = np.fromiter((len(x) for x in sequences), dtype=np.int64, count=len(sequences))
+        offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        if len(sequences) > 0:
+            tokens = np.concatenate([np.asarray(x, dtype=np.int32) for x in sequences])
+        else:
+            tokens = np.empty(0, dtype=np.int32)
+        return cls(tokens, offsets, labels)
+
+    # create the store from (input_ids, attention_mask) pairs of padded sequences, the padding is removed
+    @classmethod
+    def from_pairs(cls, pairs, labels= None):
+        return cls.from_sequences([np.asarray(ids)[np.asarray(mask) == 1] for ids, mask in pairs], labels)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    # view of the token ids of one text (no copy)
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    # create a new store which only holds the given texts
+    def subset(self, indices):
+        indices = np.asarray(indices)
+        labels = self.labels[indices] if self.labels is not None else None
+        return TokenStore.from_sequences([self[i] for i in indices], labels)
+
+    # create the padded input_ids and attention_mask for a batch of texts, if no length is given the batch is padded to its longest text
+    def pad_batch(self, indices, pad_id, padding_side= "right", length= None):
+        indices = np.asarray(indices, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        if length is None:
+            length = max(int(lengths.max()) if len(lengths) > 0 else 0, 1)
+        lengths = np.minimum(lengths, length)
+        columns = np.arange(length)[None, :]
+        if padding_side == "left":
+            shift = (length - lengths)[:, None]
+            valid = columns >= shift
+            source = starts[:, None] + np.where(valid, columns - shift, 0)
+        else:
+            valid = columns < lengths[:, None]
+            source = starts[:, None] + np.where(valid, columns, 0)
+        if len(self.tokens) > 0:
+            input_ids = np.where(valid, self.tokens[np.minimum(source, len(self.tokens) - 1)], pad_id).astype(np.int64)
+        else:
+            input_ids = np.full(valid.shape, pad_id, dtype=np.int64)
+        return input_ids, valid.astype(np.int64)
+
+    # create the (text, label sentence) pairs of the binary classification for a batch of texts, the result has the shape
+    # (batch, num_labels, length). The label sentence directly follows the text, if the text is too long it is cut but keeps its last token.
+    def pad_label_pairs(self, indices, label_ids, label_lengths, pad_id, padding_side= "right", max_length= 512, length= None):
+        indices = np.asarray(indices, dtype=np.int64)
+        label_ids = np.asarray(label_ids)
+        label_lengths = np.asarray(label_lengths, dtype=np.int64)
+        starts = self.offsets[indices]
+        lengths = self.offsets[indices + 1] - starts
+        if length is None:
+            length = int(min(lengths.max() + label_lengths.max(), max_length)) if len(indices) > 0 else 1
+
+        head = np.minimum(lengths[:, None], length - label_lengths[None, :])
+        total = head + label_lengths[None, :]
+        columns = np.broadcast_to(np.arange(length)[None, None, :], (len(indices), len(label_lengths), length))
+        if padding_side == "left":
+            # position inside the sequence which is aligned to the right end
+            columns = columns - (length - total)[:, :, None]
+
+        is_text = (columns >= 0) & (columns < head[:, :, None])
+        text_position = np.where(columns == head[:, :, None] - 1, lengths[:, None, None] - 1, columns)
+        label_position = columns - head[:, :, None]
+        is_label = (label_position >= 0) & (label_position < label_lengths[None, :, None])
+        label_row = np.broadcast_to(np.arange(len(label_lengths))[None, :, None], columns.shape)
+
+        input_ids = np.full(columns.shape, pad_id, dtype=np.int32)
+        input_ids[is_text] = self.tokens[(starts[:, None, None] + text_position)[is_text]]
+        input_ids[is_label] = label_ids[label_row[is_label], label_position[is_label]]
+        return input_ids, (is_text | is_label).astype(np.int32)
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, "tokens.npy"), np.asarray(self.tokens, dtype=np.int32))
+        np.save(os.path.join(path, "offsets.npy"), np.asarray(self.offsets, dtype=np.int64))
+        if self.labels is not None:
+            np.save(os.path.join(path, "labels.npy"), np.asarray(self.labels))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"format": "tokenstore", "version": self.version, "num_texts": len(self), "num_tokens": int(self.offsets[-1])}, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode= "r"):
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta["version"] != cls.version:
+            raise ValueError("TokenStore version {} can not be read, expected version {}.".format(meta["version"], cls.version))
+        tokens = np.load(os.path.join(path, "tokens.npy"), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode=mmap_mode)
+        labels = None
+        if os.path.exists(os.path.join(path, "labels.npy")):
+            labels = np.load(os.path.join(path, "labels.npy"), mmap_mode=mmap_mode)
+        return cls(tokens, offsets, labels, path=path)
+
+    # memory mapped stores are pickled by their path (e.g. for dataloader workers), so the pages are shared and not copied
+    def __getstate__(self):
+        if self.path is not None and isinstance(self.tokens, np.memmap):
+            return {"path": self.path}
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        if list(state.keys()) == ["path"]:
+            state = TokenStore.load(state["path"]).__dict__
+        self.__dict__.update(state)
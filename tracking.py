@@ -0,0 +1,17 @@
+import logging
+
+# the metrics of the current run are sent to wandb and to the registered hooks, e.g. the local sweep runner collects the
+# metrics of its trials with a hook. Without wandb (use_wandb = False) wandb is not imported and only the hooks get the metrics.
+use_wandb = True
+hooks = list()
+
+
+def log(metrics: dict):
+    if use_wandb:
+        import wandb
+        wandb.log(metrics)
+    for hook in hooks:
+        try:
+            hook(metrics)
+        except Exception:
+            logging.exception("metrics hook failed")